@@ -1,9 +1,12 @@
 from pathlib import Path
-from dotenv import load_dotenv
 import os
+import tempfile
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-load_dotenv(BASE_DIR / '.env')
+# Only pay for importing python-dotenv when there is a .env file to read
+if (BASE_DIR / '.env').exists():
+    from dotenv import load_dotenv
+    load_dotenv(BASE_DIR / '.env')
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 
@@ -33,7 +36,6 @@ INSTALLED_APPS = [
 
 INSTALLED_APPS += [
     'encryption',
-    "anymail",
 ]
 
 MIDDLEWARE = [
@@ -73,11 +75,87 @@ WSGI_APPLICATION = 'data_security_system.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        # Tests run on a file rather than Django's shared-cache in-memory database,
+        # whose table locks fail concurrent writers at once instead of waiting
+        'TEST': {
+            'NAME': os.environ.get('SQLITE_TEST_PATH') or os.path.join(
+                tempfile.gettempdir(), f'data_security_system_test_{os.getpid()}.sqlite3'
+            ),
+        },
     }
 }
 
 
+# Cache. The default local-memory cache is per process; point CACHE_BACKEND at a
+# shared backend (e.g. django.core.cache.backends.redis.RedisCache with
+# CACHE_LOCATION=redis://127.0.0.1:6379) when running several workers or nodes so
+# cache-based invalidation reaches all of them. `manage.py check` refuses the
+# local-memory cache when WEB_CONCURRENCY > 1, and `check --deploy` outside DEBUG.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Upper bound on (user, key_name) resolutions kept in each worker's memory
+KEY_CACHE_MAX_ENTRIES = int(os.environ.get('KEY_CACHE_MAX_ENTRIES', 10000))
+
+# Encrypt each new record under its own HKDF subkey of the key (see
+# encryption/ciphers.py). Turning it off only affects new ciphertexts; derived
+# ones keep decrypting. SUBKEY_CACHE_MAX_ENTRIES bounds the derived subkeys each
+# worker keeps in memory.
+KEY_DERIVATION = os.environ.get('KEY_DERIVATION', 'true').lower() in ('1', 'true', 'yes')
+SUBKEY_CACHE_MAX_ENTRIES = int(os.environ.get('SUBKEY_CACHE_MAX_ENTRIES', 4096))
+
+
+# Rate limiting (see encryption/ratelimit.py). Use CacheCounterStore with a shared
+# CACHE_BACKEND when running several workers or nodes.
+RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RATELIMIT_STORE = os.environ.get('RATELIMIT_STORE', 'encryption.ratelimit.MemoryCounterStore')
+RATELIMIT_TRUST_X_FORWARDED_FOR = os.environ.get('RATELIMIT_TRUST_X_FORWARDED_FOR', 'false').lower() in ('1', 'true', 'yes')
+RATELIMITS = {
+    'login': {'ip': '20/m', 'user': '5/m'},
+    'verify_2fa': {'ip': '20/m', 'user': '5/5m'},
+    'crypto': {'ip': '120/m', 'user': '60/m'},
+    'api': {'ip': '600/m', 'user': '300/m'},
+}
+
+# Login codes (see encryption/otp.py): lifetime in seconds and wrong guesses
+# allowed before a code is locked
+OTP_TTL_SECONDS = int(os.environ.get('OTP_TTL_SECONDS', 600))
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', 5))
+
+# JSON API (encryption/api.py): largest page a client may request with ?limit=
+API_MAX_PAGE_SIZE = 500
+
+
+# Blind-index search (see encryption/search.py). Changing BLIND_INDEX_KEY requires
+# `python manage.py rebuild_search_index`; when empty a key is derived from SECRET_KEY.
+BLIND_INDEX_KEY = os.environ.get('BLIND_INDEX_KEY', '')
+BLIND_INDEX_PREFIX_MIN = 2
+BLIND_INDEX_PREFIX_MAX = 12
+BLIND_INDEX_MAX_TOKENS = 256
+
+
+# Cached dashboard/record fragments: lifetime in seconds, largest row table kept in
+# the cache, and rows rendered per streamed chunk (see encryption/fragments.py)
+FRAGMENT_CACHE_TIMEOUT = 600
+FRAGMENT_CACHE_MAX_BYTES = 1024 * 1024
+STREAM_CHUNK_ROWS = 500
+
+# Prometheus metrics at /encryption/metrics/ (see encryption/metrics.py). Scrapes
+# are allowed from METRICS_ALLOWED_IPS or with "Authorization: Bearer <METRICS_TOKEN>".
+# Under gunicorn point METRICS_MULTIPROC_DIR at a per-host directory shared by the
+# workers (and empty it on restart) so every worker's numbers are merged.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()]
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+
 # Development security: keep defaults safe but allow HTTP locally
 # When DEBUG=True we disable strict secure settings so you can test over HTTP.
 SECURE_SSL_REDIRECT = False
@@ -125,7 +203,46 @@ STATIC_URL = 'static/'
 
 # Media files configuration
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', BASE_DIR / 'media')
+
+# Storage backends. Encrypted blobs use their own alias so they can be moved to
+# an S3-compatible store (ENCRYPTED_FILES_STORAGE=encryption.storage.S3Storage,
+# plus the AWS_* variables below) without touching the rest of the media files.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'encrypted_files': {
+        'BACKEND': os.environ.get('ENCRYPTED_FILES_STORAGE', 'encryption.storage.ShardedFileSystemStorage'),
+    },
+}
+
+AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME', '')
+AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL', '')  # e.g. http://localhost:9000 for MinIO
+AWS_S3_REGION_NAME = os.environ.get('AWS_S3_REGION_NAME', '')
+
+# Batch encryption endpoint limits (BATCH_MAX_WORKERS=0 means one worker per CPU).
+# BATCH_MAX_ENTRY_BYTES caps each file or archive member once decompressed.
+BATCH_MAX_ENTRIES = int(os.environ.get('BATCH_MAX_ENTRIES', 5000))
+BATCH_MAX_ENTRY_BYTES = int(os.environ.get('BATCH_MAX_ENTRY_BYTES', 64 * 1024 * 1024))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 0))
+
+# Plaintext bytes per segment of segmented (appendable, range-readable) files;
+# see encryption/segments.py. Changing it only affects segments written afterwards.
+FILE_SEGMENT_SIZE = int(os.environ.get('FILE_SEGMENT_SIZE', 1024 * 1024))
+
+# Coordination of writes to the same file (see encryption/locks.py). PostgreSQL
+# and MySQL use database locks; other backends flock() files in LOCK_DIR (default:
+# a directory in the system temp dir). LOCK_TIMEOUT is in seconds.
+LOCK_DIR = os.environ.get('LOCK_DIR', '')
+LOCK_TIMEOUT = float(os.environ.get('LOCK_TIMEOUT', 30))
+
+# Activity rollups behind the admin panel charts (see encryption/rollups.py) are
+# buffered per worker and written this often, in seconds, and at exit; 0 writes through.
+ROLLUP_FLUSH_INTERVAL = float(os.environ.get('ROLLUP_FLUSH_INTERVAL', 10))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -182,7 +299,15 @@ else:
 
 DEFAULT_FROM_EMAIL = os.environ.get("DEFAULT_FROM_EMAIL", "Your App <no-reply@yourdomain.com>")
 
+# Anymail (which pulls in `requests` at startup) is only installed when one of its
+# backends is selected, e.g. EMAIL_SERVICE=other EMAIL_BACKEND=anymail.backends.brevo.EmailBackend
+if EMAIL_BACKEND.startswith('anymail.'):
+    INSTALLED_APPS += ['anymail']
+
 # Optional API keys used by the app for HTTPS email providers
 # Prefer setting these as environment variables in production (e.g. on PythonAnywhere)
 BREVO_API_KEY = os.environ.get('BREVO_API_KEY', '')
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY', '')
+# Provider endpoints; overridden by `manage.py loadtest` to point at local stand-ins
+RESEND_API_URL = os.environ.get('RESEND_API_URL', 'https://api.resend.com')
+BREVO_API_URL = os.environ.get('BREVO_API_URL', 'https://api.brevo.com')
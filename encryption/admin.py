@@ -1,32 +1,98 @@
-from django.contrib import admin
-from .models import EncryptionKey, EncryptedData, EncryptedFile, TwoFactorCode
+from django.contrib import admin, messages
+from .models import DailyActivity, EncryptionKey, EncryptedData, EncryptedFile, EncryptedPayload, TwoFactorCode
+from . import search
+
+
+class BlindIndexSearchMixin:
+	"""Match names by exact name or prefix through the blind index instead of icontains scans.
+
+	Digests are per user, so names are only searched once a user is selected in
+	the user filter. Only prefixes up to BLIND_INDEX_PREFIX_MAX characters are
+	indexed, so the hits for a longer search are confirmed against the full name.
+	"""
+	blind_index_kind = None
+	blind_index_name_field = None
+
+	def get_search_results(self, request, queryset, search_term):
+		base = queryset
+		queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+		if not search_term:
+			return queryset, may_have_duplicates
+		user = request.GET.get('user__id__exact')
+		if not user:
+			self.message_user(request, 'Select a user in the filter to search record names.', messages.INFO)
+			return queryset, may_have_duplicates
+		by_prefix = base.filter(pk__in=search.search_ids(search_term, self.blind_index_kind, search.MODE_PREFIX, user))
+		term = search.normalize(search_term)
+		if len(term) > search.prefix_max():
+			by_prefix = by_prefix.filter(**{f'{self.blind_index_name_field}__istartswith': term})
+		queryset |= by_prefix
+		queryset |= base.filter(pk__in=search.search_ids(search_term, self.blind_index_kind, search.MODE_EXACT, user))
+		return queryset, may_have_duplicates
 
 
 @admin.register(EncryptionKey)
 class EncryptionKeyAdmin(admin.ModelAdmin):
-	list_display = ('key_name', 'user', 'created_at')
+	list_display = ('key_name', 'cipher', 'user', 'created_at')
 	search_fields = ('key_name', 'user__username')
+	list_filter = ('cipher',)
 	readonly_fields = ('created_at',)
 
 
+class EncryptedPayloadInline(admin.StackedInline):
+	"""The ciphertext, loaded on the change page only."""
+	model = EncryptedPayload
+	can_delete = False
+
+
 @admin.register(EncryptedData)
-class EncryptedDataAdmin(admin.ModelAdmin):
-	list_display = ('data_name', 'user', 'key', 'created_at')
-	search_fields = ('data_name', 'user__username', 'key__key_name')
+class EncryptedDataAdmin(BlindIndexSearchMixin, admin.ModelAdmin):
+	list_display = ('data_name', 'user', 'key', 'encrypted_size', 'created_at')
+	list_select_related = ('user', 'key')
+	search_fields = ('=user__username', '=key__key_name')
+	blind_index_kind = 'data'
+	blind_index_name_field = 'data_name'
 	list_filter = ('user',)
-	readonly_fields = ('created_at',)
+	readonly_fields = ('created_at', 'encrypted_size')
+	inlines = (EncryptedPayloadInline,)
+
+	def get_queryset(self, request):
+		# The list page renders usernames and key names only: leave key material behind
+		return super().get_queryset(request).defer('key__key_value')
+
+	def save_related(self, request, form, formsets, change):
+		super().save_related(request, form, formsets, change)
+		payload = EncryptedPayload.objects.filter(record=form.instance).values_list('value', flat=True).first()
+		if payload is not None:
+			EncryptedData.objects.filter(pk=form.instance.pk).update(encrypted_size=len(payload))
 
 
 @admin.register(EncryptedFile)
-class EncryptedFileAdmin(admin.ModelAdmin):
-	list_display = ('file_name', 'user', 'key', 'created_at')
-	search_fields = ('file_name', 'user__username')
+class EncryptedFileAdmin(BlindIndexSearchMixin, admin.ModelAdmin):
+	list_display = ('file_name', 'user', 'key', 'size', 'created_at')
+	list_select_related = ('user', 'key')
+	search_fields = ('=user__username',)
+	blind_index_kind = 'file'
+	blind_index_name_field = 'file_name'
+	list_filter = ('user',)
 	readonly_fields = ('created_at',)
 
 
 @admin.register(TwoFactorCode)
 class TwoFactorCodeAdmin(admin.ModelAdmin):
-	list_display = ('user', 'code', 'used', 'attempts', 'created_at')
-	search_fields = ('user__username', 'code')
+	list_display = ('user', 'used', 'attempts', 'created_at')
+	list_select_related = ('user',)
+	search_fields = ('user__username',)
 	list_filter = ('used',)
+	exclude = ('code_hash',)
 	readonly_fields = ('created_at',)
+
+
+@admin.register(DailyActivity)
+class DailyActivityAdmin(admin.ModelAdmin):
+	list_display = ('day', 'user', 'encryptions', 'decryptions', 'bytes_processed', 'logins', 'two_factor_failures')
+	list_select_related = ('user',)
+	search_fields = ('user__username',)
+	date_hierarchy = 'day'
+	# Counters are maintained by encryption.rollups
+	readonly_fields = ('day', 'user', 'encryptions', 'decryptions', 'bytes_processed', 'logins', 'two_factor_failures')
@@ -0,0 +1,207 @@
+"""
+Read-only JSON API for key, data and file metadata.
+
+Responses carry an ``ETag`` derived from the user's records version (see
+``encryption.fragments``) and from one aggregate over the rows in scope: their
+count, newest ``created_at`` and, for files, the sum of row versions. Writes
+that bypass the signals (queryset updates, other tools on the database) still
+change the tag, and a poll with a matching ``If-None-Match`` is answered with
+304 without reading any record. ``Last-Modified`` is the later of the user's
+last recorded change and the newest ``created_at``, and is honoured via
+``If-Modified-Since`` the same way.
+
+Query parameters:
+
+- ``fields=id,key_name``: only return (and only select) these fields.
+- ``limit`` / ``after``: keyset pagination on ``id``; follow ``next``.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.http import Http404, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from . import fragments
+from .models import EncryptedData, EncryptedFile, EncryptionKey
+from .ratelimit import ratelimit
+from .storage import get_encrypted_storage
+
+
+class Resource:
+    def __init__(self, model, fields: Dict[str, str], default_fields: List[str], version_field: Optional[str] = None):
+        self.model = model
+        self.fields = fields  # API name -> ORM lookup
+        self.default_fields = default_fields
+        self.version_field = version_field  # bumped on every change to a row
+
+
+RESOURCES = {
+    "keys": Resource(
+        EncryptionKey,
+        {"id": "id", "key_name": "key_name", "cipher": "cipher", "created_at": "created_at"},
+        ["id", "key_name", "cipher", "created_at"],
+    ),
+    "data": Resource(
+        EncryptedData,
+        {
+            "id": "id",
+            "data_name": "data_name",
+            "key": "key__key_name",
+            "created_at": "created_at",
+            "size": "encrypted_size",
+            # Joined in from the payload table only when asked for
+            "encrypted_value": "payload__value",
+        },
+        ["id", "data_name", "key", "created_at", "size"],
+    ),
+    "files": Resource(
+        EncryptedFile,
+        {
+            "id": "id",
+            "file_name": "file_name",
+            "key": "key__key_name",
+            "created_at": "created_at",
+            "url": "encrypted_file",
+            "size": "size",
+            "segmented": "segmented",
+            "version": "version",
+        },
+        ["id", "file_name", "key", "created_at", "url", "size", "segmented", "version"],
+        version_field="version",
+    ),
+}
+
+
+def api_login_required(view):
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({"error": "Authentication required"}, status=401)
+        return view(request, *args, **kwargs)
+
+    return wrapped
+
+
+def _selected_fields(request, resource: Resource) -> Optional[List[str]]:
+    requested = request.GET.get("fields")
+    if not requested:
+        return resource.default_fields
+    fields = [f.strip() for f in requested.split(",") if f.strip()]
+    if not fields or any(f not in resource.fields for f in fields):
+        return None
+    return fields
+
+
+def _validators(request, resource_name: str, res: Resource, queryset, *parts) -> Tuple[str, Optional[int]]:
+    """``(etag, last_modified)`` for the rows of ``queryset``, from one aggregate query."""
+    aggregates = {"count": Count("id"), "created": Max("created_at")}
+    if res.version_field:
+        # Versions only grow, so the sum changes whenever any row does
+        aggregates["versions"] = Sum(res.version_field)
+    state = queryset.aggregate(**aggregates)
+    version = fragments.records_version(request.user.pk)
+    raw = "|".join(str(p) for p in (
+        resource_name, request.user.pk, version, state["count"], state["created"], state.get("versions"), *parts
+    ))
+    etag = quote_etag(hashlib.sha1(raw.encode()).hexdigest())
+
+    last_modified = fragments.records_changed_at(request.user.pk)
+    if state["created"] is not None:
+        created = int(state["created"].timestamp())
+        last_modified = created if last_modified is None else max(last_modified, created)
+    return etag, last_modified
+
+
+def _serialize(row: Dict, fields: List[str], resource: Resource) -> Dict:
+    item = {name: row[resource.fields[name]] for name in fields}
+    if "url" in item:
+        item["url"] = get_encrypted_storage().url(item["url"]) if item["url"] else None
+    return item
+
+
+def _conditional(request, etag: str, last_modified: Optional[int]):
+    """Return a 304 (carrying the validators) when the client's copy is current."""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response["ETag"] = etag
+    return response
+
+
+def _respond(request, payload: Dict, etag: str, last_modified: Optional[int]):
+    response = JsonResponse(payload)
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _get_resource(name: str) -> Resource:
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise Http404
+
+
+@api_login_required
+@ratelimit("api", methods=("GET",))
+def list_view(request, resource: str):
+    res = _get_resource(resource)
+    fields = _selected_fields(request, res)
+    if fields is None:
+        return JsonResponse({"error": f"Unknown field; choose from {sorted(res.fields)}"}, status=400)
+    try:
+        max_limit = int(getattr(settings, "API_MAX_PAGE_SIZE", 500))
+        limit = min(int(request.GET.get("limit", 50)), max_limit)
+        after = int(request.GET.get("after", 0))
+    except ValueError:
+        return JsonResponse({"error": "limit and after must be integers"}, status=400)
+    if limit < 1:
+        return JsonResponse({"error": "limit must be positive"}, status=400)
+
+    owned = res.model.objects.filter(user=request.user)
+    etag, last_modified = _validators(request, resource, res, owned, ",".join(fields), limit, after)
+    # Cheap path: nothing changed since the client's copy, so skip reading the rows
+    not_modified = _conditional(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    lookups = sorted({res.fields[f] for f in fields} | {"id"})
+    rows = list(owned.filter(id__gt=after).order_by("id").values(*lookups)[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_url = None
+    if has_more:
+        params = request.GET.copy()
+        params["after"] = rows[-1]["id"]
+        next_url = request.build_absolute_uri(f"{request.path}?{params.urlencode()}")
+
+    payload = {"results": [_serialize(row, fields, res) for row in rows], "next": next_url}
+    return _respond(request, payload, etag, last_modified)
+
+
+@api_login_required
+@ratelimit("api", methods=("GET",))
+def detail_view(request, resource: str, pk: int):
+    res = _get_resource(resource)
+    fields = _selected_fields(request, res)
+    if fields is None:
+        return JsonResponse({"error": f"Unknown field; choose from {sorted(res.fields)}"}, status=400)
+
+    owned = res.model.objects.filter(user=request.user, pk=pk)
+    etag, last_modified = _validators(request, resource, res, owned, ",".join(fields), pk)
+    not_modified = _conditional(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    lookups = sorted({res.fields[f] for f in fields} | {"id"})
+    row = owned.values(*lookups).first()
+    if row is None:
+        return JsonResponse({"error": "Not found"}, status=404)
+    return _respond(request, _serialize(row, fields, res), etag, last_modified)
@@ -0,0 +1,200 @@
+"""
+Batch encryption of many uploaded files or archive entries.
+
+Entries are read sequentially from the request (archive readers are not thread
+safe), then encrypted and written to storage on a thread pool. The heavy lifting
+happens inside OpenSSL, which releases the GIL, so throughput scales with cores.
+All records are inserted with a single ``bulk_create``.
+"""
+from __future__ import annotations
+
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from .ciphers import Cipher
+from . import fragments, search
+from .models import EncryptedFile
+from .storage import get_encrypted_storage
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class BatchError(Exception):
+    """A batch request that cannot be processed as submitted."""
+
+
+class BatchLimitExceeded(BatchError):
+    pass
+
+
+class InvalidArchive(BatchError):
+    pass
+
+
+def _max_entries() -> int:
+    return int(getattr(settings, "BATCH_MAX_ENTRIES", 5000))
+
+
+def _max_entry_bytes() -> int:
+    return int(getattr(settings, "BATCH_MAX_ENTRY_BYTES", 64 * 1024 * 1024))
+
+
+def _read_entry(name: str, fileobj, declared_size: Optional[int] = None) -> bytes:
+    """Read ``fileobj`` in chunks, refusing it once it passes ``BATCH_MAX_ENTRY_BYTES``.
+
+    Archive headers can understate a member's size, so the declared size only
+    short-circuits the obvious cases and the bytes actually read are counted too.
+    """
+    limit = _max_entry_bytes()
+    if declared_size is not None and declared_size > limit:
+        raise BatchLimitExceeded(f"{name} exceeds {limit} bytes")
+    chunks = []
+    total = 0
+    while True:
+        chunk = fileobj.read(min(READ_CHUNK_SIZE, limit + 1 - total))
+        if not chunk:
+            return b"".join(chunks)
+        total += len(chunk)
+        if total > limit:
+            raise BatchLimitExceeded(f"{name} exceeds {limit} bytes")
+        chunks.append(chunk)
+
+
+def _max_workers() -> int:
+    return int(getattr(settings, "BATCH_MAX_WORKERS", 0) or os.cpu_count() or 1)
+
+
+def is_archive(name: str) -> bool:
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def _iter_archive(upload) -> Iterator[Tuple[str, bytes]]:
+    # Archive modules are only needed by batch uploads; keep them off the startup path
+    import tarfile
+    import zipfile
+
+    try:
+        yield from _read_archive(upload, tarfile, zipfile)
+    except (zipfile.BadZipFile, tarfile.TarError) as exc:
+        raise InvalidArchive(f"{upload.name}: {exc}") from exc
+
+
+def _read_archive(upload, tarfile, zipfile) -> Iterator[Tuple[str, bytes]]:
+    name = upload.name.lower()
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(upload) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, _read_entry(info.filename, member, info.file_size)
+    else:
+        # "r|*" streams members in order without seeking back through the upload
+        with tarfile.open(fileobj=upload, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                extracted = archive.extractfile(member)
+                if extracted is None:
+                    continue
+                yield member.name, _read_entry(member.name, extracted, member.size)
+
+
+def iter_entries(uploads: Iterable, expand_archives: bool = True) -> Iterator[Tuple[str, bytes]]:
+    """Yield ``(file_name, plaintext)`` for every uploaded file, expanding archives."""
+    limit = _max_entries()
+    count = 0
+    for upload in uploads:
+        if expand_archives and is_archive(upload.name):
+            entries = _iter_archive(upload)
+        else:
+            entries = iter([(upload.name, _read_entry(upload.name, upload, getattr(upload, "size", None)))])
+        for entry_name, content in entries:
+            count += 1
+            if count > limit:
+                raise BatchLimitExceeded(f"Batch exceeds {limit} entries")
+            yield entry_name.replace("\\", "/").lstrip("/")[:255], content
+
+
+def _encrypt_and_store(cipher: Cipher, storage, file_name: str, content: bytes) -> Tuple[str, int]:
+    token = cipher.encrypt(content)
+    stored_as = storage.save(
+        storage.generate_filename(f"encrypted_files/{os.path.basename(file_name)}"),
+        ContentFile(token),
+    )
+    return stored_as, len(token)
+
+
+def encrypt_batch(
+    key,
+    user,
+    entries: Iterable[Tuple[str, bytes]],
+    max_workers: Optional[int] = None,
+) -> List[Dict]:
+    """Encrypt ``entries`` under ``key`` in parallel and record them in one insert.
+
+    Returns a manifest with one dict per entry, in input order.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    storage = get_encrypted_storage()
+    cipher = key.get_cipher()
+    workers = max_workers or _max_workers()
+    manifest: List[Dict] = []
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            item = pending.pop(future)
+            try:
+                item["stored_as"], item["encrypted_size"] = future.result()
+                item["status"] = "encrypted"
+            except Exception as exc:
+                item["status"] = "error"
+                item["error"] = str(exc)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for file_name, content in entries:
+                item = {"file_name": file_name, "size": len(content)}
+                manifest.append(item)
+                pending[pool.submit(_encrypt_and_store, cipher.for_new_record(), storage, file_name, content)] = item
+                # Keep a bounded number of plaintexts in memory
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(wait(pending).done)
+        except BaseException:
+            # ``entries`` failed partway (bad archive, limit reached): let the
+            # submitted entries finish, then remove every blob already written
+            collect(wait(pending).done)
+            for item in manifest:
+                if item.get("stored_as"):
+                    storage.delete(item["stored_as"])
+            raise
+
+    stored = [item for item in manifest if item["status"] == "encrypted"]
+    try:
+        with transaction.atomic():
+            records = EncryptedFile.objects.bulk_create(
+                [
+                    EncryptedFile(
+                        file_name=item["file_name"], encrypted_file=item["stored_as"], key=key, user=user,
+                        size=item["size"],
+                    )
+                    for item in stored
+                ]
+            )
+            # bulk_create skips post_save, so index and invalidate explicitly
+            search.index_records(records)
+            fragments.invalidate(user.pk, fragments.GLOBAL_SCOPE)
+    except Exception:
+        for item in stored:
+            storage.delete(item["stored_as"])
+        raise
+    return manifest
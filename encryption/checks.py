@@ -0,0 +1,68 @@
+"""
+System checks for settings the encryption app relies on.
+
+Key resolution (``keycache``), rendered fragments (``fragments``) and API ETags
+are invalidated by bumping version counters in the default cache. With a
+process-local backend a bump only reaches the worker that made it, and the
+other workers keep serving deleted keys and stale listings. So a shared backend
+is required whenever more than one process serves requests: always when
+``WEB_CONCURRENCY`` asks for several workers, and under ``check --deploy``
+(outside DEBUG).
+"""
+from __future__ import annotations
+
+import os
+from typing import List
+
+from django.conf import settings
+from django.core.checks import CheckMessage, Error, Tags, register
+
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+_HINT = (
+    "Set CACHE_BACKEND to a backend shared by every worker, e.g. "
+    "django.core.cache.backends.redis.RedisCache with CACHE_LOCATION=redis://host:6379."
+)
+
+
+def _worker_count() -> int:
+    try:
+        return int(os.environ.get("WEB_CONCURRENCY", 1))
+    except ValueError:
+        return 1
+
+
+def _process_local_backend():
+    backend = settings.CACHES.get("default", {}).get("BACKEND", "")
+    return backend if backend in PROCESS_LOCAL_CACHES else None
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs) -> List[CheckMessage]:
+    backend = _process_local_backend()
+    workers = _worker_count()
+    if backend is None or workers <= 1:
+        return []
+    return [Error(
+        f"WEB_CONCURRENCY={workers} but the default cache ({backend}) is local to each process, "
+        "so key, fragment and ETag invalidations would not reach the other workers.",
+        hint=_HINT,
+        id="encryption.E001",
+    )]
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache_deploy(app_configs, **kwargs) -> List[CheckMessage]:
+    backend = _process_local_backend()
+    if backend is None or settings.DEBUG or _worker_count() > 1:
+        # DEBUG runs are single-process; several workers are reported by E001
+        return []
+    return [Error(
+        f"The default cache ({backend}) is local to each process, so key, fragment and ETag "
+        "invalidations would not reach other workers or nodes.",
+        hint=_HINT,
+        id="encryption.E002",
+    )]
@@ -0,0 +1,350 @@
+"""
+Versioned cipher suites for encryption keys.
+
+``EncryptionKey.cipher`` names the suite used for new ciphertexts. AEAD suites
+(AES-256-GCM, ChaCha20-Poly1305) emit a self-describing token::
+
+    MAGIC (3 bytes) | suite id (1 byte) | nonce (12 bytes) | ciphertext + tag
+
+Anything without the header is treated as a legacy Fernet token, so data written
+before a key (or the app) switched suites keeps decrypting.
+
+Records can be encrypted under their own subkey, derived with HKDF-SHA256 from
+the key's material and a random 16-byte record id (:meth:`Cipher.for_record`).
+Such tokens wrap the token made with the subkey::
+
+    DERIVED_MAGIC (3 bytes) | record id (16 bytes) | token
+
+The record id travels with the ciphertext, so the master ``Cipher`` decrypts
+any record, and rows keep decrypting when they are copied or renumbered (vault
+imports). Subkeys derived for decryption are kept in a bounded LRU
+(``subkeys``), so repeated reads of the same record, such as the segments of
+one file, derive only once. A new record's cipher derives its own subkey and
+keeps it to itself: write-once records would only evict the entries that reads
+reuse.
+
+Binary payloads (files) are stored raw; text payloads (``EncryptedData``) are
+urlsafe-base64 encoded so they fit the existing text column.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from . import metrics
+
+
+__all__ = [
+    "FERNET",
+    "AES_256_GCM",
+    "CHACHA20_POLY1305",
+    "CIPHER_CHOICES",
+    "DEFAULT_CIPHER",
+    "InvalidToken",
+    "Cipher",
+    "generate_key",
+    "get_cipher",
+    "new_record_id",
+]
+
+FERNET = "fernet"
+AES_256_GCM = "aes256gcm"
+CHACHA20_POLY1305 = "chacha20poly1305"
+
+CIPHER_CHOICES = [
+    (FERNET, "Fernet (AES-128-CBC + HMAC-SHA256)"),
+    (AES_256_GCM, "AES-256-GCM"),
+    (CHACHA20_POLY1305, "ChaCha20-Poly1305"),
+]
+DEFAULT_CIPHER = FERNET
+
+MAGIC = b"DS\x01"
+NONCE_SIZE = 12
+_SUITE_IDS = {AES_256_GCM: 1, CHACHA20_POLY1305: 2}
+_SUITE_BY_ID = {v: k for k, v in _SUITE_IDS.items()}
+
+DERIVED_MAGIC = b"DS\x02"
+RECORD_ID_SIZE = 16
+_HEADERS = (MAGIC, DERIVED_MAGIC)
+_HKDF_INFO = b"data-security-system/record-key/v1:"
+
+
+class InvalidToken(Exception):
+    """Ciphertext is corrupt, truncated or was made with a different key."""
+
+
+# cryptography's primitives are imported on first use rather than at module load:
+# models import this module, so it is on every worker's startup path.
+
+def _fernet(key_value: bytes):
+    from cryptography.fernet import Fernet
+
+    return Fernet(key_value)
+
+
+def _aead_class(suite: str):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+    return {AES_256_GCM: AESGCM, CHACHA20_POLY1305: ChaCha20Poly1305}[suite]
+
+
+def _setting(name: str, default):
+    from django.conf import settings
+
+    return getattr(settings, name, default)
+
+
+# Children resolved once: the encrypt/decrypt path only does a dict lookup and an add
+_ENCRYPTED = {suite: metrics.CRYPTO_PAYLOAD.labels("encrypt", suite) for suite, _ in CIPHER_CHOICES}
+_DECRYPTED = {suite: metrics.CRYPTO_PAYLOAD.labels("decrypt", suite) for suite, _ in CIPHER_CHOICES}
+_SUBKEY_HIT = metrics.SUBKEY_CACHE_LOOKUPS.labels("hit")
+_SUBKEY_MISS = metrics.SUBKEY_CACHE_LOOKUPS.labels("miss")
+
+
+def _suite_of(token: bytes):
+    """Suite a token was made with; ``None`` for an unknown AEAD suite id."""
+    if not token.startswith(MAGIC):
+        return FERNET
+    return _SUITE_BY_ID.get(token[len(MAGIC)]) if len(token) > len(MAGIC) else None
+
+
+def generate_key(cipher: str = DEFAULT_CIPHER) -> str:
+    """Return a new urlsafe-base64 key for ``cipher``.
+
+    All suites use 32 bytes of key material, so the same format works for each.
+    """
+    if cipher not in dict(CIPHER_CHOICES):
+        raise ValueError(f"Unknown cipher suite {cipher!r}")
+    # Fernet keys are urlsafe-base64 encoded 32 random bytes too
+    return base64.urlsafe_b64encode(os.urandom(32)).decode()
+
+
+def new_record_id() -> bytes:
+    return os.urandom(RECORD_ID_SIZE)
+
+
+def derivation_enabled() -> bool:
+    return bool(_setting("KEY_DERIVATION", True))
+
+
+def derive_key(key_value: bytes, record_id: bytes) -> bytes:
+    """HKDF-SHA256 subkey of ``key_value`` for ``record_id``, in the same format as ``generate_key``."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=_HKDF_INFO + record_id)
+    return base64.urlsafe_b64encode(hkdf.derive(base64.urlsafe_b64decode(key_value)))
+
+
+class SubkeyCache:
+    """Bounded LRU of subkey ciphers by (key material, suite, record id)."""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[bytes, str, bytes], Cipher]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_entries(self) -> int:
+        if self._max_entries is None:
+            self._max_entries = int(_setting("SUBKEY_CACHE_MAX_ENTRIES", 4096))
+        return self._max_entries
+
+    def get(self, key_value: bytes, cipher: str, record_id: bytes) -> "Cipher":
+        entry_key = (key_value, cipher, record_id)
+        with self._lock:
+            subkey = self._entries.get(entry_key)
+            if subkey is not None:
+                self._entries.move_to_end(entry_key)
+        if subkey is not None:
+            _SUBKEY_HIT.inc()
+            return subkey
+        _SUBKEY_MISS.inc()
+        # Derived outside the lock; a concurrent miss for the same record derives the same key
+        subkey = Cipher(derive_key(key_value, record_id), cipher)
+        with self._lock:
+            self._entries[entry_key] = subkey
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return subkey
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+subkeys = SubkeyCache()
+metrics.SUBKEY_CACHE_ENTRIES.set_function(lambda: len(subkeys))
+
+
+def _split_derived(token: bytes) -> Tuple[bytes, bytes]:
+    start = len(DERIVED_MAGIC)
+    if len(token) <= start + RECORD_ID_SIZE:
+        raise InvalidToken
+    return token[start : start + RECORD_ID_SIZE], token[start + RECORD_ID_SIZE :]
+
+
+class Cipher:
+    """A key bound to its suite. Encrypts with ``cipher`` and decrypts any suite.
+
+    With a ``record_id`` (see :meth:`for_record`) new tokens are made with that
+    record's subkey; decryption handles master-key and subkey tokens alike.
+    """
+
+    def __init__(self, key_value: str, cipher: str = DEFAULT_CIPHER, record_id: Optional[bytes] = None):
+        if cipher not in dict(CIPHER_CHOICES):
+            raise ValueError(f"Unknown cipher suite {cipher!r}")
+        if record_id is not None and len(record_id) != RECORD_ID_SIZE:
+            raise ValueError(f"Record ids are {RECORD_ID_SIZE} bytes")
+        self.cipher = cipher
+        self.record_id = record_id
+        self._key_value = key_value.encode() if isinstance(key_value, str) else key_value
+        self._fernet = None
+        self._aeads: Dict[str, object] = {}
+        self._record_subkey: Optional[Cipher] = None
+
+    def for_record(self, record_id: bytes) -> "Cipher":
+        """This key, encrypting under the subkey of ``record_id``."""
+        return Cipher(self._key_value, self.cipher, record_id)
+
+    def for_new_record(self) -> "Cipher":
+        """Cipher for a new record: its own random subkey, or this key when ``KEY_DERIVATION`` is off."""
+        return self.for_record(new_record_id()) if derivation_enabled() else self
+
+    def _subkey(self, record_id: bytes) -> "Cipher":
+        return subkeys.get(self._key_value, self.cipher, record_id)
+
+    def _own_subkey(self) -> "Cipher":
+        # Kept on this cipher, which is all that encrypts for the record (e.g. every segment of one upload)
+        if self._record_subkey is None:
+            self._record_subkey = Cipher(derive_key(self._key_value, self.record_id), self.cipher)
+        return self._record_subkey
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            self._fernet = _fernet(self._key_value)
+        return self._fernet
+
+    def _aead(self, suite: str):
+        aead = self._aeads.get(suite)
+        if aead is None:
+            aead = _aead_class(suite)(base64.urlsafe_b64decode(self._key_value))
+            self._aeads[suite] = aead
+        return aead
+
+    # -- binary -------------------------------------------------------------
+
+    def encrypt(self, data: bytes) -> bytes:
+        if self.record_id is not None:
+            return DERIVED_MAGIC + self.record_id + self._own_subkey().encrypt(data)
+        _ENCRYPTED[self.cipher].observe(len(data))
+        if self.cipher == FERNET:
+            return self.fernet.encrypt(data)
+        header = MAGIC + bytes([_SUITE_IDS[self.cipher]])
+        nonce = os.urandom(NONCE_SIZE)
+        return header + nonce + self._aead(self.cipher).encrypt(nonce, data, header)
+
+    def decrypt(self, token: bytes) -> bytes:
+        if token.startswith(DERIVED_MAGIC):
+            try:
+                record_id, inner = _split_derived(token)
+            except InvalidToken:
+                metrics.CRYPTO_FAILURES.labels("unknown").inc()
+                raise
+            return self._subkey(record_id).decrypt(inner)
+        suite = _suite_of(token)
+        try:
+            data = self._decrypt(suite, token)
+        except InvalidToken:
+            metrics.CRYPTO_FAILURES.labels(suite or "unknown").inc()
+            raise
+        _DECRYPTED[suite].observe(len(data))
+        return data
+
+    def _decrypt(self, suite, token: bytes) -> bytes:
+        from cryptography import fernet
+        from cryptography.exceptions import InvalidTag
+
+        if suite == FERNET:
+            try:
+                return self.fernet.decrypt(token)
+            except fernet.InvalidToken:
+                raise InvalidToken
+        if suite is None:
+            raise InvalidToken
+        header = token[: len(MAGIC) + 1]
+        nonce = token[len(header) : len(header) + NONCE_SIZE]
+        try:
+            return self._aead(suite).decrypt(nonce, token[len(header) + NONCE_SIZE :], header)
+        except (InvalidTag, ValueError):
+            raise InvalidToken
+
+    def verify(self, token: bytes) -> bool:
+        """Check a token's integrity without keeping any plaintext.
+
+        Fernet tokens only need their HMAC checked, which skips decryption. AEAD
+        tags can only be checked by decrypting; the plaintext is discarded.
+        """
+        if token.startswith(DERIVED_MAGIC):
+            try:
+                record_id, inner = _split_derived(token)
+            except InvalidToken:
+                return False
+            return self._subkey(record_id).verify(inner)
+        if token.startswith(MAGIC):
+            try:
+                self._decrypt(_suite_of(token), token)
+            except InvalidToken:
+                return False
+            return True
+        try:
+            raw = base64.urlsafe_b64decode(token)
+            signing_key = base64.urlsafe_b64decode(self._key_value)[:16]
+        except (ValueError, TypeError):
+            return False
+        # version (1) | timestamp (8) | IV (16) | ciphertext (n * 16) | HMAC (32)
+        if len(raw) < 57 or raw[0] != 0x80 or (len(raw) - 57) % 16:
+            return False
+        expected = hmac.new(signing_key, raw[:-32], hashlib.sha256).digest()
+        return hmac.compare_digest(expected, raw[-32:])
+
+    # -- text ---------------------------------------------------------------
+
+    def encrypt_text(self, value: str) -> str:
+        token = self.encrypt(value.encode())
+        if self.cipher == FERNET and self.record_id is None:
+            return token.decode()
+        return base64.urlsafe_b64encode(token).decode()
+
+    def verify_text(self, token: str) -> bool:
+        raw = token.encode()
+        try:
+            decoded = base64.urlsafe_b64decode(raw)
+        except (ValueError, TypeError):
+            return False
+        return self.verify(decoded if decoded.startswith(_HEADERS) else raw)
+
+    def decrypt_text(self, token: str) -> str:
+        raw = token.encode()
+        try:
+            decoded = base64.urlsafe_b64decode(raw)
+        except (ValueError, TypeError):
+            raise InvalidToken
+        # Fernet tokens are base64 text themselves; AEAD and derived tokens are base64 of MAGIC...
+        if decoded.startswith(_HEADERS):
+            return self.decrypt(decoded).decode()
+        return self.decrypt(raw).decode()
+
+
+def get_cipher(key) -> Cipher:
+    """Return a :class:`Cipher` for an ``EncryptionKey`` instance."""
+    return Cipher(key.key_value, getattr(key, "cipher", DEFAULT_CIPHER))
@@ -0,0 +1,120 @@
+"""
+Fragment caching and progressive rendering for record listings.
+
+Every user has a records version counter in the shared cache, plus one global
+counter for pages that list everyone's records (record system, admin panel).
+Signals bump the counters whenever keys, data, files or users change, so a
+cached fragment keyed on a version simply stops being looked up once the data
+behind it changes; nothing has to be deleted explicitly.
+
+Long row tables are streamed: the page template renders a marker from
+``{{ stream.<name> }}`` where the rows go, and :func:`stream_template` yields the
+page around it while rows are rendered from ``queryset.iterator()`` in chunks.
+"""
+from __future__ import annotations
+
+import time
+from typing import Dict, Iterator, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
+
+from .keycache import bump_version, current_version
+
+GLOBAL_SCOPE = "all"
+
+
+def _version_key(scope) -> str:
+    return f"fragver:{scope}"
+
+
+def records_version(scope=GLOBAL_SCOPE) -> int:
+    """Current version for a user id (or ``GLOBAL_SCOPE``)."""
+    return current_version(_version_key(scope))
+
+
+def records_changed_at(scope=GLOBAL_SCOPE) -> Optional[int]:
+    """Unix time of the last recorded change in ``scope``, if still known."""
+    return cache.get(f"fragts:{scope}")
+
+
+def invalidate(*scopes) -> None:
+    now = int(time.time())
+    for scope in scopes:
+        bump_version(_version_key(scope))
+        cache.set(f"fragts:{scope}", now, timeout=None)
+
+
+def fragment_timeout() -> int:
+    return int(getattr(settings, "FRAGMENT_CACHE_TIMEOUT", 600))
+
+
+class RowStream:
+    """Rows of a table rendered in chunks from a queryset, optionally cached.
+
+    ``template_name`` receives ``rows`` (a list of objects) and renders their
+    ``<tr>`` elements; ``empty_html`` is emitted when the queryset has no rows.
+    """
+
+    def __init__(self, template_name: str, queryset, empty_html: str = "", cache_key: Optional[str] = None,
+                 chunk_size: Optional[int] = None):
+        self.template_name = template_name
+        self.queryset = queryset
+        self.empty_html = empty_html
+        self.cache_key = cache_key
+        self.chunk_size = chunk_size or int(getattr(settings, "STREAM_CHUNK_ROWS", 500))
+
+    def render(self) -> Iterator[str]:
+        if self.cache_key:
+            cached = cache.get(self.cache_key)
+            if cached is not None:
+                yield cached
+                return
+
+        template = get_template(self.template_name)
+        max_bytes = int(getattr(settings, "FRAGMENT_CACHE_MAX_BYTES", 1024 * 1024))
+        # Only small listings are worth keeping in the cache; stop collecting
+        # (and hold no rendered HTML) once a listing outgrows max_bytes
+        parts, size, rows, rendered_any = [], 0, [], False
+        for obj in self.queryset.iterator(chunk_size=self.chunk_size):
+            rows.append(obj)
+            if len(rows) >= self.chunk_size:
+                html = template.render({"rows": rows})
+                rows, rendered_any = [], True
+                size += len(html)
+                if parts is not None:
+                    parts.append(html)
+                    if size > max_bytes:
+                        parts = None
+                yield html
+        if rows or not rendered_any:
+            html = template.render({"rows": rows}) if rows else self.empty_html
+            size += len(html)
+            if parts is not None:
+                parts.append(html)
+                if size > max_bytes:
+                    parts = None
+            yield html
+
+        if self.cache_key and parts is not None:
+            cache.set(self.cache_key, "".join(parts), fragment_timeout())
+
+
+def stream_template(request, template_name: str, context: Dict, streams: Dict[str, RowStream]) -> StreamingHttpResponse:
+    """Render ``template_name`` and stream each ``RowStream`` where its marker appears."""
+    markers = {name: mark_safe(f"<!--stream:{name}-->") for name in streams}
+    page = render_to_string(template_name, {**context, "stream": markers}, request)
+    positions = sorted((page.find(marker), name) for name, marker in markers.items() if marker in page)
+
+    def generate():
+        offset = 0
+        for position, name in positions:
+            yield page[offset:position]
+            yield from streams[name].render()
+            offset = position + len(markers[name])
+        yield page[offset:]
+
+    return StreamingHttpResponse(generate(), content_type="text/html; charset=utf-8")
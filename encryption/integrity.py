@@ -0,0 +1,216 @@
+"""
+Integrity sweeps over stored ciphertexts.
+
+Every ``EncryptedData`` token and ``EncryptedFile`` blob (each segment blob,
+for segmented files) is checked against its
+key with :meth:`Cipher.verify`: Fernet tokens by HMAC alone, AEAD tokens by
+decrypting in memory and discarding the result. Nothing is written except the
+``verified_at`` timestamp of records that pass, so a sweep can be resumed or
+run incrementally, re-checking only records not verified within ``max_age``.
+
+Work is split into chunks and checked on a process pool (workers open blobs
+from storage themselves, so only ids and names cross process boundaries for
+files). The main process reads one page of rows per query, after the last
+primary key seen, and keeps at most a few chunks in flight. No cursor is left
+open while records that passed are updated (SQLite does not cope with writes to
+a table that an open cursor is scanning).
+"""
+from __future__ import annotations
+
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .ciphers import Cipher
+from .storage import get_encrypted_storage
+
+KIND_DATA = "data"
+KIND_FILE = "file"
+KINDS = (KIND_DATA, KIND_FILE)
+
+# (id, ok, error, bytes checked)
+Result = Tuple[int, bool, str, int]
+
+
+def _ciphers():
+    cache = {}
+
+    def get(key_value: str, cipher: str) -> Cipher:
+        if (key_value, cipher) not in cache:
+            cache[(key_value, cipher)] = Cipher(key_value, cipher)
+        return cache[(key_value, cipher)]
+
+    return get
+
+
+def check_data(items: List[Tuple[int, str, str, str]]) -> List[Result]:
+    """Check ``(id, token, key_value, cipher)`` tuples."""
+    get_cipher = _ciphers()
+    results = []
+    for pk, token, key_value, cipher in items:
+        try:
+            ok = get_cipher(key_value, cipher).verify_text(token)
+            results.append((pk, ok, "" if ok else "token failed authentication", len(token)))
+        except Exception as exc:
+            results.append((pk, False, str(exc), len(token)))
+    return results
+
+
+def check_files(items: List[Tuple[int, Union[str, List[str]], str, str]]) -> List[Result]:
+    """Check ``(id, blob name(s), key_value, cipher)`` tuples, reading blobs from storage.
+
+    Segmented files pass the list of their segment blob names; every one must pass.
+    """
+    storage = get_encrypted_storage()
+    get_cipher = _ciphers()
+    results = []
+    for pk, names, key_value, cipher in items:
+        checked = 0
+        try:
+            for name in [names] if isinstance(names, str) else names:
+                with storage.open(name, "rb") as blob:
+                    token = blob.read()
+                checked += len(token)
+                if not get_cipher(key_value, cipher).verify(token):
+                    results.append((pk, False, f"blob {name} failed authentication", checked))
+                    break
+            else:
+                results.append((pk, True, "", checked))
+        except Exception as exc:
+            results.append((pk, False, f"{type(exc).__name__}: {exc}", checked))
+    return results
+
+
+def _sources():
+    # Imported here: spawned workers import this module before django.setup()
+    from .models import EncryptedData, EncryptedFile
+
+    return {
+        KIND_DATA: (EncryptedData, "payload__value", check_data, None),
+        KIND_FILE: (EncryptedFile, "encrypted_file", check_files, _segment_names),
+    }
+
+
+def _segment_names(chunk: List[Tuple]) -> List[Tuple]:
+    """Swap the (empty) blob name of segmented files for their segment blob names."""
+    from .models import FileSegment
+
+    segmented = [row[0] for row in chunk if not row[1]]
+    if not segmented:
+        return chunk
+    names: Dict[int, List[str]] = {pk: [] for pk in segmented}
+    for file_id, blob in FileSegment.objects.filter(file_id__in=segmented).order_by("file_id", "index").values_list(
+        "file_id", "blob"
+    ):
+        names[file_id].append(blob)
+    return [(pk, names.get(pk, name), *rest) for pk, name, *rest in chunk]
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+
+def _pending(model, max_age: Optional[timedelta], now):
+    queryset = model.objects.order_by("pk")
+    if max_age is not None:
+        queryset = queryset.filter(Q(verified_at__isnull=True) | Q(verified_at__lt=now - max_age))
+    return queryset
+
+
+def _pages(rows, size: int, limit: Optional[int] = None):
+    """Yield lists of up to ``size`` rows (``pk`` first, ordered by pk), one query each."""
+    last = None
+    while limit is None or limit > 0:
+        page_size = size if limit is None else min(size, limit)
+        page = list((rows if last is None else rows.filter(pk__gt=last))[:page_size])
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][0]
+        if limit is not None:
+            limit -= len(page)
+
+
+class _InlineExecutor:
+    """Runs checks in-process (``workers=0``) behind the executor interface."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def sweep(
+    kinds: Iterable[str] = KINDS,
+    max_age: Optional[timedelta] = None,
+    workers: int = 0,
+    chunk_size: int = 200,
+    limit: Optional[int] = None,
+    on_failure=None,
+) -> Dict:
+    """Verify records of ``kinds``; ``max_age=None`` checks everything.
+
+    Returns counts, bytes checked and elapsed seconds. ``on_failure(kind, id, error)``
+    is called for every record that fails.
+    """
+    now = timezone.now()
+    report = {"checked": 0, "failed": 0, "bytes": 0, "elapsed": 0.0}
+    start = time.perf_counter()
+
+    if workers:
+        # Spawned rather than forked: workers never inherit the parent's open
+        # database connection or the cursor that is streaming rows
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+        )
+    else:
+        executor = _InlineExecutor()
+
+    def collect(kind, model, futures):
+        passed = []
+        for future in futures:
+            for pk, ok, error, nbytes in future.result():
+                report["checked"] += 1
+                report["bytes"] += nbytes
+                if ok:
+                    passed.append(pk)
+                else:
+                    report["failed"] += 1
+                    if on_failure is not None:
+                        on_failure(kind, pk, error)
+        if passed:
+            # update() skips signals: nothing user-visible changed
+            model.objects.filter(pk__in=passed).update(verified_at=now)
+
+    sources = _sources()
+    with executor:
+        for kind in kinds:
+            model, field, check, prepare = sources[kind]
+            rows = _pending(model, max_age, now).values_list("pk", field, "key__key_value", "key__cipher")
+            in_flight = set()
+            for chunk in _pages(rows, chunk_size, limit):
+                if prepare is not None:
+                    chunk = prepare(chunk)
+                in_flight.add(executor.submit(check, chunk))
+                if len(in_flight) >= max(workers, 1) * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(kind, model, done)
+            collect(kind, model, wait(in_flight).done)
+
+    report["elapsed"] = time.perf_counter() - start
+    return report
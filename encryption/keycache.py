@@ -0,0 +1,172 @@
+"""
+Per-user key resolution with a process-local cache.
+
+Crypto views resolve ``(user, key_name)`` to a key on every request. Lookups are
+served from an in-process LRU so the hot path skips the database. Entries are
+tagged with a version read from Django's cache framework; saving or deleting a
+key bumps the owner's version, which invalidates the entry in every worker that
+shares that cache backend (configure a shared backend such as Redis or
+Memcached when running several workers or nodes; ``encryption.checks`` reports
+a process-local one).
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+KeyRef = namedtuple("KeyRef", "id key_name cipher key_value user_id")
+
+_HIT = metrics.KEY_CACHE_LOOKUPS.labels("hit")
+_MISS = metrics.KEY_CACHE_LOOKUPS.labels("miss")
+
+_GLOBAL_VERSION_KEY = "keyres:v"
+
+
+def _user_version_key(user_id: int) -> str:
+    return f"keyres:v:{user_id}"
+
+
+def _seed() -> int:
+    # Counters lost to eviction restart from the clock, so they never repeat an
+    # old value and resurrect stale entries
+    return time.time_ns() // 1000
+
+
+def current_version(version_key: str) -> int:
+    """Read a version counter from the shared cache, creating it if missing."""
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, _seed(), timeout=None)
+        version = cache.get(version_key)
+    return version
+
+
+def bump_version(version_key: str) -> None:
+    """Atomically increment a version counter in the shared cache."""
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # Missing key: start a fresh counter (add() keeps concurrent starters safe)
+        if not cache.add(version_key, _seed(), timeout=None):
+            cache.incr(version_key)
+
+
+class KeyResolutionCache:
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[tuple, KeyRef]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _version(self, user_id: int) -> tuple:
+        return self._versions([user_id])[user_id]
+
+    def _versions(self, user_ids: Iterable[int]) -> Dict[int, tuple]:
+        """Versions of many users, read with one ``get_many``."""
+        keys = {user_id: _user_version_key(user_id) for user_id in user_ids}
+        found = cache.get_many([_GLOBAL_VERSION_KEY, *keys.values()])
+
+        def read(version_key):
+            return found[version_key] if version_key in found else current_version(version_key)
+
+        global_version = read(_GLOBAL_VERSION_KEY)
+        return {user_id: (global_version, read(version_key)) for user_id, version_key in keys.items()}
+
+    def get(self, user_id: int, key_name: str, version: Optional[tuple] = None) -> Optional[KeyRef]:
+        version = self._version(user_id) if version is None else version
+        with self._lock:
+            entry = self._entries.get((user_id, key_name))
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                _MISS.inc()
+                return None
+            self._entries.move_to_end((user_id, key_name))
+            self.hits += 1
+            _HIT.inc()
+            return entry[1]
+
+    def put(self, ref: KeyRef, version: Optional[tuple] = None) -> None:
+        version = self._version(ref.user_id) if version is None else version
+        with self._lock:
+            self._entries[(ref.user_id, ref.key_name)] = (version, ref)
+            self._entries.move_to_end((ref.user_id, ref.key_name))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+key_cache = KeyResolutionCache(getattr(settings, "KEY_CACHE_MAX_ENTRIES", 10_000))
+metrics.KEY_CACHE_ENTRIES.set_function(lambda: len(key_cache))
+
+
+def _ref_for(key) -> KeyRef:
+    return KeyRef(key.id, key.key_name, key.cipher, key.key_value, key.user_id)
+
+
+def _to_instance(ref: KeyRef):
+    from .models import EncryptionKey
+
+    key = EncryptionKey(
+        id=ref.id, key_name=ref.key_name, cipher=ref.cipher, key_value=ref.key_value, user_id=ref.user_id
+    )
+    key._state.adding = False
+    key._state.db = "default"
+    return key
+
+
+def resolve_key(user, key_name: str):
+    """Return the ``EncryptionKey`` named ``key_name`` owned by ``user``.
+
+    Raises ``EncryptionKey.DoesNotExist`` like ``objects.get`` would.
+    """
+    from .models import EncryptionKey
+
+    version = key_cache._version(user.pk)
+    ref = key_cache.get(user.pk, key_name, version)
+    if ref is None:
+        key = EncryptionKey.objects.only("id", "key_name", "cipher", "key_value", "user_id").get(
+            user=user, key_name=key_name
+        )
+        ref = _ref_for(key)
+        key_cache.put(ref, version)
+    return _to_instance(ref)
+
+
+def invalidate_user(user_id: int) -> None:
+    bump_version(_user_version_key(user_id))
+
+
+def invalidate_all() -> None:
+    """Drop every cached resolution, e.g. after bulk writes that skip signals."""
+    bump_version(_GLOBAL_VERSION_KEY)
+
+
+def warm(limit: Optional[int] = None) -> int:
+    """Preload the most recent keys into this process. Returns the number loaded."""
+    from .models import EncryptionKey
+
+    limit = key_cache.max_entries if limit is None else limit
+    keys = EncryptionKey.objects.order_by("-id")[:limit]
+    # Versions first, in one round trip: a key changed while warming is then
+    # stored under a version its (post-commit) bump has already superseded
+    versions = key_cache._versions(set(keys.values_list("user_id", flat=True)))
+    count = 0
+    for key in keys.only("id", "key_name", "cipher", "key_value", "user_id").iterator():
+        if key.user_id in versions:
+            key_cache.put(_ref_for(key), versions[key.user_id])
+            count += 1
+    return count
@@ -0,0 +1,390 @@
+"""
+Load-testing harness for the login and encryption paths.
+
+Nothing here talks to a real provider:
+
+- ``ProviderStub`` is a local HTTP server that answers like the Resend
+  (``POST /emails``) and Brevo (``POST /v3/smtp/email``) APIs, with configurable
+  latency and error rate.
+- ``SMTPSink`` is a minimal SMTP server that accepts and keeps every message.
+
+Both deliver into a shared ``Mailbox``, which is where virtual users read their
+2FA codes. ``run`` drives concurrent virtual users through scripted journeys
+(register, login, verify_2fa, generate_key, encrypt/decrypt data and files)
+against a running server and returns per-endpoint ``Stats``.
+
+Used by ``python manage.py loadtest``; the server is pointed at the stand-ins
+through the environment (see ``server_environment``).
+"""
+from __future__ import annotations
+
+import email
+import json
+import math
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .ciphers import CIPHER_CHOICES
+
+CODE = re.compile(r"\b(\d{6})\b")
+
+
+class Mailbox:
+    """Latest message text per recipient, shared by the stand-ins."""
+
+    def __init__(self):
+        self._messages: Dict[str, str] = {}
+        self._arrived = threading.Condition()
+        self.delivered = 0
+
+    def deliver(self, recipients, text: str) -> None:
+        with self._arrived:
+            for rcpt in recipients:
+                self._messages[rcpt.lower()] = text
+            self.delivered += 1
+            self._arrived.notify_all()
+
+    def wait_for_code(self, recipient: str, timeout: float = 30.0) -> Optional[str]:
+        """Pop the newest code sent to ``recipient``, waiting up to ``timeout`` seconds."""
+        deadline = time.monotonic() + timeout
+        recipient = recipient.lower()
+        with self._arrived:
+            while True:
+                match = CODE.search(self._messages.pop(recipient, ""))
+                if match:
+                    return match.group(1)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._arrived.wait(remaining)
+
+
+# -- provider stand-ins -------------------------------------------------------
+
+
+class ProviderStub(ThreadingHTTPServer):
+    """Resend/Brevo look-alike: sleeps ``latency`` (+- ``jitter``) seconds, fails ``error_rate`` of calls."""
+
+    daemon_threads = True
+
+    def __init__(self, mailbox: Mailbox, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 address: Tuple[str, int] = ("127.0.0.1", 0)):
+        super().__init__(address, _ProviderHandler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+
+class _ProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: Dict) -> None:
+        raw = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_POST(self):
+        stub: ProviderStub = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if self.path.rstrip("/") == "/emails":
+            provider = "resend"
+            authorized = self.headers.get("Authorization", "").startswith("Bearer ")
+            recipients = payload.get("to") or []
+            text = payload.get("text") or payload.get("html") or ""
+        elif self.path.rstrip("/") == "/v3/smtp/email":
+            provider = "brevo"
+            authorized = bool(self.headers.get("api-key"))
+            recipients = [to.get("email", "") for to in payload.get("to") or []]
+            text = payload.get("textContent") or payload.get("htmlContent") or ""
+        else:
+            return self._reply(404, {"message": "Not found"})
+
+        time.sleep(max(0.0, stub.latency + random.uniform(-stub.jitter, stub.jitter)))
+        if not authorized:
+            stub.count(f"{provider}:401")
+            return self._reply(401, {"message": "Missing API key"})
+        if random.random() < stub.error_rate:
+            stub.count(f"{provider}:500")
+            return self._reply(500, {"message": "Injected failure"})
+        stub.count(f"{provider}:ok")
+        stub.mailbox.deliver(recipients, text)
+        if provider == "resend":
+            return self._reply(200, {"id": str(uuid.uuid4())})
+        return self._reply(201, {"messageId": f"<{uuid.uuid4()}@stub>"})
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Accepts any SMTP conversation (no TLS or AUTH) and delivers messages to the mailbox."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: Mailbox, latency: float = 0.0, address: Tuple[str, int] = ("127.0.0.1", 0)):
+        super().__init__(address, _SMTPHandler)
+        self.mailbox = mailbox
+        self.latency = latency
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _send(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sink: SMTPSink = self.server
+        self._send("220 loadtest SMTP sink")
+        recipients: List[str] = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self._send("250 loadtest")
+            elif verb == "MAIL":
+                recipients = []
+                self._send("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[-1].strip().strip("<>"))
+                self._send("250 OK")
+            elif verb == "DATA":
+                self._send("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b".\r\n", b".\n"):
+                        break
+                    lines.append(data[1:] if data.startswith(b"..") else data)
+                time.sleep(sink.latency)
+                message = email.message_from_bytes(b"".join(lines))
+                parts = message.walk() if message.is_multipart() else [message]
+                text = "\n".join(
+                    part.get_payload(decode=True).decode("utf-8", "replace")
+                    for part in parts if part.get_content_type() == "text/plain"
+                )
+                sink.mailbox.deliver(recipients, text)
+                self._send("250 OK queued")
+            elif verb == "QUIT":
+                self._send("221 Bye")
+                return
+            elif verb in ("RSET", "NOOP"):
+                recipients = [] if verb == "RSET" else recipients
+                self._send("250 OK")
+            else:
+                self._send("502 Command not implemented")
+
+
+def serve_in_background(server) -> threading.Thread:
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def server_environment(provider: str, stub: ProviderStub, sink: SMTPSink) -> Dict[str, str]:
+    """Environment that routes the app's email through the stand-ins.
+
+    ``provider`` picks which delivery path is exercised: only that one is given
+    credentials, so ``_send_verification_email`` skips the others.
+    """
+    env = {
+        "RESEND_API_KEY": "", "BREVO_API_KEY": "",
+        "RESEND_API_URL": stub.url, "BREVO_API_URL": stub.url,
+        "EMAIL_SERVICE": "loadtest",
+        "EMAIL_BACKEND": "django.core.mail.backends.smtp.EmailBackend",
+        "EMAIL_HOST": "127.0.0.1", "EMAIL_PORT": str(sink.port), "EMAIL_USE_TLS": "false",
+        "EMAIL_HOST_USER": "", "EMAIL_HOST_PASSWORD": "",
+        # Every virtual user logs in from 127.0.0.1; per-IP limits would throttle the run
+        "RATELIMIT_ENABLED": "false",
+    }
+    if provider == "resend":
+        env["RESEND_API_KEY"] = "re_loadtest"
+    elif provider == "brevo":
+        env["BREVO_API_KEY"] = "xkeysib-loadtest"
+    return env
+
+
+# -- journeys -------------------------------------------------------------------
+
+
+@dataclass
+class Stats:
+    """Latencies (seconds) and failures per endpoint."""
+
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    journeys: int = 0
+    failed_journeys: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def finish_journey(self, ok: bool) -> None:
+        with self._lock:
+            self.journeys += 1
+            self.failed_journeys += not ok
+
+    def summary(self, elapsed: float) -> List[Dict]:
+        rows = []
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            rows.append({
+                "endpoint": endpoint,
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "rps": len(values) / elapsed if elapsed else 0.0,
+                **{f"p{p}": percentile(values, p) for p in (50, 90, 95, 99)},
+                "max": values[-1],
+            })
+        return rows
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class JourneyFailed(Exception):
+    pass
+
+
+class VirtualUser:
+    """One browser session walking the app's pages like a person would."""
+
+    def __init__(self, base_url: str, mailbox: Mailbox, stats: Stats, file_size: int = 64 * 1024,
+                 timeout: float = 30.0):
+        import requests
+
+        self.base = base_url.rstrip("/") + "/encryption"
+        self.mailbox = mailbox
+        self.stats = stats
+        self.file_size = file_size
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _request(self, endpoint: str, method: str, path: str, expect: Callable, **kwargs):
+        if method == "POST":
+            # Django rotates the token on login, so read it back every time
+            kwargs.setdefault("headers", {})["X-CSRFToken"] = self.session.cookies.get("csrftoken", "")
+            kwargs["headers"]["Referer"] = self.base + path
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base + path, timeout=self.timeout,
+                                            allow_redirects=False, **kwargs)
+            ok = expect(response)
+        except Exception:
+            response, ok = None, False
+        self.stats.record(endpoint, time.perf_counter() - start, ok)
+        if not ok:
+            status = response.status_code if response is not None else "no response"
+            raise JourneyFailed(f"{endpoint}: {status}")
+        return response
+
+    @staticmethod
+    def _ok(response):
+        return response.status_code == 200
+
+    @staticmethod
+    def _redirect_to(target):
+        return lambda response: response.status_code == 302 and response.headers.get("Location", "").endswith(target)
+
+    def run(self) -> None:
+        tag = uuid.uuid4().hex[:12]
+        username, password, mail = f"lt_{tag}", f"Pw-{uuid.uuid4().hex}!", f"lt_{tag}@loadtest.invalid"
+        key_name, data_name, file_name = f"k_{tag}", f"d_{tag}", f"f_{tag}.bin"
+
+        self._request("register_form", "GET", "/register/", self._ok)
+        self._request("register", "POST", "/register/", self._redirect_to("/dashboard/"), data={
+            "username": username, "email": mail, "password1": password, "password2": password})
+        self._request("logout", "GET", "/logout/", self._redirect_to("/login/"))
+
+        self._request("login_form", "GET", "/login/", self._ok)
+        self._request("login", "POST", "/login/", self._redirect_to("/verify-2fa/"),
+                      data={"username": username, "password": password})
+        code = self.mailbox.wait_for_code(mail, self.timeout)
+        if code is None:
+            self.stats.record("email_delivery", self.timeout, False)
+            raise JourneyFailed("no verification email arrived")
+        self._request("verify_2fa", "POST", "/verify-2fa/", self._redirect_to("/dashboard/"), data={"code": code})
+
+        self._request("dashboard", "GET", "/dashboard/", self._ok)
+        self._request("generate_key", "POST", "/generate-key/",
+                      lambda r: r.status_code == 200 and b"alert-success" in r.content,
+                      data={"key_name": key_name, "cipher": random.choice(CIPHER_CHOICES)[0]})
+        secret = f"value {tag} " * 8
+        self._request("encrypt_data", "POST", "/encrypt-data/", self._ok,
+                      data={"key_name": key_name, "data_name": data_name, "data_value": secret})
+        self._request("decrypt_data", "POST", "/decrypt-data/",
+                      lambda r: r.status_code == 200 and secret.strip().encode() in r.content,
+                      data={"key_name": key_name, "data_name": data_name})
+        self._request("encrypt_file", "POST", "/encrypt-file/",
+                      lambda r: r.status_code == 200 and b"successfully" in r.content,
+                      data={"key_name": key_name}, files={"file": (file_name, os.urandom(self.file_size))})
+        self._request("decrypt_file", "POST", "/decrypt-file/",
+                      lambda r: r.status_code == 200 and b"successfully" in r.content,
+                      data={"key_name": key_name, "file_name": file_name})
+        self._request("logout", "GET", "/logout/", self._redirect_to("/login/"))
+
+
+def run(base_url: str, mailbox: Mailbox, users: int = 10, journeys: int = 5, duration: Optional[float] = None,
+        file_size: int = 64 * 1024, timeout: float = 30.0, on_error: Callable[[str], None] = lambda message: None
+        ) -> Tuple[Stats, float]:
+    """Run ``users`` concurrent virtual users, each doing ``journeys`` journeys
+    (or as many as fit in ``duration`` seconds). Returns the stats and elapsed seconds."""
+    stats = Stats()
+    deadline = time.monotonic() + duration if duration else None
+
+    def worker():
+        done = 0
+        while (done < journeys) if deadline is None else (time.monotonic() < deadline):
+            try:
+                VirtualUser(base_url, mailbox, stats, file_size, timeout).run()
+                stats.finish_journey(True)
+            except JourneyFailed as exc:
+                stats.finish_journey(False)
+                on_error(str(exc))
+            done += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
@@ -0,0 +1,185 @@
+"""
+Cross-process locks for coordinating writes to shared records and blobs.
+
+Several app nodes (or worker processes) can act on the same file at once: two
+appends, an append and a delete, two decrypts writing the same output. The
+helpers here serialise them:
+
+- :func:`named_lock` takes a lock on an arbitrary name. On PostgreSQL it is a
+  transaction-scoped advisory lock and on MySQL a ``GET_LOCK`` lock, so every
+  node sharing the database is covered. Other backends (SQLite) fall back to an
+  ``flock`` on a file under ``LOCK_DIR``, which covers the processes of one host
+  (or of several hosts, if ``LOCK_DIR`` is on a shared disk that supports it).
+- :func:`locked_row` opens a transaction and fetches a row with
+  ``SELECT ... FOR UPDATE``. On backends that ignore row locks it also takes
+  the named lock for that row.
+
+Rows with a ``version`` column add optimistic checks on top: a client sends
+back the version it saw, and :func:`check_version` refuses the write (under the
+lock) if the row has moved on since.
+
+Named locks give up with :class:`LockTimeout` after ``LOCK_TIMEOUT`` seconds;
+row locks wait as long as the database lets them.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+
+class LockTimeout(Exception):
+    """The lock was not acquired within the timeout."""
+
+
+class VersionConflict(Exception):
+    """The row changed since the version a write was based on."""
+
+    def __init__(self, current: int):
+        super().__init__(f"Stale version; current version is {current}")
+        self.current = current
+
+
+def check_version(row, expected) -> None:
+    """Raise :class:`VersionConflict` unless ``expected`` is None or ``row.version``."""
+    if expected is not None and int(expected) != row.version:
+        raise VersionConflict(row.version)
+
+
+def lock_timeout() -> float:
+    return float(getattr(settings, "LOCK_TIMEOUT", 30))
+
+
+def lock_dir() -> str:
+    return getattr(settings, "LOCK_DIR", "") or os.path.join(tempfile.gettempdir(), "encryption-locks")
+
+
+def _digest(name: str) -> bytes:
+    return hashlib.sha256(name.encode()).digest()
+
+
+@contextmanager
+def _postgresql_lock(connection, name: str, timeout: float) -> Iterator[None]:
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            # Both the setting and the lock end with the transaction
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", [f"{int(timeout * 1000)}ms"])
+            try:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [int.from_bytes(_digest(name)[:8], "big", signed=True)])
+            except OperationalError as exc:
+                # lock_not_available; psycopg 3 calls the code sqlstate, psycopg2 pgcode
+                cause = exc.__cause__
+                if "55P03" in (getattr(cause, "sqlstate", None), getattr(cause, "pgcode", None)):
+                    raise LockTimeout(name) from exc
+                raise
+        yield
+
+
+@contextmanager
+def _mysql_lock(connection, name: str, timeout: float) -> Iterator[None]:
+    # MySQL lock names are limited to 64 characters
+    lock_name = _digest(name).hex()[:64]
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", [lock_name, timeout])
+        if cursor.fetchone()[0] != 1:
+            raise LockTimeout(name)
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", [lock_name])
+
+
+_local_locks: dict = {}
+_local_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _file_lock(name: str, timeout: float) -> Iterator[None]:
+    if fcntl is None:
+        # No flock: serialise the threads of this process at least
+        with _local_locks_guard:
+            lock = _local_locks.setdefault(name, threading.Lock())
+        if not lock.acquire(timeout=timeout):
+            raise LockTimeout(name)
+        try:
+            yield
+        finally:
+            lock.release()
+        return
+
+    directory = lock_dir()
+    os.makedirs(directory, exist_ok=True)
+    # Each open() is its own open file description, so threads exclude each other too
+    fd = os.open(os.path.join(directory, f"{_digest(name).hex()[:32]}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(name)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def named_lock(name: str, timeout: Optional[float] = None, using: str = "default") -> Iterator[None]:
+    """Hold an exclusive lock on ``name`` for the duration of the block.
+
+    On PostgreSQL the block runs inside a transaction (the lock is released when
+    it ends); elsewhere the block's transaction handling is left to the caller.
+    """
+    timeout = lock_timeout() if timeout is None else timeout
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        lock = _postgresql_lock(connection, name, timeout)
+    elif connection.vendor == "mysql":
+        lock = _mysql_lock(connection, name, timeout)
+    else:
+        lock = _file_lock(name, timeout)
+    with lock:
+        yield
+
+
+def row_lock_name(model, pk) -> str:
+    return f"{model._meta.label_lower}:{pk}"
+
+
+@contextmanager
+def locked_row(queryset, pk, timeout: Optional[float] = None) -> Iterator:
+    """Fetch ``queryset``'s row ``pk`` locked for update; yields None if it does not exist.
+
+    The lock is held, and the block runs in a transaction, until the block ends.
+    """
+    using = queryset.db
+    connection = connections[using]
+    if connection.features.has_select_for_update:
+        with transaction.atomic(using=using):
+            yield queryset.select_for_update().filter(pk=pk).first()
+    else:
+        # The named lock is taken before the transaction begins, so a waiting
+        # writer does not hold a database transaction open
+        with named_lock(row_lock_name(queryset.model, pk), timeout, using), transaction.atomic(using=using):
+            yield queryset.filter(pk=pk).first()
@@ -0,0 +1,301 @@
+import hashlib
+import os
+import random
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from encryption import ciphers, metrics, search
+from encryption.ciphers import CIPHER_CHOICES, Cipher, generate_key
+from encryption.models import EncryptedData, EncryptedPayload, EncryptionKey
+from encryption.ratelimit import CacheCounterStore, MemoryCounterStore, RateLimiter
+from encryption.storage import ShardedFileSystemStorage
+
+
+def _checkpoints(limit):
+    """1k, 10k, 100k, 1M ... capped at ``limit``."""
+    points, n = [], 1000
+    while n < limit:
+        points.append(n)
+        n *= 10
+    points.append(limit)
+    return points
+
+
+class Command(BaseCommand):
+    help = 'Run micro-benchmarks for the encryption subsystems (e.g. "benchmark storage --files 1000000")'
+
+    suites = ('storage', 'ciphers', 'derivation', 'ratelimit', 'search', 'listing', 'metrics')
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=self.suites, help='Benchmark suite to run')
+        parser.add_argument('--files', type=int, default=100_000,
+                            help='storage: largest directory population to measure (up to 1M)')
+        parser.add_argument('--samples', type=int, default=200,
+                            help='Operations timed at each checkpoint')
+        parser.add_argument('--size', type=int, default=None,
+                            help='Payload size in bytes (storage: 4 KiB, ciphers: 64 MiB, derivation: 1 KiB, listing: 16 KiB, '
+                                 'metrics: 1 KiB)')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='ciphers: repetitions per suite')
+        parser.add_argument('--ops', type=int, default=200_000,
+                            help='ratelimit: checks per store; metrics: updates and crypto round trips; '
+                                 'derivation: operations per row (divided by 10)')
+        parser.add_argument('--rows', type=int, default=None,
+                            help='search (100k), listing (10k): largest table size to measure '
+                                 '(runs in a throwaway test database)')
+
+    def handle(self, *args, **options):
+        handler = getattr(self, f"bench_{options['suite']}", None)
+        if handler is None:
+            raise CommandError(f"Unknown suite {options['suite']}")
+        handler(options)
+
+    def _row(self, *cols):
+        self.stdout.write("  ".join(f"{c:>14}" for c in cols))
+
+    # -- storage ------------------------------------------------------------
+
+    def bench_storage(self, options):
+        payload = os.urandom(options['size'] or 4096)
+        samples = options['samples']
+        self._row('backend', 'population', 'save us/op', 'open us/op', 'exists us/op')
+
+        for label, storage_cls in (('flat', FileSystemStorage), ('sharded', ShardedFileSystemStorage)):
+            with tempfile.TemporaryDirectory() as root:
+                storage = storage_cls(location=root)
+                population = 0
+                for checkpoint in _checkpoints(options['files']):
+                    # Grow the tree cheaply without timing it
+                    while population < checkpoint - samples:
+                        storage.save(storage.generate_filename(f"encrypted_files/f{population}"), ContentFile(payload))
+                        population += 1
+
+                    names = []
+                    start = time.perf_counter()
+                    for _ in range(samples):
+                        names.append(storage.save(storage.generate_filename(f"encrypted_files/f{population}"), ContentFile(payload)))
+                        population += 1
+                    save_us = (time.perf_counter() - start) / samples * 1e6
+
+                    start = time.perf_counter()
+                    for name in names:
+                        with storage.open(name, 'rb') as f:
+                            f.read()
+                    open_us = (time.perf_counter() - start) / samples * 1e6
+
+                    start = time.perf_counter()
+                    for name in names:
+                        storage.exists(name)
+                    exists_us = (time.perf_counter() - start) / samples * 1e6
+
+                    self._row(label, population, f"{save_us:.1f}", f"{open_us:.1f}", f"{exists_us:.1f}")
+
+    # -- ciphers ------------------------------------------------------------
+
+    def bench_ciphers(self, options):
+        size = options['size'] or 64 * 1024 * 1024
+        payload = os.urandom(size)
+        rounds = options['rounds']
+        self._row('suite', 'MiB', 'enc GB/s', 'dec GB/s', 'overhead %')
+
+        for suite, _label in CIPHER_CHOICES:
+            cipher = Cipher(generate_key(suite), suite)
+            token = cipher.encrypt(payload)
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                token = cipher.encrypt(payload)
+            enc = size * rounds / (time.perf_counter() - start) / 1e9
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                cipher.decrypt(token)
+            dec = size * rounds / (time.perf_counter() - start) / 1e9
+
+            overhead = (len(token) - size) / size * 100
+            self._row(suite, size // (1024 * 1024), f"{enc:.2f}", f"{dec:.2f}", f"{overhead:.2f}")
+
+    # -- derivation ---------------------------------------------------------
+
+    def bench_derivation(self, options):
+        """Single key vs. per-record subkeys, for new records and for reads of existing ones."""
+        payload = 'x' * (options['size'] or 1024)
+        n = max(options['ops'] // 10, 1000)
+        # More records than the subkey cache holds, so the "cold" reads always derive
+        records = ciphers.subkeys.max_entries * 2
+        self._row('suite', 'path', 'ops/s', 'us/op', 'vs single')
+
+        for suite, _label in CIPHER_CHOICES:
+            master = Cipher(generate_key(suite), suite)
+            plain_token = master.encrypt_text(payload)
+            warm = [master.for_new_record().encrypt_text(payload) for _ in range(64)]
+            cold = [master.for_new_record().encrypt_text(payload) for _ in range(records)]
+
+            paths = [
+                ('encrypt single', lambda i: master.encrypt_text(payload)),
+                ('encrypt record', lambda i: master.for_new_record().encrypt_text(payload)),
+                ('decrypt single', lambda i: master.decrypt_text(plain_token)),
+                ('decrypt cached', lambda i: master.decrypt_text(warm[i % len(warm)])),
+                ('decrypt cold', lambda i: master.decrypt_text(cold[i % len(cold)])),
+            ]
+            baseline = {}
+            for label, op in paths:
+                ciphers.subkeys.clear()
+                for i in range(len(warm)):
+                    master.decrypt_text(warm[i])
+                start = time.perf_counter()
+                for i in range(n):
+                    op(i)
+                per_op = (time.perf_counter() - start) / n
+                kind = label.split()[0]
+                baseline.setdefault(kind, per_op)
+                self._row(suite, label, f"{1 / per_op:,.0f}", f"{per_op * 1e6:.2f}",
+                          f"{baseline[kind] / per_op:.2f}x")
+        ciphers.subkeys.clear()
+
+    # -- ratelimit ----------------------------------------------------------
+
+    def bench_ratelimit(self, options):
+        ops = options['ops']
+        identities = [f"ip:10.0.{i // 256}.{i % 256}" for i in range(10_000)]
+        self._row('store', 'ops', 'ns/check', 'checks/s')
+
+        for label, store in (('memory', MemoryCounterStore()), ('cache', CacheCounterStore())):
+            limiter = RateLimiter(limit=100, window=60, store=store)
+            start = time.perf_counter()
+            for i in range(ops):
+                limiter.hit(identities[i % len(identities)])
+            elapsed = time.perf_counter() - start
+            self._row(label, ops, f"{elapsed / ops * 1e9:.0f}", f"{ops / elapsed:,.0f}")
+
+    # -- search -------------------------------------------------------------
+
+    @staticmethod
+    def _bench_name(i):
+        return f"{hashlib.sha1(str(i).encode()).hexdigest()[:12]}.txt"
+
+    def bench_search(self, options):
+        samples = options['samples']
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = User.objects.create(username='bench')
+            key = EncryptionKey.objects.create(key_name='bench', key_value=generate_key(), user=user)
+            self._row('rows', 'exact ms', 'prefix ms', 'icontains ms')
+            population = 0
+            for checkpoint in _checkpoints(options['rows'] or 100_000):
+                while population < checkpoint:
+                    count = min(5000, checkpoint - population)
+                    records = EncryptedData.objects.bulk_create([
+                        EncryptedData(data_name=self._bench_name(population + i), encrypted_size=1, key=key, user=user)
+                        for i in range(count)
+                    ])
+                    search.index_records(records)
+                    population += count
+
+                names = [self._bench_name(random.randrange(population)) for _ in range(samples)]
+                timings = []
+                for run in (
+                    lambda n: search.search(n, 'data', search.MODE_EXACT, user=user),
+                    lambda n: search.search(n[:6], 'data', search.MODE_PREFIX, user=user, limit=20),
+                    lambda n: list(EncryptedData.objects.filter(user=user, data_name__icontains=n)[:20]),
+                ):
+                    start = time.perf_counter()
+                    for name in names:
+                        run(name)
+                    timings.append((time.perf_counter() - start) / samples * 1e3)
+                self._row(population, *(f"{t:.3f}" for t in timings))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    # -- listing ------------------------------------------------------------
+
+    def bench_listing(self, options):
+        samples = options['samples']
+        value = 'x' * (options['size'] or 16 * 1024)
+        page = 50
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = User.objects.create(username='bench')
+            key = EncryptionKey.objects.create(key_name='bench', key_value=generate_key(), user=user)
+            self._row('rows', 'full ms/page', 'projected ms', 'full KiB/page', 'projected KiB')
+            population = 0
+            for checkpoint in _checkpoints(options['rows'] or 10_000):
+                while population < checkpoint:
+                    count = min(1000, checkpoint - population)
+                    records = EncryptedData.objects.bulk_create([
+                        EncryptedData(data_name=self._bench_name(population + i), encrypted_size=len(value),
+                                      key=key, user=user)
+                        for i in range(count)
+                    ])
+                    EncryptedPayload.objects.bulk_create([EncryptedPayload(record=r, value=value) for r in records])
+                    population += count
+
+                # "full" loads the rows with their key and ciphertext, as list pages did
+                # while the ciphertext lived on the row; "projected" is what the
+                # dashboard and admin panel partials select now
+                base = EncryptedData.objects.filter(user=user).order_by('id')
+                cases = (
+                    (base.select_related('key', 'payload'), ('data_name', 'key__key_value', 'payload__value')),
+                    (base.select_related('key').only('data_name', 'encrypted_size', 'key__key_name'),
+                     ('data_name', 'encrypted_size', 'key__key_name')),
+                )
+                timings, sizes = [], []
+                for queryset, columns in cases:
+                    offsets = [random.randrange(max(population - page, 1)) for _ in range(samples)]
+                    start = time.perf_counter()
+                    for offset in offsets:
+                        list(queryset[offset:offset + page])
+                    timings.append((time.perf_counter() - start) / samples * 1e3)
+                    # Rough payload of the widest columns fetched per page
+                    page_values = base[:page].values_list(*columns)
+                    sizes.append(sum(len(str(v)) for row in page_values for v in row) / 1024)
+                self._row(population, *(f"{t:.3f}" for t in timings), *(f"{kib:.1f}" for kib in sizes))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    # -- metrics ------------------------------------------------------------
+
+    def bench_metrics(self, options):
+        ops = options['ops']
+        registry = metrics.registry
+        counter = registry.counter('bench_counter_total', 'benchmark', ('op',)).labels('x')
+        histogram = registry.histogram('bench_seconds', 'benchmark').labels()
+
+        summary = registry.summary('bench_bytes', 'benchmark').labels()
+
+        self._row('update', 'ops', 'ns/op')
+        for label, update in (('counter.inc', counter.inc), ('summary.observe', lambda: summary.observe(1024)),
+                              ('hist.observe', lambda: histogram.observe(0.003))):
+            start = time.perf_counter()
+            for _ in range(ops):
+                update()
+            self._row(label, ops, f"{(time.perf_counter() - start) / ops * 1e9:.0f}")
+
+        # End to end: the instrumented crypto path with metrics on vs. off.
+        # Rounds alternate and the best of each is kept to cancel out noise.
+        payload = 'x' * (options['size'] or 1024)
+        cipher = Cipher(generate_key(ciphers.AES_256_GCM), ciphers.AES_256_GCM)
+        n = max(ops // 20, 1000)
+        best = {True: float('inf'), False: float('inf')}
+        enabled = registry.enabled
+        try:
+            for _ in range(options['rounds']):
+                for state in (False, True):
+                    registry.enabled = state
+                    start = time.perf_counter()
+                    for _ in range(n):
+                        cipher.decrypt_text(cipher.encrypt_text(payload))
+                    best[state] = min(best[state], time.perf_counter() - start)
+        finally:
+            registry.enabled = enabled
+        self.stdout.write('')
+        self._row('round trip', 'bytes', 'off us/op', 'on us/op', 'overhead %')
+        overhead = (best[True] - best[False]) / best[False] * 100
+        self._row(ciphers.AES_256_GCM, len(payload), f"{best[False] / n * 1e6:.2f}", f"{best[True] / n * 1e6:.2f}",
+                  f"{overhead:.2f}")
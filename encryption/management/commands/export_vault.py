@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from encryption.vault import VaultError, export_vault
+
+
+class Command(BaseCommand):
+    help = ('Stream keys, encrypted data and encrypted file blobs into a single archive '
+            '(contains key material: store it like a database backup)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Archive path ("-" for stdout); a .gz suffix enables gzip')
+        parser.add_argument('--user', action='append', dest='users', default=[],
+                            help='Only export records of this username (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per archive member')
+        parser.add_argument('--workers', type=int, default=4, help='Parallel blob reads')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        log = (lambda message: self.stderr.write(message)) if options['verbosity'] > 1 else (lambda message: None)
+        start = time.perf_counter()
+        try:
+            if output == '-':
+                manifest = self._export(sys.stdout.buffer, False, options, log)
+            else:
+                # Created owner-only: the archive holds key values
+                fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'wb') as fileobj:
+                    manifest = self._export(fileobj, output.endswith('.gz'), options, log)
+        except VaultError as exc:
+            raise CommandError(str(exc))
+        elapsed = time.perf_counter() - start
+
+        counts = manifest['counts']
+        summary = (f"Exported {counts['keys']} keys, {counts['data']} data records and {counts['files']} files "
+                   f"({counts['blob_bytes'] / 1e6:.1f} MB of blobs) in {elapsed:.1f}s")
+        # Keep stdout clean when the archive itself goes there
+        out = self.stderr if output == '-' else self.stdout
+        out.write(self.style.SUCCESS(summary))
+        if manifest['missing_blobs']:
+            out.write(self.style.WARNING(f"{manifest['missing_blobs']} files were skipped: blob missing or unreadable"))
+
+    def _export(self, fileobj, compress, options, log):
+        return export_vault(fileobj, users=options['users'], chunk_size=options['chunk_size'],
+                            workers=options['workers'], compress=compress, log=log)
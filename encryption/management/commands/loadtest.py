@@ -0,0 +1,145 @@
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from django.core.management.base import BaseCommand, CommandError
+
+from encryption import loadtest
+
+SERVERS = {
+    'gunicorn': lambda bind, workers: [
+        sys.executable, '-m', 'gunicorn', 'data_security_system.wsgi:application',
+        '--bind', bind, '--workers', str(workers), '--log-level', 'warning',
+    ],
+    'uvicorn': lambda bind, workers: [
+        sys.executable, '-m', 'uvicorn', 'data_security_system.asgi:application',
+        '--host', bind.split(':')[0], '--port', bind.split(':')[1], '--workers', str(workers), '--log-level', 'warning',
+    ],
+    # Single process, threaded; a quick baseline when gunicorn/uvicorn are not installed
+    'runserver': lambda bind, workers: [sys.executable, 'manage.py', 'runserver', bind, '--noreload'],
+}
+
+
+class Command(BaseCommand):
+    help = ('Drive concurrent user journeys (register, login + 2FA, keys, data and file encryption) against a '
+            'server whose email providers are replaced by local stand-ins; report RPS and latency per endpoint')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=(*SERVERS, 'none'), default='gunicorn',
+                            help='Start this server on a throwaway database and media directory; "none" targets --url '
+                                 'as is (start it with the environment printed by --print-env)')
+        parser.add_argument('--url', default='http://127.0.0.1:8765', help='Server base URL')
+        parser.add_argument('--server-workers', type=int, default=4, help='Worker processes for the started server')
+        parser.add_argument('--users', type=int, default=10, help='Concurrent virtual users')
+        parser.add_argument('--journeys', type=int, default=5, help='Journeys per virtual user')
+        parser.add_argument('--duration', type=float, default=None,
+                            help='Run for this many seconds instead of a fixed number of journeys')
+        parser.add_argument('--provider', choices=('resend', 'brevo', 'smtp'), default='resend',
+                            help='Email delivery path to exercise')
+        parser.add_argument('--latency', type=float, default=50, help='Provider stub latency in ms')
+        parser.add_argument('--jitter', type=float, default=0, help='Provider stub latency jitter (+- ms)')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of provider calls answered with a 500 (the app then falls back)')
+        parser.add_argument('--file-size', type=int, default=64 * 1024, help='Bytes per uploaded file')
+        parser.add_argument('--print-env', action='store_true',
+                            help='Print the server environment for the stand-ins and keep them running')
+
+    def handle(self, *args, **options):
+        mailbox = loadtest.Mailbox()
+        stub = loadtest.ProviderStub(mailbox, options['latency'] / 1000, options['jitter'] / 1000, options['error_rate'])
+        sink = loadtest.SMTPSink(mailbox, options['latency'] / 1000)
+        loadtest.serve_in_background(stub)
+        loadtest.serve_in_background(sink)
+        env = loadtest.server_environment(options['provider'], stub, sink)
+        if options['provider'] == 'resend' and importlib.util.find_spec('resend') is None:
+            self.stderr.write(self.style.WARNING(
+                'The resend SDK is not installed, so the app skips Resend and falls back to SMTP (the sink).'
+            ))
+
+        if options['print_env']:
+            for name, value in env.items():
+                self.stdout.write(f'export {name}={value}')
+            self.stdout.write('Stand-ins running; press Ctrl+C to stop.')
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                return
+
+        workdir = process = None
+        try:
+            if options['server'] != 'none':
+                workdir = tempfile.mkdtemp(prefix='loadtest-')
+                process = self._start_server(options, env, workdir)
+            self._wait_until_up(options['url'], process)
+
+            self.stdout.write(
+                f"{options['users']} users x "
+                f"{str(options['duration']) + 's' if options['duration'] else options['journeys']} journeys "
+                f"against {options['url']} ({options['server']}), email via {options['provider']} stub"
+            )
+            errors = []
+            stats, elapsed = loadtest.run(
+                options['url'], mailbox, users=options['users'], journeys=options['journeys'],
+                duration=options['duration'], file_size=options['file_size'], on_error=errors.append,
+            )
+        finally:
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+            stub.shutdown()
+            sink.shutdown()
+
+        self._report(stats, elapsed, stub, errors)
+
+    def _start_server(self, options, env, workdir):
+        # A fresh database and media root so load-test users and blobs never mix with real ones
+        server_env = dict(os.environ, **env, SQLITE_PATH=os.path.join(workdir, 'db.sqlite3'),
+                          MEDIA_ROOT=os.path.join(workdir, 'media'))
+        server_env.setdefault('DJANGO_SETTINGS_MODULE', 'data_security_system.settings')
+        migrate = subprocess.run([sys.executable, 'manage.py', 'migrate', '--noinput', '-v', '0'],
+                                 env=server_env, capture_output=True, text=True)
+        if migrate.returncode != 0:
+            raise CommandError(f'Migrating the load-test database failed:\n{migrate.stderr[-2000:]}')
+        bind = options['url'].split('://', 1)[-1].rstrip('/')
+        command = SERVERS[options['server']](bind, options['server_workers'])
+        return subprocess.Popen(command, env=server_env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def _wait_until_up(self, url, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise CommandError(f'Server exited:\n{process.stderr.read().decode(errors="replace")[-2000:]}')
+            try:
+                urllib.request.urlopen(f"{url.rstrip('/')}/encryption/login/", timeout=2)
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'Server at {url} did not come up within {timeout}s')
+
+    def _report(self, stats, elapsed, stub, errors):
+        self.stdout.write(
+            f'\n{stats.journeys} journeys ({stats.failed_journeys} failed) in {elapsed:.1f}s: '
+            f'{stats.journeys / elapsed:.2f} journeys/s'
+        )
+        self.stdout.write(f"{'endpoint':<16}{'reqs':>7}{'errors':>7}{'rps':>9}"
+                          f"{'p50 ms':>9}{'p90 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for row in stats.summary(elapsed):
+            self.stdout.write(
+                f"{row['endpoint']:<16}{row['requests']:>7}{row['errors']:>7}{row['rps']:>9.1f}"
+                + ''.join(f"{row[p] * 1000:>9.1f}" for p in ('p50', 'p90', 'p95', 'p99', 'max'))
+            )
+        if stub.calls:
+            self.stdout.write('Provider stub calls: ' + ', '.join(f'{k}={v}' for k, v in sorted(stub.calls.items())))
+        for message in sorted(set(errors))[:10]:
+            self.stderr.write(self.style.ERROR(f'{errors.count(message)} x {message}'))
@@ -0,0 +1,67 @@
+import os
+import re
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# What a worker does before serving its first request: configure settings,
+# populate the app registry (models, admin, signals) and load the URLconf.
+STARTUP_SCRIPT = (
+    'import django; django.setup(); '
+    'from django.urls import get_resolver; get_resolver().url_patterns'
+)
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S.*)$')
+
+
+class Command(BaseCommand):
+    help = 'Profile worker startup with "python -X importtime" and list the slowest imports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=25, help='Number of modules to list')
+        parser.add_argument('--sort', choices=('self', 'cumulative'), default='cumulative')
+        parser.add_argument('--filter', default='', help='Only list modules whose name starts with this prefix')
+        parser.add_argument('--runs', type=int, default=1,
+                            help='Repeat the measurement and report the fastest run per module')
+
+    def _measure(self):
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'data_security_system.settings')
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+            capture_output=True, text=True, env=env, cwd=os.getcwd(),
+        )
+        if proc.returncode != 0:
+            raise CommandError(f'Startup failed:\n{proc.stderr[-2000:]}')
+        modules = {}
+        for line in proc.stderr.splitlines():
+            match = IMPORT_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, name = match.groups()
+                modules[name.strip()] = (int(self_us), int(cumulative_us), len(indent) // 2)
+        return modules
+
+    def handle(self, *args, **options):
+        runs = max(1, options['runs'])
+        best = {}
+        for _ in range(runs):
+            for name, (self_us, cumulative_us, depth) in self._measure().items():
+                previous = best.get(name)
+                if previous is None or cumulative_us < previous[1]:
+                    best[name] = (self_us, cumulative_us, depth)
+
+        # Top-level imports (depth 0) add up to the total import time
+        total_us = sum(cumulative for _, cumulative, depth in best.values() if depth == 0)
+        self.stdout.write(f'Modules imported: {len(best)}')
+        self.stdout.write(f'Total import time: {total_us / 1000:.1f} ms')
+
+        column = 0 if options['sort'] == 'self' else 1
+        rows = sorted(
+            ((name, data) for name, data in best.items() if name.startswith(options['filter'])),
+            key=lambda item: item[1][column], reverse=True,
+        )[:options['top']]
+        self.stdout.write('')
+        self.stdout.write(f'{"self ms":>9} {"cumul ms":>9}  module')
+        for name, (self_us, cumulative_us, _) in rows:
+            self.stdout.write(f'{self_us / 1000:9.2f} {cumulative_us / 1000:9.2f}  {name}')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from encryption import search
+from encryption.models import EncryptedData, EncryptedFile
+
+
+class Command(BaseCommand):
+    help = 'Rebuild blind-index name entries for all encrypted data and files (e.g. after changing BLIND_INDEX_KEY)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model, name_field in ((EncryptedData, 'data_name'), (EncryptedFile, 'file_name')):
+            total, batch = 0, []
+            for obj in model.objects.only('id', 'user_id', name_field).iterator(chunk_size=batch_size):
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    search.index_records(batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                search.index_records(batch)
+                total += len(batch)
+            self.stdout.write(self.style.SUCCESS(f'{model.__name__}: indexed {total} records'))
+        self.stdout.write('Content tokens are only indexed at encryption time and are not rebuilt.')
@@ -0,0 +1,42 @@
+import os
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from encryption.integrity import KINDS, sweep
+
+
+class Command(BaseCommand):
+    help = 'Check that stored data tokens and file blobs still authenticate under their keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=KINDS, action='append', dest='kinds',
+                            help='Only check this kind (repeatable; default: all)')
+        parser.add_argument('--max-age', type=float, default=168,
+                            help='Skip records verified within this many hours (default: 168)')
+        parser.add_argument('--all', action='store_true', help='Re-check every record regardless of --max-age')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Checker processes (0 checks in this process)')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Records per work unit')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many records per kind')
+
+    def handle(self, *args, **options):
+        def report_failure(kind, pk, error):
+            self.stderr.write(self.style.ERROR(f'{kind} {pk}: {error}'))
+
+        report = sweep(
+            kinds=options['kinds'] or KINDS,
+            max_age=None if options['all'] else timedelta(hours=options['max_age']),
+            workers=options['workers'],
+            chunk_size=options['chunk_size'],
+            limit=options['limit'],
+            on_failure=report_failure,
+        )
+        elapsed = max(report['elapsed'], 1e-9)
+        self.stdout.write(
+            f"Checked {report['checked']} records ({report['bytes'] / 1e6:.1f} MB) in {report['elapsed']:.1f}s: "
+            f"{report['checked'] / elapsed:.0f} records/s, {report['bytes'] / 1e6 / elapsed:.1f} MB/s"
+        )
+        if report['failed']:
+            raise CommandError(f"{report['failed']} records failed verification")
+        self.stdout.write(self.style.SUCCESS('All checked records verified'))
@@ -0,0 +1,458 @@
+"""
+In-process metrics (counters, gauges, summaries, histograms) with Prometheus
+text export.
+
+Updates are lock-free: every labelled child keeps one small list ("cell") per
+thread, reached through a ``threading.local``, and only that thread ever writes
+to it. Cells are summed when metrics are collected, so an update costs an
+attribute lookup and an in-place add. When a thread exits, its cell is folded
+into the child's base cell, so the number of cells follows the number of live
+threads.
+
+With several worker processes (gunicorn), set ``METRICS_MULTIPROC_DIR`` to a
+directory shared by the workers of one host. Each process then writes a snapshot
+of its metrics there every ``METRICS_FLUSH_INTERVAL`` seconds (and at exit), and
+the ``/metrics`` endpoint merges all snapshots: counters, summaries and
+histograms are summed over every process that ever ran, gauges over live
+processes only. Clear the directory when the server (not a single worker)
+restarts.
+"""
+from __future__ import annotations
+
+import atexit
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+COUNTER = "counter"
+GAUGE = "gauge"
+SUMMARY = "summary"
+HISTOGRAM = "histogram"
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (metric name, label values) -> values; see Metric.width for the layout
+Values = Dict[Tuple[str, Tuple[str, ...]], List[float]]
+
+
+class _CellOwner:
+    """Lives in one thread's local storage; collected when that thread exits."""
+
+    __slots__ = ("__weakref__",)
+
+
+class _ThreadCell(threading.local):
+    # threading.local re-runs __init__ (with the same arguments) in every thread
+    def __init__(self, child):
+        self.cell = child._new_cell()
+        # Fold the cell into the child's base cell once the thread is gone, so
+        # short-lived threads (request threads, executor pools) don't pile up cells
+        self.owner = _CellOwner()
+        weakref.finalize(self.owner, child._retire_cell, self.cell)
+
+
+class _Child:
+    __slots__ = ("_metric", "_registry", "labels", "_cells", "_local")
+
+    def __init__(self, metric, labels: Tuple[str, ...]):
+        self._metric = metric
+        self._registry = metric.registry
+        self.labels = labels
+        self._reset()
+
+    def _reset(self) -> None:
+        # _cells[0] is the base cell holding the counts of exited threads
+        self._cells: List[list] = [[0] * self._metric.width]
+        self._local = _ThreadCell(self)
+
+    def _new_cell(self) -> list:
+        cell = [0] * self._metric.width
+        with self._registry.lock:
+            self._cells.append(cell)
+        self._registry.start_flusher()
+        return cell
+
+    def _retire_cell(self, cell: list) -> None:
+        with self._registry.lock:
+            for i in range(1, len(self._cells)):
+                if self._cells[i] is cell:
+                    del self._cells[i]
+                    break
+            else:
+                # Dropped by reset() or a fork since; its counts went with it
+                return
+            base = self._cells[0]
+            for i, v in enumerate(cell):
+                base[i] += v
+
+    def value(self) -> List[float]:
+        total = [0] * self._metric.width
+        # Summed under the lock so a cell being folded into the base is counted once
+        with self._registry.lock:
+            for cell in self._cells:
+                for i, v in enumerate(cell):
+                    total[i] += v
+        return total
+
+
+class _CounterChild(_Child):
+    __slots__ = ()
+
+    def inc(self, amount: float = 1) -> None:
+        if self._registry.enabled:
+            self._local.cell[0] += amount
+
+
+class _GaugeChild(_Child):
+    """Gauges hold one value per process, not per thread."""
+
+    __slots__ = ()
+
+    def _reset(self) -> None:
+        self._cells = [[0]]
+
+    def set(self, value: float) -> None:
+        self._cells[0][0] = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._registry.lock:
+            self._cells[0][0] += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class _Timer:
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _SummaryChild(_Child):
+    __slots__ = ()
+
+    def observe(self, value: float) -> None:
+        if self._registry.enabled:
+            cell = self._local.cell
+            cell[0] += 1
+            cell[1] += value
+
+    def time(self) -> _Timer:
+        """Context manager observing the elapsed seconds of its block."""
+        return _Timer(self)
+
+
+class _HistogramChild(_SummaryChild):
+    __slots__ = ()
+
+    def observe(self, value: float) -> None:
+        if self._registry.enabled:
+            cell = self._local.cell
+            cell[bisect.bisect_left(self._metric.buckets, value)] += 1
+            cell[-1] += value
+
+
+class Metric:
+    child_class = _Child
+    width = 1
+
+    def __init__(self, registry, kind: str, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.children: Dict[Tuple[str, ...], _Child] = {}
+        self.function: Optional[Callable[[], float]] = None
+
+    def labels(self, *values, **kwargs) -> _Child:
+        """Child for one label combination. Keep it around on hot paths."""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self.registry.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self.child_class(self, values)
+        return child
+
+    # Unlabelled metrics act as their own single child
+    def __getattr__(self, attr):
+        if attr in ("inc", "dec", "set", "observe", "time") and not self.labelnames:
+            return getattr(self.labels(), attr)
+        raise AttributeError(attr)
+
+
+class Counter(Metric):
+    child_class = _CounterChild
+
+
+class Gauge(Metric):
+    child_class = _GaugeChild
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the (unlabelled) value from ``function`` at collection time."""
+        self.function = function
+
+
+class Summary(Metric):
+    """Count and sum of observations (no quantiles)."""
+
+    child_class = _SummaryChild
+    width = 2
+
+
+class Histogram(Metric):
+    child_class = _HistogramChild
+
+    @property
+    def width(self) -> int:
+        # One count per bucket, the +Inf bucket, then the sum
+        return len(self.buckets) + 2
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.RLock()
+        self.enabled = True
+        self._flusher: Optional[threading.Thread] = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # -- definition ------------------------------------------------------------
+
+    def _register(self, cls, kind, name, documentation, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(self, kind, name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, COUNTER, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, GAUGE, name, documentation, labelnames)
+
+    def summary(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Summary:
+        return self._register(Summary, SUMMARY, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, HISTOGRAM, name, documentation, labelnames, buckets=buckets)
+
+    def _children(self) -> List[_Child]:
+        with self.lock:
+            return [child for metric in self.metrics.values() for child in metric.children.values()]
+
+    def reset(self) -> None:
+        """Zero every value in this process (tests and benchmarks)."""
+        for child in self._children():
+            child._reset()
+
+    def _after_fork(self) -> None:
+        # A forked worker starts from zero; the parent keeps reporting its own counts
+        self.lock = threading.RLock()
+        self._flusher = None
+        for metric in self.metrics.values():
+            for child in metric.children.values():
+                child._reset()
+
+    # -- collection ------------------------------------------------------------
+
+    def snapshot(self) -> Values:
+        """This process's values."""
+        values = {(child._metric.name, child.labels): child.value() for child in self._children()}
+        for metric in list(self.metrics.values()):
+            if metric.function is not None:
+                try:
+                    values[(metric.name, ())] = [float(metric.function())]
+                except Exception:
+                    pass
+        return values
+
+    # -- multiprocess ----------------------------------------------------------
+
+    def start_flusher(self) -> None:
+        if self._flusher is not None or not multiproc_dir():
+            return
+        with self.lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        interval = flush_interval()
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def flush(self) -> None:
+        """Write this process's snapshot to the shared directory (atomically)."""
+        directory = multiproc_dir()
+        if not directory:
+            return
+        payload = {
+            "pid": os.getpid(),
+            "values": [[name, list(labels), value] for (name, labels), value in self.snapshot().items()],
+        }
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics-", suffix=".tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(payload, handle)
+        os.replace(tmp, os.path.join(directory, f"metrics-{os.getpid()}.json"))
+
+    def collect(self) -> Values:
+        """Merged values of every process (or just this one without a shared directory)."""
+        directory = multiproc_dir()
+        if not directory:
+            return self.snapshot()
+        self.flush()
+        merged: Values = {}
+        for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+            try:
+                with open(path) as handle:
+                    data = json.load(handle)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(data.get("pid"))
+            for name, labels, value in data.get("values", []):
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == GAUGE and not alive):
+                    continue
+                key = (name, tuple(labels))
+                total = merged.get(key)
+                merged[key] = list(value) if total is None else [a + b for a, b in zip(total, value)]
+        return merged
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        values = self.collect()
+        by_metric: Dict[str, list] = {}
+        for (name, labels), value in sorted(values.items()):
+            by_metric.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda m: m.name):
+            name, names = metric.name, metric.labelnames
+            lines.append(f"# HELP {name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in by_metric.get(name, []):
+                if metric.kind == HISTOGRAM:
+                    cumulative = 0
+                    bounds = [_format_value(b) for b in metric.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, value[:-1]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(names, labels, ('le', bound))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(names, labels)} {_format_value(value[-1])}")
+                    lines.append(f"{name}_count{_labels(names, labels)} {cumulative}")
+                elif metric.kind == SUMMARY:
+                    lines.append(f"{name}_sum{_labels(names, labels)} {_format_value(value[1])}")
+                    lines.append(f"{name}_count{_labels(names, labels)} {_format_value(value[0])}")
+                else:
+                    lines.append(f"{name}{_labels(names, labels)} {_format_value(value[0])}")
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid) -> bool:
+    if not isinstance(pid, int):
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+def _setting(name: str, default):
+    try:
+        from django.conf import settings
+
+        return getattr(settings, name, default)
+    except Exception:  # settings not configured (e.g. a bare worker process)
+        return default
+
+
+def multiproc_dir() -> str:
+    return _setting("METRICS_MULTIPROC_DIR", "") or os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+
+
+def flush_interval() -> float:
+    return float(_setting("METRICS_FLUSH_INTERVAL", 5))
+
+
+registry = Registry()
+registry.enabled = bool(_setting("METRICS_ENABLED", True))
+atexit.register(lambda: registry.flush() if multiproc_dir() else None)
+
+counter = registry.counter
+gauge = registry.gauge
+summary = registry.summary
+histogram = registry.histogram
+
+
+# -- application metrics -------------------------------------------------------
+
+# One summary per direction: _count is the number of operations, _sum the bytes
+CRYPTO_PAYLOAD = summary("encryption_crypto_payload_bytes", "Plaintext bytes per encrypt/decrypt operation",
+                         ("op", "cipher"))
+CRYPTO_FAILURES = counter("encryption_crypto_failures_total", "Tokens that failed to decrypt", ("cipher",))
+KEY_CACHE_LOOKUPS = counter("encryption_key_cache_lookups_total", "Key resolution cache lookups", ("result",))
+KEY_CACHE_ENTRIES = gauge("encryption_key_cache_entries", "Keys held in the key resolution cache")
+SUBKEY_CACHE_LOOKUPS = counter("encryption_subkey_cache_lookups_total", "Per-record subkey cache lookups", ("result",))
+SUBKEY_CACHE_ENTRIES = gauge("encryption_subkey_cache_entries", "Derived subkeys held in the subkey cache")
+STORAGE_LATENCY = histogram("encryption_storage_operation_seconds", "Encrypted blob storage latency",
+                            ("backend", "op"))
+EMAIL_SENDS = counter("encryption_email_send_total", "Verification email delivery attempts", ("provider", "outcome"))
+EMAIL_LATENCY = histogram("encryption_email_send_seconds", "Verification email delivery latency", ("provider",))
+TWO_FACTOR = counter("encryption_two_factor_verifications_total", "2FA code submissions", ("outcome",))
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-19 15:21
+
+import encryption.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0002_twofactorcode'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='encryptedfile',
+            name='encrypted_file',
+            field=models.FileField(max_length=255, storage=encryption.storage.get_encrypted_storage, upload_to='encrypted_files/'),
+        ),
+    ]
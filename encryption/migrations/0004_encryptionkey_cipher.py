@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0003_encryptedfile_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptionkey',
+            name='cipher',
+            field=models.CharField(choices=[('fernet', 'Fernet (AES-128-CBC + HMAC-SHA256)'), ('aes256gcm', 'AES-256-GCM'), ('chacha20poly1305', 'ChaCha20-Poly1305')], default='fernet', max_length=32),
+        ),
+    ]
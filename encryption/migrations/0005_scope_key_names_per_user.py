@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-19 15:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0004_encryptionkey_cipher'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='encryptionkey',
+            name='key_name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='encryptionkey',
+            constraint=models.UniqueConstraint(fields=('user', 'key_name'), name='unique_key_name_per_user'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-19 15:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0005_scope_key_names_per_user'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlindIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('data', 'Encrypted data'), ('file', 'Encrypted file')], max_length=8)),
+                ('object_id', models.BigIntegerField()),
+                ('term', models.CharField(choices=[('name', 'Name'), ('prefix', 'Name prefix'), ('token', 'Content token')], max_length=8)),
+                ('digest', models.CharField(max_length=32)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['digest', 'user'], name='blindindex_digest_user'), models.Index(fields=['kind', 'object_id'], name='blindindex_object')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0006_blindindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encrypteddata',
+            name='verified_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='verified_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2 on 2026-10-19 15:47
+
+import django.db.models.deletion
+import encryption.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0007_verified_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='segmented',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='encryptedfile',
+            name='encrypted_file',
+            field=models.FileField(blank=True, max_length=255, storage=encryption.storage.get_encrypted_storage, upload_to='encrypted_files/'),
+        ),
+        migrations.CreateModel(
+            name='FileSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('offset', models.BigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('blob', models.FileField(max_length=255, storage=encryption.storage.get_encrypted_storage, upload_to='encrypted_files/')),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='encryption.encryptedfile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['file', 'offset'], name='filesegment_file_offset')],
+                'constraints': [models.UniqueConstraint(fields=('file', 'index'), name='unique_segment_index')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2 on 2026-10-19 15:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+
+def move_values_to_payloads(apps, schema_editor):
+    EncryptedData = apps.get_model('encryption', 'EncryptedData')
+    EncryptedPayload = apps.get_model('encryption', 'EncryptedPayload')
+    # One statement for the sizes, rather than an UPDATE per row under an open cursor
+    EncryptedData.objects.update(encrypted_size=Length('encrypted_value'))
+    rows = EncryptedData.objects.order_by('pk').values_list('pk', 'encrypted_value')
+    batch = []
+    for pk, value in rows.iterator(chunk_size=500):
+        batch.append(EncryptedPayload(record_id=pk, value=value))
+        if len(batch) >= 500:
+            EncryptedPayload.objects.bulk_create(batch)
+            batch = []
+    EncryptedPayload.objects.bulk_create(batch)
+
+
+def move_payloads_back(apps, schema_editor):
+    EncryptedData = apps.get_model('encryption', 'EncryptedData')
+    EncryptedPayload = apps.get_model('encryption', 'EncryptedPayload')
+    for record_id, value in EncryptedPayload.objects.values_list('record_id', 'value').iterator(chunk_size=500):
+        EncryptedData.objects.filter(pk=record_id).update(encrypted_value=value)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0008_segmented_files'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncryptedPayload',
+            fields=[
+                ('record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='payload', serialize=False, to='encryption.encrypteddata')),
+                ('value', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='encrypteddata',
+            name='encrypted_size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='encrypteddata',
+            name='encrypted_value',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(move_values_to_payloads, move_payloads_back),
+        migrations.RemoveField(
+            model_name='encrypteddata',
+            name='encrypted_value',
+        ),
+    ]
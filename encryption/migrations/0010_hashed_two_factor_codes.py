@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-19 16:10
+
+from django.db import migrations, models
+
+
+def delete_plaintext_codes(apps, schema_editor):
+    # Codes were never read back from this table; nothing worth hashing is lost
+    apps.get_model('encryption', 'TwoFactorCode').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0009_data_payload_side_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_plaintext_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='twofactorcode',
+            name='code',
+            field=models.CharField(default='', max_length=6),
+        ),
+        migrations.RemoveField(
+            model_name='twofactorcode',
+            name='code',
+        ),
+        migrations.AddField(
+            model_name='twofactorcode',
+            name='code_hash',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='twofactorcode',
+            index=models.Index(fields=['user', 'used', 'created_at'], name='twofactor_user_used_created'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 16:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0010_hashed_two_factor_codes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
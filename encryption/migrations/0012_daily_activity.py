@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-19 16:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0011_file_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('encryptions', models.PositiveIntegerField(default=0)),
+                ('decryptions', models.PositiveIntegerField(default=0)),
+                ('bytes_processed', models.BigIntegerField(default=0)),
+                ('logins', models.PositiveIntegerField(default=0)),
+                ('two_factor_failures', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'daily activity',
+                'constraints': [models.UniqueConstraint(fields=('day', 'user'), name='unique_activity_per_user_day')],
+            },
+        ),
+    ]
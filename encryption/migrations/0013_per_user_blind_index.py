@@ -0,0 +1,78 @@
+# Blind-index digests now include the user id (see encryption.search.digest).
+# Existing entries are recomputed: names from the record rows, content tokens by
+# decrypting the records that had them. Reversing recomputes the unscoped form.
+
+import hashlib
+import hmac
+
+from django.db import migrations
+
+from encryption.ciphers import InvalidToken, get_cipher
+from encryption.search import _index_key, _prefix_bounds, normalize, tokenize
+
+BATCH_SIZE = 2000
+
+
+def _digest(key, user_id, kind, term, value):
+    scope = '' if user_id is None else f'{user_id}\x1f'
+    return hmac.new(key, f'{scope}{kind}\x1f{term}\x1f{value}'.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def _rebuild(apps, per_user):
+    BlindIndex = apps.get_model('encryption', 'BlindIndex')
+    EncryptedData = apps.get_model('encryption', 'EncryptedData')
+    EncryptedFile = apps.get_model('encryption', 'EncryptedFile')
+    key = _index_key()
+    low, high = _prefix_bounds()
+    tokenized = list(
+        BlindIndex.objects.filter(term='token', kind='data').values_list('object_id', flat=True).distinct()
+    )
+    BlindIndex.objects.all().delete()
+
+    entries = []
+
+    def add(kind, object_id, user_id, term, value):
+        digest = _digest(key, user_id if per_user else None, kind, term, value)
+        entries.append(BlindIndex(kind=kind, object_id=object_id, user_id=user_id, term=term, digest=digest))
+        if len(entries) >= BATCH_SIZE:
+            BlindIndex.objects.bulk_create(entries)
+            entries.clear()
+
+    for kind, model, name_field in (('data', EncryptedData, 'data_name'), ('file', EncryptedFile, 'file_name')):
+        rows = model.objects.values_list('pk', 'user_id', name_field)
+        for pk, user_id, name in rows.iterator(chunk_size=BATCH_SIZE):
+            name = normalize(name)
+            add(kind, pk, user_id, 'name', name)
+            for length in range(low, min(len(name), high) + 1):
+                add(kind, pk, user_id, 'prefix', name[:length])
+
+    # Content words are only known from the plaintext
+    for start in range(0, len(tokenized), 500):
+        records = EncryptedData.objects.filter(pk__in=tokenized[start:start + 500]).select_related('key', 'payload')
+        for record in records:
+            try:
+                text = get_cipher(record.key).decrypt_text(record.payload.value)
+            except InvalidToken:
+                continue
+            for token in tokenize(text):
+                add('data', record.pk, record.user_id, 'token', token)
+    BlindIndex.objects.bulk_create(entries)
+
+
+def scope_digests_per_user(apps, schema_editor):
+    _rebuild(apps, per_user=True)
+
+
+def unscope_digests(apps, schema_editor):
+    _rebuild(apps, per_user=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0012_daily_activity'),
+    ]
+
+    operations = [
+        migrations.RunPython(scope_digests_per_user, unscope_digests),
+    ]
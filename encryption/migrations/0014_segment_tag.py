@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('encryption', '0013_per_user_blind_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='segment_tag',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -1,41 +1,184 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
+from .ciphers import CIPHER_CHOICES, DEFAULT_CIPHER, get_cipher
+from .storage import get_encrypted_storage
+
 class EncryptionKey(models.Model):
-    key_name = models.CharField(max_length=100, unique=True)
+    key_name = models.CharField(max_length=100)
     key_value = models.TextField()
+    cipher = models.CharField(max_length=32, choices=CIPHER_CHOICES, default=DEFAULT_CIPHER)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key_name'], name='unique_key_name_per_user'),
+        ]
+
     def __str__(self):
         return self.key_name
 
+    def get_cipher(self):
+        return get_cipher(self)
+
 class EncryptedData(models.Model):
     data_name = models.CharField(max_length=100)
-    encrypted_value = models.TextField()
     key = models.ForeignKey(EncryptionKey, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Last successful integrity check (see verify_vault)
+    verified_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Length of the ciphertext in EncryptedPayload, so lists can show it without loading it
+    encrypted_size = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.data_name
 
+    @classmethod
+    def create(cls, encrypted_value, **fields):
+        """Create a record together with its payload row."""
+        with transaction.atomic():
+            record = cls.objects.create(encrypted_size=len(encrypted_value), **fields)
+            EncryptedPayload.objects.create(record=record, value=encrypted_value)
+        return record
+
+    @property
+    def encrypted_value(self):
+        """The ciphertext; one extra query unless fetched with select_related('payload')."""
+        return self.payload.value
+
+
+class EncryptedPayload(models.Model):
+    """Ciphertext of an ``EncryptedData`` record, kept out of the metadata table.
+
+    Values can run to megabytes of base64, so listings and counts never touch this
+    table; only decryption, export and integrity checks read it.
+    """
+    record = models.OneToOneField(EncryptedData, on_delete=models.CASCADE, primary_key=True, related_name='payload')
+    value = models.TextField()
+
+    def __str__(self):
+        return f"payload of {self.record_id}"
+
+
 class EncryptedFile(models.Model):
     file_name = models.CharField(max_length=255)
-    encrypted_file = models.FileField(upload_to='media/encrypted_files/')
+    # Empty for segmented files, whose ciphertext lives in FileSegment blobs
+    encrypted_file = models.FileField(
+        upload_to='encrypted_files/', storage=get_encrypted_storage, max_length=255, blank=True
+    )
     key = models.ForeignKey(EncryptionKey, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    verified_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    segmented = models.BooleanField(default=False)
+    # Plaintext size in bytes (unknown for files stored before it was recorded)
+    size = models.BigIntegerField(null=True, blank=True)
+    # Bumped by every change to the content; clients pass it back so a write based
+    # on a stale view is refused (see encryption.locks)
+    version = models.PositiveIntegerField(default=1)
+    # Random id (hex) in the header of every segment, binding segments to their file;
+    # empty for files segmented before it was introduced (see encryption.segments)
+    segment_tag = models.CharField(max_length=32, blank=True, default='')
 
     def __str__(self):
         return self.file_name
 
+
+class FileSegment(models.Model):
+    """One independently encrypted piece of a segmented ``EncryptedFile``.
+
+    ``offset``/``length`` locate the segment in the plaintext, so a byte range
+    is served by decrypting only the segments that cover it. See
+    ``encryption.segments``.
+    """
+    file = models.ForeignKey(EncryptedFile, on_delete=models.CASCADE, related_name='segments')
+    index = models.PositiveIntegerField()
+    offset = models.BigIntegerField()
+    length = models.PositiveIntegerField()
+    blob = models.FileField(upload_to='encrypted_files/', storage=get_encrypted_storage, max_length=255)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'index'], name='unique_segment_index'),
+        ]
+        indexes = [
+            models.Index(fields=['file', 'offset'], name='filesegment_file_offset'),
+        ]
+
+    def __str__(self):
+        return f"{self.file_id}#{self.index}"
+
 class TwoFactorCode(models.Model):
+    """A login code issued by ``encryption.otp``; only its HMAC is stored."""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    code = models.CharField(max_length=6)
+    code_hash = models.CharField(max_length=64)
     created_at = models.DateTimeField(auto_now_add=True)
     used = models.BooleanField(default=False)
     attempts = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            # The user's newest unused code: the only lookup verification makes
+            models.Index(fields=['user', 'used', 'created_at'], name='twofactor_user_used_created'),
+        ]
+
     def __str__(self):
         return f"2FA for {self.user.username} - used={self.used}"
+
+
+class BlindIndex(models.Model):
+    """Keyed HMAC digests of record names (and optional content tokens).
+
+    Lets users find records by exact name, name prefix or content word without
+    scanning or decrypting anything. See ``encryption.search``.
+    """
+    KIND_DATA = 'data'
+    KIND_FILE = 'file'
+    KIND_CHOICES = [(KIND_DATA, 'Encrypted data'), (KIND_FILE, 'Encrypted file')]
+
+    TERM_NAME = 'name'
+    TERM_PREFIX = 'prefix'
+    TERM_TOKEN = 'token'
+    TERM_CHOICES = [(TERM_NAME, 'Name'), (TERM_PREFIX, 'Name prefix'), (TERM_TOKEN, 'Content token')]
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    term = models.CharField(max_length=8, choices=TERM_CHOICES)
+    digest = models.CharField(max_length=32)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['digest', 'user'], name='blindindex_digest_user'),
+            models.Index(fields=['kind', 'object_id'], name='blindindex_object'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.object_id} {self.term}"
+
+
+class DailyActivity(models.Model):
+    """Per-user, per-day activity counters behind the admin panel charts.
+
+    Maintained incrementally by ``encryption.rollups``; charts read one row per
+    user and day instead of the record tables.
+    """
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    encryptions = models.PositiveIntegerField(default=0)
+    decryptions = models.PositiveIntegerField(default=0)
+    # Plaintext bytes encrypted or decrypted
+    bytes_processed = models.BigIntegerField(default=0)
+    logins = models.PositiveIntegerField(default=0)
+    two_factor_failures = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user'], name='unique_activity_per_user_day'),
+        ]
+        verbose_name_plural = 'daily activity'
+
+    def __str__(self):
+        return f"{self.user_id} on {self.day}"
@@ -0,0 +1,86 @@
+"""
+One-time login codes backed by ``TwoFactorCode``.
+
+Codes come from :mod:`secrets` and only an HMAC of ``(user id, code)`` is stored,
+so a leaked table or backup does not reveal live codes. Issuing a code replaces
+the user's earlier ones.
+
+Verification reads the user's newest code with one query on the
+``(user, used, created_at)`` index and compares digests in constant time. Every
+write is a conditional ``UPDATE``: a correct code is claimed with
+``used=False`` in the ``WHERE`` clause, so of several concurrent submissions
+exactly one succeeds, and wrong guesses bump ``attempts`` with an ``F()``
+expression, so no increment is lost and the lockout cannot be raced past.
+"""
+from __future__ import annotations
+
+import hmac
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from .models import TwoFactorCode
+
+DIGITS = 6
+
+SUCCESS = "success"
+INVALID = "invalid"
+EXPIRED = "expired"
+LOCKED = "locked"
+MISSING = "missing"
+
+
+def ttl() -> timedelta:
+    return timedelta(seconds=int(getattr(settings, "OTP_TTL_SECONDS", 600)))
+
+
+def max_attempts() -> int:
+    return int(getattr(settings, "OTP_MAX_ATTEMPTS", 5))
+
+
+def _digest(user_id: int, code: str) -> str:
+    return salted_hmac("encryption.otp", f"{user_id}:{code}", algorithm="sha256").hexdigest()
+
+
+def issue(user) -> str:
+    """Create a fresh code for ``user`` and return it (the only time it exists in clear)."""
+    code = f"{secrets.randbelow(10 ** DIGITS):0{DIGITS}d}"
+    with transaction.atomic():
+        TwoFactorCode.objects.filter(user=user).delete()
+        TwoFactorCode.objects.create(user=user, code_hash=_digest(user.pk, code))
+    return code
+
+
+def verify(user_id: int, code: str) -> str:
+    """Check ``code`` against the user's current code; returns one of the outcome constants.
+
+    A code stops working after its first successful use, once it expires, or
+    after ``OTP_MAX_ATTEMPTS`` wrong guesses.
+    """
+    current = (
+        TwoFactorCode.objects.filter(user_id=user_id, used=False)
+        .order_by("-created_at")
+        .values("pk", "code_hash", "attempts", "created_at")
+        .first()
+    )
+    if current is None:
+        return MISSING
+    if current["created_at"] < timezone.now() - ttl():
+        return EXPIRED
+    limit = max_attempts()
+    if current["attempts"] >= limit:
+        return LOCKED
+
+    claimable = TwoFactorCode.objects.filter(pk=current["pk"], used=False, attempts__lt=limit)
+    if hmac.compare_digest(_digest(user_id, code or ""), current["code_hash"]):
+        # Only one concurrent submission can flip used=False -> True
+        return SUCCESS if claimable.update(used=True) == 1 else INVALID
+
+    # attempts__lt keeps concurrent wrong guesses from counting past the limit
+    claimable.update(attempts=F("attempts") + 1)
+    return INVALID
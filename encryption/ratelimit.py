@@ -0,0 +1,193 @@
+"""
+Sliding-window rate limiting for login, 2FA and crypto endpoints.
+
+Each check is O(1): a counter for the current fixed window and one for the
+previous window are combined into a weighted estimate of the last ``window``
+seconds (the "sliding window counter" approximation). Counters live in a
+pluggable store:
+
+- ``MemoryCounterStore``: in-process dict, for a single node.
+- ``CacheCounterStore``: Django's cache (``add``/``incr``), shared by every
+  worker and node that uses the same cache backend.
+
+Limits are configured in ``settings.RATELIMITS`` as ``{scope: {"ip": rate,
+"user": rate}}`` where a rate looks like ``"5/m"``, ``"100/h"`` or ``"10/30s"``.
+"""
+from __future__ import annotations
+
+import functools
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.utils.module_loading import import_string
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_RATE_RE = re.compile(r"^\s*(\d+)\s*/\s*(\d*)\s*([smhd])\s*$")
+
+
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """``"5/10m"`` -> ``(5, 600)``."""
+    match = _RATE_RE.match(rate)
+    if not match:
+        raise ValueError(f"Invalid rate {rate!r}; expected e.g. '5/m' or '10/30s'")
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * _UNITS[unit]
+
+
+class MemoryCounterStore:
+    """Thread-safe in-process counters. Stale entries are pruned in batches."""
+
+    def __init__(self, prune_every: int = 10_000):
+        self._counters: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._prune_every = prune_every
+        self._ops = 0
+
+    def incr(self, key: str, window_index: int, window: int) -> Tuple[int, int]:
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or entry[0] < window_index - 1:
+                entry = [window_index, 0, 0]
+                self._counters[key] = entry
+            elif entry[0] == window_index - 1:
+                entry[0], entry[1], entry[2] = window_index, 0, entry[1]
+            entry[1] += 1
+            current, previous = entry[1], entry[2]
+
+            self._ops += 1
+            if self._ops >= self._prune_every:
+                self._ops = 0
+                self._prune(window_index)
+            return current, previous
+
+    def _prune(self, window_index: int) -> None:
+        stale = [k for k, entry in self._counters.items() if entry[0] < window_index - 1]
+        for k in stale:
+            del self._counters[k]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+
+class CacheCounterStore:
+    """Counters in Django's cache, one key per (limit key, window)."""
+
+    prefix = "rl"
+
+    def incr(self, key: str, window_index: int, window: int) -> Tuple[int, int]:
+        current_key = f"{self.prefix}:{key}:{window_index}"
+        # add() is a no-op when the key exists, so concurrent first hits don't reset it
+        cache.add(current_key, 0, timeout=window * 2)
+        try:
+            current = cache.incr(current_key)
+        except ValueError:
+            # Evicted between add() and incr()
+            cache.set(current_key, 1, timeout=window * 2)
+            current = 1
+        previous = cache.get(f"{self.prefix}:{key}:{window_index - 1}", 0)
+        return current, previous
+
+
+class RateLimiter:
+    def __init__(self, limit: int, window: int, store=None):
+        self.limit = limit
+        self.window = window
+        self.store = store if store is not None else get_store()
+
+    def hit(self, key: str, now: Optional[float] = None) -> Tuple[bool, int]:
+        """Record one event for ``key``. Returns ``(allowed, retry_after_seconds)``."""
+        now = time.time() if now is None else now
+        window_index, offset = divmod(now, self.window)
+        current, previous = self.store.incr(key, int(window_index), self.window)
+        estimate = previous * (1 - offset / self.window) + current
+        if estimate <= self.limit:
+            return True, 0
+        return False, max(1, int(self.window - offset))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                path = getattr(settings, "RATELIMIT_STORE", "encryption.ratelimit.MemoryCounterStore")
+                _store = import_string(path)()
+    return _store
+
+
+def client_ip(request) -> str:
+    if getattr(settings, "RATELIMIT_TRUST_X_FORWARDED_FOR", False):
+        forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "") or "unknown"
+
+
+def user_key(request) -> Optional[str]:
+    """Identify the account being acted on, before or after authentication."""
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return str(user.pk)
+    pending = request.session.get("pre_2fa_user_id") if hasattr(request, "session") else None
+    if pending:
+        return str(pending)
+    username = request.POST.get("username")
+    if username:
+        return f"name:{username.lower()}"
+    return None
+
+
+def check(request, scope: str) -> Tuple[bool, int]:
+    """Apply every configured limit for ``scope``; return ``(allowed, retry_after)``."""
+    if not getattr(settings, "RATELIMIT_ENABLED", True):
+        return True, 0
+    rates = getattr(settings, "RATELIMITS", {}).get(scope, {})
+    identities: Dict[str, Callable] = {"ip": client_ip, "user": user_key}
+    allowed, retry_after = True, 0
+    for kind, rate in rates.items():
+        identity = identities[kind](request)
+        if identity is None:
+            continue
+        limit, window = parse_rate(rate)
+        ok, wait = RateLimiter(limit, window).hit(f"{scope}:{kind}:{identity}")
+        if not ok:
+            allowed, retry_after = False, max(retry_after, wait)
+    return allowed, retry_after
+
+
+def ratelimit(scope: str, methods=("POST",), template: Optional[str] = None):
+    """View decorator enforcing ``settings.RATELIMITS[scope]``.
+
+    Blocked requests get a 429 with ``Retry-After``; if ``template`` is given it is
+    rendered with an ``error`` message instead of a plain-text body.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method in methods:
+                allowed, retry_after = check(request, scope)
+                if not allowed:
+                    message = f"Too many requests. Try again in {retry_after} seconds."
+                    if template:
+                        response = render(request, template, {"error": message}, status=429)
+                    else:
+                        response = HttpResponse(message, status=429, content_type="text/plain")
+                    response["Retry-After"] = str(retry_after)
+                    return response
+            return view(request, *args, **kwargs)
+
+        return wrapped
+
+    return decorator
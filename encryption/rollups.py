@@ -0,0 +1,158 @@
+"""
+Daily activity rollups for the admin panel.
+
+Encryptions, decryptions, plaintext bytes processed, logins and failed 2FA
+submissions are counted per user per day in ``DailyActivity``. Charts then read
+one row per active user and day, whatever the size of the record tables.
+
+:func:`record` only adds to an in-process buffer. Every
+``ROLLUP_FLUSH_INTERVAL`` seconds a background thread (started by the first
+event in each process) writes it with one ``UPDATE ... SET n = n + delta`` per
+(day, user), and once more when the process exits. The request path therefore
+rarely touches the database, and workers add to rows rather than overwrite
+each other's counts. Only a worker that is killed outright loses counts, at
+most its last interval. Set the interval to 0 to write every event through.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import DailyActivity
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("encryptions", "decryptions", "bytes_processed", "logins", "two_factor_failures")
+
+
+def flush_interval() -> float:
+    return float(getattr(settings, "ROLLUP_FLUSH_INTERVAL", 10))
+
+
+def _apply(day: date, user_id: int, counts: Counter) -> None:
+    updates = {field: F(field) + n for field, n in counts.items() if n}
+    if not updates:
+        return
+    rows = DailyActivity.objects.filter(day=day, user_id=user_id)
+    if rows.update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            DailyActivity.objects.create(day=day, user_id=user_id, **counts)
+    except IntegrityError:
+        # Another worker created the row first (or the user is gone, and this matches nothing)
+        rows.update(**updates)
+
+
+class RollupBuffer:
+    def __init__(self):
+        self._pending: Dict[Tuple[date, int], Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        # Process that owns the flusher thread; a forked child starts its own
+        self._flusher_pid: Optional[int] = None
+        self._stop = threading.Event()
+
+    def add(self, user_id: int, **counts: int) -> None:
+        unknown = set(counts) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown activity counters: {', '.join(sorted(unknown))}")
+        key = (timezone.localdate(), user_id)
+        interval = flush_interval()
+        with self._lock:
+            self._pending[key].update(counts)
+            due = time.monotonic() - self._last_flush >= interval
+            start = interval > 0 and self._flusher_pid != os.getpid()
+            if start:
+                self._flusher_pid = os.getpid()
+        if start:
+            self._start_flusher()
+        if due:
+            self.flush()
+
+    def _start_flusher(self) -> None:
+        self._stop = threading.Event()
+        threading.Thread(target=self._run_flusher, args=(self._stop,), name="rollup-flush", daemon=True).start()
+        atexit.register(self.stop)
+
+    def _run_flusher(self, stop: threading.Event) -> None:
+        while not stop.wait(max(flush_interval(), 0.01)):
+            if self._pending:
+                try:
+                    self.flush()
+                finally:
+                    # This thread's connection would otherwise stay open for good
+                    connections.close_all()
+
+    def stop(self) -> None:
+        """Stop the flusher thread and write what is still buffered (runs at exit)."""
+        self._stop.set()
+        if self._pending:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+            self._last_flush = time.monotonic()
+        items = list(pending.items())
+        for i, ((day, user_id), counts) in enumerate(items):
+            try:
+                _apply(day, user_id, counts)
+            except DatabaseError:
+                # Keep what was not written for the next flush rather than fail the request
+                logger.warning("Writing activity rollups failed; retrying on the next flush", exc_info=True)
+                with self._lock:
+                    for key, unwritten in items[i:]:
+                        self._pending[key].update(unwritten)
+                return
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+buffer = RollupBuffer()
+
+
+def record(user, **counts: int) -> None:
+    """Count activity for ``user`` (an instance or id) today, e.g. ``record(user, decryptions=1)``."""
+    user_id = getattr(user, "pk", user)
+    if user_id is not None:
+        buffer.add(user_id, **counts)
+
+
+def flush() -> None:
+    buffer.flush()
+
+
+def daily_totals(days: int = 30, user=None, today: Optional[date] = None) -> Dict[str, List]:
+    """Per-day sums of every counter over the last ``days`` days (today included).
+
+    Returns ``{"days": [iso dates], "<counter>": [values]}`` with zeros for days
+    without activity, ready to chart.
+    """
+    today = today or timezone.localdate()
+    first = today - timedelta(days=days - 1)
+    rows = DailyActivity.objects.filter(day__gte=first, day__lte=today)
+    if user is not None:
+        rows = rows.filter(user=user)
+    # One row per day, summed over users (annotations may not reuse field names)
+    by_day = {
+        row["day"]: row
+        for row in rows.values("day").order_by("day").annotate(**{f"total_{field}": Sum(field) for field in FIELDS})
+    }
+    span = [first + timedelta(days=i) for i in range(days)]
+    series: Dict[str, List] = {"days": [day.isoformat() for day in span]}
+    for field in FIELDS:
+        series[field] = [by_day[day][f"total_{field}"] if day in by_day else 0 for day in span]
+    return series
@@ -0,0 +1,178 @@
+"""
+Blind-index search over encrypted records.
+
+Names (and, when requested, plaintext words of ``EncryptedData``) are normalised
+and stored as truncated HMAC-SHA256 digests in ``BlindIndex``. A lookup hashes
+the query the same way and does one indexed equality match on ``digest``, so the
+cost depends on the number of hits rather than the table size, and the index
+never reveals the indexed text. The user id is part of every digest, so equal
+names or words of different users hash differently and the table does not show
+which users share a term or how common it is. It also means every search is
+for one user's records.
+
+Prefix search indexes every prefix between ``BLIND_INDEX_PREFIX_MIN`` and
+``BLIND_INDEX_PREFIX_MAX`` characters; longer queries match on the longest
+indexed prefix and are then filtered against the (plaintext) record name.
+"""
+from __future__ import annotations
+
+import hashlib
+import hmac
+import re
+import unicodedata
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.db.models import Count
+
+from .models import BlindIndex, EncryptedData, EncryptedFile
+
+MODE_EXACT = "exact"
+MODE_PREFIX = "prefix"
+MODE_TOKEN = "token"
+MODES = (MODE_EXACT, MODE_PREFIX, MODE_TOKEN)
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_MODELS = {BlindIndex.KIND_DATA: EncryptedData, BlindIndex.KIND_FILE: EncryptedFile}
+_NAME_FIELDS = {BlindIndex.KIND_DATA: "data_name", BlindIndex.KIND_FILE: "file_name"}
+
+
+def _index_key() -> bytes:
+    key = getattr(settings, "BLIND_INDEX_KEY", "")
+    if key:
+        return key.encode()
+    # Derive a dedicated key so the raw SECRET_KEY is never used directly
+    return hmac.new(settings.SECRET_KEY.encode(), b"encryption.blind-index", hashlib.sha256).digest()
+
+
+def _prefix_bounds():
+    return (
+        int(getattr(settings, "BLIND_INDEX_PREFIX_MIN", 2)),
+        int(getattr(settings, "BLIND_INDEX_PREFIX_MAX", 12)),
+    )
+
+
+def prefix_max() -> int:
+    """Length of the longest indexed name prefix; longer prefix queries need confirming."""
+    return _prefix_bounds()[1]
+
+
+def normalize(value: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", value).casefold().split())
+
+
+def digest(kind: str, term: str, value: str, user_id: int, key: Optional[bytes] = None) -> str:
+    """HMAC of an already normalised value, scoped to a user and domain-separated by kind and term."""
+    message = f"{user_id}\x1f{kind}\x1f{term}\x1f{value}".encode()
+    return hmac.new(key or _index_key(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def kind_for(obj) -> str:
+    return BlindIndex.KIND_FILE if isinstance(obj, EncryptedFile) else BlindIndex.KIND_DATA
+
+
+def _name_entries(obj, key: bytes) -> List[BlindIndex]:
+    kind = kind_for(obj)
+    name = normalize(getattr(obj, _NAME_FIELDS[kind]))
+    low, high = _prefix_bounds()
+    entries = [BlindIndex(kind=kind, object_id=obj.pk, user_id=obj.user_id,
+                          term=BlindIndex.TERM_NAME, digest=digest(kind, BlindIndex.TERM_NAME, name, obj.user_id, key))]
+    for length in range(low, min(len(name), high) + 1):
+        entries.append(BlindIndex(kind=kind, object_id=obj.pk, user_id=obj.user_id, term=BlindIndex.TERM_PREFIX,
+                                  digest=digest(kind, BlindIndex.TERM_PREFIX, name[:length], obj.user_id, key)))
+    return entries
+
+
+def tokenize(text: str, limit: Optional[int] = None) -> List[str]:
+    limit = limit or int(getattr(settings, "BLIND_INDEX_MAX_TOKENS", 256))
+    seen = {}
+    for token in _TOKEN_RE.findall(normalize(text)):
+        seen.setdefault(token, None)
+        if len(seen) >= limit:
+            break
+    return list(seen)
+
+
+def index_records(objs: Iterable) -> None:
+    """(Re)index the names of ``objs`` in one delete + one ``bulk_create`` per kind."""
+    key = _index_key()
+    by_kind = {}
+    for obj in objs:
+        by_kind.setdefault(kind_for(obj), []).append(obj)
+    for kind, items in by_kind.items():
+        BlindIndex.objects.filter(
+            kind=kind, object_id__in=[o.pk for o in items],
+            term__in=[BlindIndex.TERM_NAME, BlindIndex.TERM_PREFIX],
+        ).delete()
+        entries = []
+        for obj in items:
+            entries.extend(_name_entries(obj, key))
+        BlindIndex.objects.bulk_create(entries, batch_size=1000)
+
+
+def index_record(obj) -> None:
+    index_records([obj])
+
+
+def index_tokens(obj, text: str) -> None:
+    """Make the plaintext words of ``obj`` searchable (call while plaintext is at hand)."""
+    key = _index_key()
+    kind = kind_for(obj)
+    BlindIndex.objects.filter(kind=kind, object_id=obj.pk, term=BlindIndex.TERM_TOKEN).delete()
+    BlindIndex.objects.bulk_create([
+        BlindIndex(kind=kind, object_id=obj.pk, user_id=obj.user_id, term=BlindIndex.TERM_TOKEN,
+                   digest=digest(kind, BlindIndex.TERM_TOKEN, token, obj.user_id, key))
+        for token in tokenize(text)
+    ])
+
+
+def unindex_record(kind: str, object_id: int) -> None:
+    BlindIndex.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def search_ids(query: str, kind: str, mode: str = MODE_PREFIX, user=None):
+    """Return ids of ``kind`` records of ``user`` (an instance or id) matching ``query``.
+
+    Digests are per user, so there is no search across all users. The result is
+    a lazy ``values_list`` queryset, usable directly as a subquery.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown search mode {mode!r}")
+    if user is None:
+        raise ValueError("Blind-index search needs a user; digests are scoped per user")
+    user_id = getattr(user, "pk", user)
+    value = normalize(query)
+    if not value:
+        return BlindIndex.objects.none().values_list("object_id", flat=True)
+
+    if mode == MODE_TOKEN:
+        term, values = BlindIndex.TERM_TOKEN, tokenize(value)
+    elif mode == MODE_EXACT:
+        term, values = BlindIndex.TERM_NAME, [value]
+    else:
+        low, high = _prefix_bounds()
+        if len(value) < low:
+            return BlindIndex.objects.none().values_list("object_id", flat=True)
+        term, values = BlindIndex.TERM_PREFIX, [value[:high]]
+    key = _index_key()
+    digests = {digest(kind, term, v, user_id, key) for v in values}
+
+    # Digests are domain-separated by user, kind and term, so matching on digest
+    # is exact; the user filter lets the planner use the (digest, user) index
+    hits = BlindIndex.objects.filter(digest__in=digests, user_id=user_id)
+    if mode == MODE_TOKEN and len(values) > 1:
+        # All words must match
+        return (hits.values("object_id").annotate(n=Count("digest", distinct=True))
+                .filter(n=len(values)).values_list("object_id", flat=True))
+    return hits.values_list("object_id", flat=True)
+
+
+def search(query: str, kind: str, mode: str = MODE_PREFIX, user=None, limit: int = 50):
+    """Return ``user``'s matching ``EncryptedData``/``EncryptedFile`` rows, newest first."""
+    ids = search_ids(query, kind, mode, user)
+    queryset = _MODELS[kind].objects.filter(pk__in=ids).order_by("-created_at")
+    if mode == MODE_PREFIX and len(normalize(query)) > prefix_max():
+        # Query longer than the indexed prefixes: confirm against the real name
+        wanted = normalize(query)
+        return [obj for obj in queryset if normalize(getattr(obj, _NAME_FIELDS[kind])).startswith(wanted)][:limit]
+    return list(queryset[:limit])
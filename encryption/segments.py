@@ -0,0 +1,238 @@
+"""
+Segmented encrypted files: append without re-encrypting, decrypt byte ranges.
+
+A segmented ``EncryptedFile`` stores its plaintext as consecutive segments of
+at most ``FILE_SEGMENT_SIZE`` bytes, each encrypted on its own into a separate
+blob and indexed by a ``FileSegment`` row (index, plaintext offset, length).
+
+- Appending encrypts and stores only the new data as new segments.
+- Reading ``[start, end)`` looks up the covering segments through the
+  ``(file, offset)`` index and decrypts just those.
+
+Each segment's plaintext starts with a header checked on decryption: the
+file's random ``segment_tag``, the segment's index and offset, and whether it
+ends the pass that wrote it. So segments cannot be reordered, moved within a
+file or swapped in from another file unnoticed, and a read up to the end of the
+file fails if the last segment is not one that ended a pass (truncation
+mid-pass). Files created before tags existed keep the index/offset header.
+The segments written in one pass (an upload or an append) share one record
+subkey, so reading them back derives it once.
+"""
+from __future__ import annotations
+
+import os
+import struct
+from typing import Iterable, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F
+
+from . import fragments, locks
+from .ciphers import InvalidToken
+from .models import EncryptedFile, FileSegment
+from .storage import get_encrypted_storage
+
+# segment index, plaintext offset (untagged files)
+_HEADER = struct.Struct(">IQ")
+# file tag, segment index, plaintext offset, last segment of its pass
+_TAGGED_HEADER = struct.Struct(">16sIQ?")
+TAG_SIZE = 16
+
+
+def segment_size() -> int:
+    return int(getattr(settings, "FILE_SEGMENT_SIZE", 1024 * 1024))
+
+
+def new_tag() -> bytes:
+    return os.urandom(TAG_SIZE)
+
+
+def _tag_of(encrypted_file: EncryptedFile) -> bytes:
+    return bytes.fromhex(encrypted_file.segment_tag)
+
+
+class SegmentWriter:
+    """Encrypt plaintext into segment blobs as it arrives.
+
+    Plaintext is buffered only up to one segment; a full segment is encrypted
+    and saved to storage as soon as more data follows it, and the last one on
+    :meth:`close`, marked as ending the pass. Segments of files with a ``tag``
+    carry it in their header. The ``FileSegment`` rows are
+    built but not saved: :func:`append` and :func:`create` insert them, and
+    :meth:`abort` removes the blobs if that never happens.
+    """
+
+    def __init__(
+        self,
+        cipher,
+        file_name: str,
+        index: int = 0,
+        offset: int = 0,
+        size: Optional[int] = None,
+        tag: bytes = b"",
+    ):
+        self.cipher = cipher
+        self.tag = tag
+        self.file_name = os.path.basename(file_name)
+        self.index = index
+        self.offset = offset
+        self.size = size or segment_size()
+        self.segments: List[FileSegment] = []
+        self.storage = get_encrypted_storage()
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        # A full segment is held back until more data arrives: it may be the last one
+        while len(self._buffer) > self.size:
+            self._store(bytes(self._buffer[: self.size]))
+            del self._buffer[: self.size]
+
+    def close(self) -> None:
+        if self._buffer:
+            self._store(bytes(self._buffer), last=True)
+            self._buffer.clear()
+
+    def abort(self) -> None:
+        for segment in self.segments:
+            self.storage.delete(segment.blob.name)
+        self.segments = []
+        self._buffer.clear()
+
+    def _store(self, piece: bytes, last: bool = False) -> None:
+        if self.tag:
+            header = _TAGGED_HEADER.pack(self.tag, self.index, self.offset, last)
+        else:
+            header = _HEADER.pack(self.index, self.offset)
+        token = self.cipher.encrypt(header + piece)
+        name = self.storage.save(
+            self.storage.generate_filename(f"encrypted_files/{self.file_name}.{self.index:06d}.seg"), ContentFile(token)
+        )
+        self.segments.append(FileSegment(index=self.index, offset=self.offset, length=len(piece), blob=name))
+        self.index += 1
+        self.offset += len(piece)
+
+    def _insert(self, encrypted_file: EncryptedFile) -> None:
+        for segment in self.segments:
+            segment.file = encrypted_file
+        FileSegment.objects.bulk_create(self.segments, batch_size=500)
+
+
+def append(
+    encrypted_file: EncryptedFile,
+    chunks: Iterable[bytes],
+    size: Optional[int] = None,
+    expected_version: Optional[int] = None,
+) -> int:
+    """Encrypt ``chunks`` as new segments at the end of ``encrypted_file``.
+
+    Returns the number of plaintext bytes appended. Concurrent appends and
+    deletes of the same file are serialised on its row (see ``encryption.locks``).
+    Raises ``EncryptedFile.DoesNotExist`` if the file was deleted meanwhile and
+    ``VersionConflict`` if ``expected_version`` is given and no longer current.
+    """
+    if not encrypted_file.segmented:
+        raise ValueError("Only segmented files can be appended to")
+    writer = None
+    try:
+        with locks.locked_row(
+            EncryptedFile.objects.only("id", "user_id", "version", "segment_tag"), encrypted_file.pk
+        ) as locked:
+            if locked is None:
+                raise EncryptedFile.DoesNotExist
+            locks.check_version(locked, expected_version)
+            last = locked.segments.order_by("-index").only("index", "offset", "length").first()
+            writer = SegmentWriter(
+                encrypted_file.key.get_cipher().for_new_record(),
+                encrypted_file.file_name,
+                index=last.index + 1 if last else 0,
+                offset=last.offset + last.length if last else 0,
+                size=size,
+                tag=_tag_of(locked),
+            )
+            start = writer.offset
+            for chunk in chunks:
+                writer.write(chunk)
+            writer.close()
+            writer._insert(locked)
+            EncryptedFile.objects.filter(pk=locked.pk).update(size=writer.offset, version=F("version") + 1)
+            # update() sends no signals; cached record rows show the version
+            transaction.on_commit(lambda: fragments.invalidate(locked.user_id, fragments.GLOBAL_SCOPE))
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+    encrypted_file.size = writer.offset
+    encrypted_file.version = locked.version + 1
+    return writer.offset - start
+
+
+def create_from_writer(key, user, file_name: str, writer: SegmentWriter) -> EncryptedFile:
+    """Record a segmented file whose segments ``writer`` has already stored (from offset 0)."""
+    writer.close()
+    try:
+        with transaction.atomic():
+            encrypted_file = EncryptedFile.objects.create(
+                file_name=file_name, key=key, user=user, segmented=True, size=writer.offset, encrypted_file="",
+                segment_tag=writer.tag.hex(),
+            )
+            writer._insert(encrypted_file)
+    except Exception:
+        writer.abort()
+        raise
+    return encrypted_file
+
+
+def create(key, user, file_name: str, chunks: Iterable[bytes], size: Optional[int] = None) -> EncryptedFile:
+    """Create a segmented file holding ``chunks``."""
+    writer = SegmentWriter(key.get_cipher().for_new_record(), file_name, size=size, tag=new_tag())
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+    except Exception:
+        writer.abort()
+        raise
+    return create_from_writer(key, user, file_name, writer)
+
+
+def _decrypt_segment(cipher, segment: FileSegment, tag: bytes, last: bool) -> bytes:
+    with segment.blob.open("rb") as blob:
+        plaintext = cipher.decrypt(blob.read())
+    if not tag:
+        if len(plaintext) != _HEADER.size + segment.length or _HEADER.unpack_from(plaintext) != (segment.index, segment.offset):
+            raise InvalidToken
+        return plaintext[_HEADER.size:]
+    if len(plaintext) != _TAGGED_HEADER.size + segment.length:
+        raise InvalidToken
+    segment_tag, index, offset, ends_pass = _TAGGED_HEADER.unpack_from(plaintext)
+    # Earlier passes end mid-file, so only the file's last segment must end one
+    if (segment_tag, index, offset) != (tag, segment.index, segment.offset) or (last and not ends_pass):
+        raise InvalidToken
+    return plaintext[_TAGGED_HEADER.size:]
+
+
+def read_range(encrypted_file: EncryptedFile, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """Yield the plaintext of ``[start, end)``, decrypting only the covering segments."""
+    if not encrypted_file.segmented:
+        # Single-blob files have to be decrypted whole
+        with encrypted_file.encrypted_file.open("rb") as blob:
+            plaintext = encrypted_file.key.get_cipher().decrypt(blob.read())
+        yield plaintext[start:end]
+        return
+
+    end = encrypted_file.size if end is None else min(end, encrypted_file.size or 0)
+    if start >= end:
+        return
+    cipher = encrypted_file.key.get_cipher()
+    tag = _tag_of(encrypted_file)
+    segments = encrypted_file.segments.order_by("offset")
+    first = segments.filter(offset__lte=start).order_by("-offset").only("offset").first()
+    for segment in segments.filter(offset__gte=first.offset if first else 0, offset__lt=end).iterator():
+        data = _decrypt_segment(cipher, segment, tag, segment.offset + segment.length == encrypted_file.size)
+        yield data[max(start - segment.offset, 0) : end - segment.offset]
+
+
+def iter_plaintext(encrypted_file: EncryptedFile) -> Iterator[bytes]:
+    return read_range(encrypted_file, 0, None)
@@ -0,0 +1,79 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.dispatch import receiver
+
+from . import fragments, keycache, rollups, search
+from .models import EncryptedData, EncryptedFile, EncryptionKey, FileSegment
+
+
+@receiver([post_save, post_delete], sender=EncryptionKey)
+def invalidate_key_resolution(sender, instance, **kwargs):
+    # After commit: a bump inside the transaction lets another worker re-cache the
+    # old row, which it still sees, under the new version
+    user_id = instance.user_id
+    transaction.on_commit(lambda: keycache.invalidate_user(user_id))
+
+
+@receiver(post_save, sender=EncryptedData)
+@receiver(post_save, sender=EncryptedFile)
+def index_record_name(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_record(instance)
+
+
+@receiver(post_delete, sender=EncryptedData)
+@receiver(post_delete, sender=EncryptedFile)
+def unindex_record(sender, instance, **kwargs):
+    search.unindex_record(search.kind_for(instance), instance.pk)
+
+
+@receiver(post_delete, sender=EncryptedFile)
+def delete_file_blob(sender, instance, **kwargs):
+    # Only once the deletion commits, so a rolled-back delete keeps its blob
+    name, storage = instance.encrypted_file.name, instance.encrypted_file.storage
+    if name:
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_delete, sender=FileSegment)
+def delete_segment_blob(sender, instance, **kwargs):
+    # Segments go with their file (cascade); their blobs only once that commits
+    name, storage = instance.blob.name, instance.blob.storage
+    if name:
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver([post_save, post_delete], sender=EncryptionKey)
+@receiver([post_save, post_delete], sender=EncryptedData)
+@receiver([post_save, post_delete], sender=EncryptedFile)
+def invalidate_record_fragments(sender, instance, **kwargs):
+    fragments.invalidate(instance.user_id, fragments.GLOBAL_SCOPE)
+
+
+# User columns shown in cached fragments (partials/user_rows.html)
+USER_FRAGMENT_FIELDS = frozenset({"username", "email", "is_staff"})
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_fragments(sender, instance, update_fields=None, **kwargs):
+    # Partial saves that touch nothing rendered (last_login on every login) keep the fragments
+    if update_fields is not None and not USER_FRAGMENT_FIELDS.intersection(update_fields):
+        return
+    fragments.invalidate(fragments.GLOBAL_SCOPE)
+
+
+@receiver(user_logged_in)
+def count_login(sender, request, user, **kwargs):
+    rollups.record(user, logins=1)
+
+
+def warm_key_cache(sender, **kwargs):
+    # Run once per worker process, on its first request (avoids DB access in ready())
+    request_started.disconnect(warm_key_cache, dispatch_uid="encryption.warm_key_cache")
+    keycache.warm()
+
+
+request_started.connect(warm_key_cache, dispatch_uid="encryption.warm_key_cache")
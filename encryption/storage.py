@@ -0,0 +1,257 @@
+"""
+Storage backends for encrypted file blobs.
+
+Blobs are written through Django's ``Storage`` API so ``EncryptedFile.encrypted_file``
+can live on local disk or on an S3-compatible object store. Which backend is used is
+controlled by the ``encrypted_files`` alias in ``settings.STORAGES``.
+"""
+from __future__ import annotations
+
+import os
+import tempfile
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, Storage, storages
+from django.utils.deconstruct import deconstructible
+
+from . import metrics
+
+ENCRYPTED_FILES_ALIAS = "encrypted_files"
+
+
+def get_encrypted_storage() -> Storage:
+    """Return the storage configured for encrypted blobs (used as FileField storage)."""
+    return storages[ENCRYPTED_FILES_ALIAS]
+
+
+def _timer(backend: str, op: str):
+    return metrics.STORAGE_LATENCY.labels(backend, op).time()
+
+
+class ShardedNameMixin:
+    """Spread new names over ``<dir>/<aa>/<bb>/<name>`` so no directory grows unbounded.
+
+    Shards are random rather than derived from the file name, so many uploads of
+    ``report.pdf`` don't pile up in a single directory. Existing flat names such as
+    ``encrypted_files/figma.png`` keep resolving because only new names are sharded.
+    """
+
+    shard_depth = 2
+    shard_width = 2
+
+    def shard_parts(self) -> list:
+        token = uuid.uuid4().hex
+        return [
+            token[i * self.shard_width : (i + 1) * self.shard_width]
+            for i in range(self.shard_depth)
+        ]
+
+    def generate_filename(self, filename):
+        filename = super().generate_filename(filename)
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, *self.shard_parts(), basename).replace("\\", "/")
+
+
+@deconstructible(path="encryption.storage.ShardedFileSystemStorage")
+class ShardedFileSystemStorage(ShardedNameMixin, FileSystemStorage):
+    """Local storage with a sharded layout and atomic (temp file + rename) writes.
+
+    Content is streamed chunk by chunk into a temp file in the target directory and
+    only published under its final name once fully written, so readers never see a
+    partially written blob.
+    """
+
+    def __init__(self, *args, shard_depth: Optional[int] = None, shard_width: Optional[int] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if shard_depth is not None:
+            self.shard_depth = shard_depth
+        if shard_width is not None:
+            self.shard_width = shard_width
+
+    def _make_directory(self, directory: str) -> None:
+        try:
+            if self.directory_permissions_mode is not None:
+                old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+                try:
+                    os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+                finally:
+                    os.umask(old_umask)
+            else:
+                os.makedirs(directory, exist_ok=True)
+        except FileExistsError:
+            raise FileExistsError("%s exists and is not a directory." % directory)
+
+    def _publish(self, tmp_path: str, full_path: str) -> None:
+        """Move the finished temp file into place without clobbering other writers."""
+        if self._allow_overwrite:
+            os.replace(tmp_path, full_path)
+            return
+        try:
+            # link() fails with FileExistsError instead of silently replacing
+            os.link(tmp_path, full_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # Filesystems without hard links: best effort no-clobber rename
+            if os.path.exists(full_path):
+                raise FileExistsError(full_path)
+            os.replace(tmp_path, full_path)
+
+    def _open(self, name, mode="rb"):
+        with _timer("filesystem", "open"):
+            return super()._open(name, mode)
+
+    def delete(self, name):
+        with _timer("filesystem", "delete"):
+            super().delete(name)
+
+    def _save(self, name, content):
+        with _timer("filesystem", "save"):
+            return self._atomic_save(name, content)
+
+    def _atomic_save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        self._make_directory(directory)
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".part", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    tmp.write(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+
+            while True:
+                try:
+                    self._publish(tmp_path, full_path)
+                    break
+                except FileExistsError:
+                    # Another writer won the name; pick a fresh one and retry
+                    name = self.get_available_name(name)
+                    full_path = self.path(name)
+                    self._make_directory(os.path.dirname(full_path))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        name = os.path.relpath(full_path, self.location)
+        self._ensure_location_group_id(full_path)
+        return str(name).replace("\\", "/")
+
+
+@deconstructible(path="encryption.storage.S3Storage")
+class S3Storage(ShardedNameMixin, Storage):
+    """Minimal S3-compatible backend (AWS S3, MinIO, moto) built on boto3.
+
+    Uploads go through ``upload_fileobj`` which streams multipart chunks, and a PUT
+    only becomes visible once complete, so writes are atomic by construction.
+    Reads download into a spooled temp file to keep memory bounded.
+    """
+
+    spool_max_size = 8 * 1024 * 1024
+
+    def __init__(
+        self,
+        bucket_name: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        region_name: Optional[str] = None,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        location: str = "",
+        querystring_expire: int = 3600,
+        client=None,
+    ):
+        self.bucket_name = bucket_name or getattr(settings, "AWS_STORAGE_BUCKET_NAME", None) or os.environ.get("AWS_STORAGE_BUCKET_NAME") or None
+        self.endpoint_url = endpoint_url or getattr(settings, "AWS_S3_ENDPOINT_URL", None) or os.environ.get("AWS_S3_ENDPOINT_URL") or None
+        self.region_name = region_name or getattr(settings, "AWS_S3_REGION_NAME", None) or os.environ.get("AWS_S3_REGION_NAME") or None
+        self.access_key = access_key or getattr(settings, "AWS_ACCESS_KEY_ID", None) or os.environ.get("AWS_ACCESS_KEY_ID") or None
+        self.secret_key = secret_key or getattr(settings, "AWS_SECRET_ACCESS_KEY", None) or os.environ.get("AWS_SECRET_ACCESS_KEY") or None
+        self.location = location.strip("/")
+        self.querystring_expire = querystring_expire
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            # boto3 is slow to import and only needed when S3 is configured
+            try:
+                import boto3  # type: ignore
+            except ImportError:  # pragma: no cover
+                raise RuntimeError("boto3 is required for S3Storage; install boto3 to use it")
+            self._client = boto3.client(
+                "s3",
+                endpoint_url=self.endpoint_url,
+                region_name=self.region_name,
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+            )
+        return self._client
+
+    def _key(self, name: str) -> str:
+        name = str(name).replace("\\", "/").lstrip("/")
+        return f"{self.location}/{name}" if self.location else name
+
+    def _open(self, name, mode="rb"):
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        with _timer("s3", "open"):
+            self.client.download_fileobj(self.bucket_name, self._key(name), spooled)
+        spooled.seek(0)
+        return File(spooled, name=name)
+
+    def _save(self, name, content):
+        if hasattr(content, "seek") and not getattr(content, "closed", False):
+            try:
+                content.seek(0)
+            except (AttributeError, OSError, ValueError):
+                pass
+        with _timer("s3", "save"):
+            self.client.upload_fileobj(content.file if hasattr(content, "file") else content, self.bucket_name, self._key(name))
+        return str(name).replace("\\", "/")
+
+    def delete(self, name):
+        with _timer("s3", "delete"):
+            self.client.delete_object(Bucket=self.bucket_name, Key=self._key(name))
+
+    def exists(self, name):
+        from botocore.exceptions import ClientError  # type: ignore
+
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=self._key(name))
+            return True
+        except ClientError:
+            return False
+
+    def size(self, name):
+        head = self.client.head_object(Bucket=self.bucket_name, Key=self._key(name))
+        return head["ContentLength"]
+
+    def get_modified_time(self, name):
+        head = self.client.head_object(Bucket=self.bucket_name, Key=self._key(name))
+        return head["LastModified"]
+
+    def url(self, name):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket_name, "Key": self._key(name)},
+            ExpiresIn=self.querystring_expire,
+        )
+
+    def listdir(self, path):
+        prefix = self._key(path).rstrip("/")
+        prefix = f"{prefix}/" if prefix else ""
+        directories, files = [], []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter="/"):
+            for entry in page.get("CommonPrefixes", []):
+                directories.append(entry["Prefix"][len(prefix):].rstrip("/"))
+            for entry in page.get("Contents", []):
+                files.append(entry["Key"][len(prefix):])
+        return directories, files
@@ -1,3 +1,965 @@
-from django.test import TestCase
+import base64
+import gc
+import importlib.util
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import batch, checks, ciphers, fragments, integrity, metrics, otp, ratelimit, rollups, search, segments, vault
+from .ciphers import generate_key
+from .locks import VersionConflict
+from .models import BlindIndex, DailyActivity, EncryptedData, EncryptedFile, EncryptionKey, FileSegment, TwoFactorCode
+
+
+def setUpModule():
+    # Write activity rollups through: counts buffered by one test (for users that
+    # test created) must not be flushed into a later one
+    override = override_settings(ROLLUP_FLUSH_INTERVAL=0)
+    override.enable()
+    unittest.addModuleCleanup(override.disable)
+
+
+def _run_concurrently(fn, args_list):
+    """Call ``fn(*args)`` for every item in ``args_list`` on its own thread, released together."""
+    barrier = threading.Barrier(len(args_list))
+    results = [None] * len(args_list)
+
+    def worker(i, args):
+        try:
+            barrier.wait()
+            results[i] = fn(*args)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i, args)) for i, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class OTPTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+
+    def test_code_is_stored_hashed(self):
+        code = otp.issue(self.user)
+        self.assertRegex(code, r'^\d{6}$')
+        stored = TwoFactorCode.objects.get(user=self.user)
+        self.assertNotIn(code, stored.code_hash)
+
+    def test_code_works_once(self):
+        code = otp.issue(self.user)
+        self.assertEqual(otp.verify(self.user.pk, code), otp.SUCCESS)
+        self.assertEqual(otp.verify(self.user.pk, code), otp.MISSING)
+
+    def test_new_code_replaces_old(self):
+        old = otp.issue(self.user)
+        new = otp.issue(self.user)
+        if old != new:
+            self.assertEqual(otp.verify(self.user.pk, old), otp.INVALID)
+        self.assertEqual(otp.verify(self.user.pk, new), otp.SUCCESS)
+
+    @override_settings(OTP_TTL_SECONDS=0)
+    def test_expired_code(self):
+        code = otp.issue(self.user)
+        self.assertEqual(otp.verify(self.user.pk, code), otp.EXPIRED)
+
+    @override_settings(OTP_MAX_ATTEMPTS=3)
+    def test_lockout_after_wrong_guesses(self):
+        code = otp.issue(self.user)
+        wrong = f'{(int(code) + 1) % 1_000_000:06d}'
+        for _ in range(3):
+            self.assertEqual(otp.verify(self.user.pk, wrong), otp.INVALID)
+        self.assertEqual(otp.verify(self.user.pk, code), otp.LOCKED)
+
+
+class OTPConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'pw')
+
+    def test_concurrent_correct_submissions_succeed_once(self):
+        code = otp.issue(self.user)
+        results = _run_concurrently(otp.verify, [(self.user.pk, code)] * 8)
+        self.assertEqual(results.count(otp.SUCCESS), 1)
+        self.assertTrue(TwoFactorCode.objects.get(user=self.user).used)
+
+    @override_settings(OTP_MAX_ATTEMPTS=100)
+    def test_concurrent_wrong_guesses_are_all_counted(self):
+        code = otp.issue(self.user)
+        wrong = f'{(int(code) + 1) % 1_000_000:06d}'
+        results = _run_concurrently(otp.verify, [(self.user.pk, wrong)] * 8)
+        self.assertEqual(results, [otp.INVALID] * 8)
+        self.assertEqual(TwoFactorCode.objects.get(user=self.user).attempts, 8)
+
+    @override_settings(OTP_MAX_ATTEMPTS=3)
+    def test_concurrent_wrong_guesses_stop_at_limit(self):
+        code = otp.issue(self.user)
+        wrong = f'{(int(code) + 1) % 1_000_000:06d}'
+        _run_concurrently(otp.verify, [(self.user.pk, wrong)] * 8)
+        self.assertEqual(TwoFactorCode.objects.get(user=self.user).attempts, 3)
+        self.assertEqual(otp.verify(self.user.pk, code), otp.LOCKED)
+
+
+class FileCoordinationStressTests(TransactionTestCase):
+    """Concurrent appends and deletes of one file, as several app nodes would issue them."""
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media, LOCK_DIR=lock_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('carol', 'carol@example.com', 'pw')
+        self.key = EncryptionKey.objects.create(user=self.user, key_name='k', key_value=generate_key())
+        self.file = segments.create(self.key, self.user, 'log.bin', [], size=1024)
+
+    def _blobs(self):
+        return [name for _, _, names in os.walk(self.media) for name in names]
+
+    def _append(self, marker, expected_version=None):
+        try:
+            encrypted_file = EncryptedFile.objects.select_related('key').get(pk=self.file.pk)
+            return segments.append(encrypted_file, [marker * 3000], size=1024, expected_version=expected_version)
+        except (EncryptedFile.DoesNotExist, VersionConflict) as exc:
+            return type(exc).__name__
+
+    def _client(self):
+        client = Client()
+        client.force_login(self.user)
+        return client
+
+    def _delete(self, version=None, client=None):
+        data = {} if version is None else {'version': version}
+        return (client or self._client()).post(f'/encryption/delete-file/{self.file.pk}/', data).status_code
+
+    def test_concurrent_appends_are_serialised(self):
+        markers = [bytes([ord('a') + i]) for i in range(8)]
+        results = _run_concurrently(self._append, [(m,) for m in markers])
+        self.assertEqual(results, [3000] * 8)
+
+        encrypted_file = EncryptedFile.objects.get(pk=self.file.pk)
+        self.assertEqual(encrypted_file.size, 8 * 3000)
+        self.assertEqual(encrypted_file.version, 9)
+        rows = list(encrypted_file.segments.order_by('index').values_list('index', 'offset', 'length'))
+        self.assertEqual([index for index, _, _ in rows], list(range(len(rows))))
+        self.assertEqual([offset for _, offset, _ in rows], [sum(r[2] for r in rows[:i]) for i in range(len(rows))])
+        # Each append's bytes are contiguous: appends never interleaved
+        plaintext = b''.join(segments.iter_plaintext(encrypted_file))
+        self.assertEqual(sorted(plaintext[i:i + 3000] for i in range(0, len(plaintext), 3000)),
+                         [m * 3000 for m in markers])
+
+    def test_concurrent_appends_and_delete(self):
+        # Log in up front, so the session and last_login writes stay out of the race
+        client = self._client()
+        calls = [(self._append, (bytes([ord('a') + i]),)) for i in range(6)] + [(self._delete, (None, client))]
+        results = _run_concurrently(lambda fn, args: fn(*args), calls)
+
+        self.assertEqual(results[-1], 302)
+        self.assertTrue(all(r in (3000, 'DoesNotExist') for r in results[:-1]), results)
+        self.assertFalse(EncryptedFile.objects.filter(pk=self.file.pk).exists())
+        self.assertFalse(FileSegment.objects.exists())
+        # Appends that ran before the delete had their blobs removed with it; later ones wrote none
+        self.assertEqual(self._blobs(), [])
+
+    def test_stale_version_is_refused(self):
+        self.assertEqual(self._append(b'x', expected_version=1), 3000)
+        self.assertEqual(self._append(b'y', expected_version=1), 'VersionConflict')
+        self.assertEqual(self._delete(version=1), 302)
+        self.assertTrue(EncryptedFile.objects.filter(pk=self.file.pk).exists())
+        self.assertEqual(self._delete(version=2), 302)
+        self.assertFalse(EncryptedFile.objects.filter(pk=self.file.pk).exists())
+
+    def test_only_the_owner_can_delete(self):
+        intruder = User.objects.create_user('mallory', 'mallory@example.com', 'pw')
+        client = Client()
+        client.force_login(intruder)
+        client.post(f'/encryption/delete-file/{self.file.pk}/')
+        self.assertTrue(EncryptedFile.objects.filter(pk=self.file.pk).exists())
+        self.assertEqual(client.get(f'/encryption/delete-file/{self.file.pk}/').status_code, 405)
+
+
+class MetricCellTests(TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('test_total', 'test', ('op',)).labels('x')
+        self.histogram = self.registry.histogram('test_seconds', 'test').labels()
+
+    def test_exited_threads_do_not_accumulate_cells(self):
+        def work():
+            self.counter.inc()
+            self.histogram.observe(0.003)
+
+        for _ in range(500):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        for _ in range(50):
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for _ in range(8):
+                    pool.submit(work)
+        gc.collect()
+
+        self.assertLessEqual(len(self.counter._cells), 3)
+        self.assertLessEqual(len(self.histogram._cells), 3)
+        self.assertEqual(self.counter.value(), [500 + 50 * 8])
+        # Every bucket plus the sum: the bucket counts add up to the observations
+        self.assertEqual(sum(self.histogram.value()[:-1]), 500 + 50 * 8)
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('dave', 'dave@example.com', 'pw')
+        self.key = EncryptionKey.objects.create(user=self.user, key_name='k', key_value=generate_key())
+
+    def _blobs(self):
+        return [name for _, _, names in os.walk(self.media) for name in names]
+
+    def test_failing_entries_leave_no_blobs(self):
+        def entries():
+            for i in range(10):
+                yield f'{i}.txt', b'x' * 100
+            raise batch.BatchLimitExceeded('too many')
+
+        with self.assertRaises(batch.BatchLimitExceeded):
+            batch.encrypt_batch(self.key, self.user, entries(), max_workers=2)
+        self.assertEqual(self._blobs(), [])
+        self.assertFalse(EncryptedFile.objects.exists())
+
+    @override_settings(BATCH_MAX_ENTRY_BYTES=1000)
+    def test_entry_size_limit(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('small.txt', b'x' * 1000)
+            zf.writestr('bomb.txt', b'\0' * 100000)
+        upload = SimpleUploadedFile('batch.zip', archive.getvalue())
+
+        entries = batch.iter_entries([upload])
+        self.assertEqual(next(entries), ('small.txt', b'x' * 1000))
+        with self.assertRaises(batch.BatchLimitExceeded):
+            next(entries)
+        with self.assertRaises(batch.BatchLimitExceeded):
+            list(batch.iter_entries([SimpleUploadedFile('big.bin', b'x' * 1001)]))
+
+    @override_settings(BATCH_MAX_ENTRY_BYTES=1000)
+    def test_entry_size_limit_ignores_declared_size(self):
+        # A header that understates the size is caught by counting the bytes read
+        with self.assertRaises(batch.BatchLimitExceeded):
+            batch._read_entry('liar.bin', io.BytesIO(b'x' * 5000), declared_size=10)
+
+
+class BlindIndexTests(TestCase):
+    def setUp(self):
+        self.users = []
+        self.records = []
+        for name in ('erin', 'frank'):
+            user = User.objects.create_user(name, f'{name}@example.com', 'pw')
+            key = EncryptionKey.objects.create(user=user, key_name='k', key_value=generate_key())
+            record = EncryptedData.create('token', data_name='Tax Report 2026', key=key, user=user)
+            search.index_record(record)
+            search.index_tokens(record, 'quarterly figures')
+            self.users.append(user)
+            self.records.append(record)
+
+    def test_digests_differ_between_users(self):
+        first, second = (
+            set(BlindIndex.objects.filter(user=user).values_list('digest', flat=True)) for user in self.users
+        )
+        self.assertTrue(first)
+        self.assertFalse(first & second)
+
+    def test_search_is_scoped_to_the_user(self):
+        erin, frank = self.users
+        self.assertEqual(list(search.search_ids('tax report 2026', 'data', search.MODE_EXACT, user=erin)),
+                         [self.records[0].pk])
+        self.assertEqual(list(search.search_ids('figures quarterly', 'data', search.MODE_TOKEN, user=frank.pk)),
+                         [self.records[1].pk])
+        with self.assertRaises(ValueError):
+            search.search_ids('tax', 'data')
+
+    def test_admin_search_longer_than_indexed_prefix(self):
+        erin = self.users[0]
+        key = EncryptionKey.objects.get(user=erin)
+        # Shares the first 12 characters of 'Tax Report 2026'
+        other = EncryptedData.create('token', data_name='Tax Report 2027', key=key, user=erin)
+        search.index_record(other)
+        admin_user = User.objects.create_superuser('root', 'root@example.com', 'pw')
+        client = Client()
+        client.force_login(admin_user)
+        response = client.get('/admin/encryption/encrypteddata/', {'q': 'tax report 2026', 'user__id__exact': erin.pk})
+        self.assertEqual([obj.pk for obj in response.context['cl'].result_list], [self.records[0].pk])
+        response = client.get('/admin/encryption/encrypteddata/', {'q': 'tax report 2027', 'user__id__exact': erin.pk})
+        self.assertEqual([obj.pk for obj in response.context['cl'].result_list], [other.pk])
+
+    def test_admin_name_search_needs_a_user(self):
+        admin_user = User.objects.create_superuser('root', 'root@example.com', 'pw')
+        client = Client()
+        client.force_login(admin_user)
+        response = client.get('/admin/encryption/encrypteddata/', {'q': 'tax report'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+        self.assertIn('Select a user', ' '.join(str(m) for m in response.context['messages']))
+
+
+LOCMEM = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+SHARED = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost:6379'}}
+
+
+class SharedCacheCheckTests(SimpleTestCase):
+    def _ids(self, check):
+        return [message.id for message in check(None)]
+
+    @override_settings(CACHES=LOCMEM, DEBUG=True)
+    def test_several_workers_need_a_shared_cache(self):
+        with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+            self.assertEqual(self._ids(checks.check_shared_cache), ['encryption.E001'])
+        with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '1'}):
+            self.assertEqual(self._ids(checks.check_shared_cache), [])
+
+    @override_settings(CACHES=LOCMEM, DEBUG=False)
+    def test_deploy_needs_a_shared_cache(self):
+        with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '1'}):
+            self.assertEqual(self._ids(checks.check_shared_cache_deploy), ['encryption.E002'])
+        with override_settings(CACHES=SHARED), mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+            self.assertEqual(self._ids(checks.check_shared_cache), [])
+            self.assertEqual(self._ids(checks.check_shared_cache_deploy), [])
+
+
+class UserFragmentInvalidationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('grace', 'grace@example.com', 'pw')
+
+    def test_login_keeps_fragments(self):
+        version = fragments.records_version()
+        Client().force_login(self.user)
+        self.assertEqual(fragments.records_version(), version)
+
+    def test_rendered_fields_invalidate(self):
+        version = fragments.records_version()
+        self.user.email = 'grace@example.org'
+        self.user.save(update_fields=['email'])
+        self.assertNotEqual(fragments.records_version(), version)
+        version = fragments.records_version()
+        self.user.save()
+        self.assertNotEqual(fragments.records_version(), version)
+
+
+class IntegritySweepTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('heidi', 'heidi@example.com', 'pw')
+        key = EncryptionKey.objects.create(user=user, key_name='k', key_value=generate_key())
+        cipher = key.get_cipher()
+        self.records = [
+            EncryptedData.create(cipher.encrypt_text(f'value {i}'), data_name=f'r{i}', key=key, user=user)
+            for i in range(25)
+        ]
+        self.broken = EncryptedData.create('not a token', data_name='broken', key=key, user=user)
+
+    def test_sweep_visits_each_pending_record_once(self):
+        report = integrity.sweep(['data'], max_age=timedelta(days=1), chunk_size=4)
+        self.assertEqual((report['checked'], report['failed']), (26, 1))
+        self.assertEqual(EncryptedData.objects.filter(verified_at__isnull=True).get(), self.broken)
+        # Only the failed record is still due
+        report = integrity.sweep(['data'], max_age=timedelta(days=1), chunk_size=4)
+        self.assertEqual((report['checked'], report['failed']), (1, 1))
+
+    def test_limit(self):
+        report = integrity.sweep(['data'], max_age=timedelta(days=1), chunk_size=4, limit=10)
+        self.assertEqual(report['checked'], 10)
+        self.assertEqual(EncryptedData.objects.filter(verified_at__isnull=False).count(), 10)
+
+
+class FragmentKeyMaterialTests(TestCase):
+    def test_key_material_is_not_cached(self):
+        from django.core.cache import cache
+
+        user = User.objects.create_superuser('ivan', 'ivan@example.com', 'pw')
+        key = EncryptionKey.objects.create(user=user, key_name='k', key_value=generate_key())
+        client = Client()
+        client.force_login(user)
+        for url in ('/encryption/dashboard/', '/encryption/records/', '/encryption/admin-panel/'):
+            response = client.get(url)
+            self.assertIn(key.key_value, b''.join(response.streaming_content).decode())
+        # LocMemCache keeps pickled values; none may contain the key
+        self.assertTrue(cache._cache)
+        self.assertFalse([value for value in cache._cache.values() if key.key_value.encode() in value])
+
+
+class KeyCacheInvalidationTests(TestCase):
+    def test_version_bumps_after_commit(self):
+        from .keycache import key_cache, resolve_key
+
+        user = User.objects.create_user('judy', 'judy@example.com', 'pw')
+        key = EncryptionKey.objects.create(user=user, key_name='k', key_value='v1')
+        key_cache.clear()
+        version = key_cache._version(user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            key.key_value = 'v2'
+            key.save()
+            # Other workers still see the old row until commit: keep the version
+            self.assertEqual(key_cache._version(user.pk), version)
+        self.assertNotEqual(key_cache._version(user.pk), version)
+        self.assertEqual(resolve_key(user, 'k').key_value, 'v2')
+
+    def test_warm_reads_versions_once(self):
+        from django.core.cache import cache
+
+        from .keycache import key_cache, resolve_key, warm
+
+        users = [User.objects.create_user(f'warm{i}', f'warm{i}@example.com', 'pw') for i in range(5)]
+        for user in users:
+            EncryptionKey.objects.create(user=user, key_name='k', key_value=f'v{user.pk}')
+        key_cache.clear()
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            self.assertEqual(warm(), 5)
+        self.assertEqual(get_many.call_count, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_key(users[0], 'k').key_value, f'v{users[0].pk}')
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(f'roll{i}', f'roll{i}@example.com', 'pw') for i in range(2)]
+        self.today = timezone.localdate()
+
+    def test_apply_creates_then_adds(self):
+        from collections import Counter
+
+        rollups._apply(self.today, self.users[0].pk, Counter(encryptions=2, bytes_processed=10))
+        rollups._apply(self.today, self.users[0].pk, Counter(encryptions=1, logins=1))
+        row = DailyActivity.objects.get(day=self.today, user=self.users[0])
+        self.assertEqual((row.encryptions, row.bytes_processed, row.logins, row.decryptions), (3, 10, 1, 0))
+
+    def test_daily_totals(self):
+        from collections import Counter
+
+        yesterday = self.today - timedelta(days=1)
+        rollups._apply(self.today, self.users[0].pk, Counter(decryptions=2))
+        rollups._apply(self.today, self.users[1].pk, Counter(decryptions=3))
+        rollups._apply(yesterday, self.users[1].pk, Counter(logins=4))
+        rollups._apply(self.today - timedelta(days=9), self.users[0].pk, Counter(logins=7))
+
+        totals = rollups.daily_totals(3, today=self.today)
+        self.assertEqual(totals['days'], [(self.today - timedelta(days=i)).isoformat() for i in (2, 1, 0)])
+        self.assertEqual(totals['decryptions'], [0, 0, 5])
+        self.assertEqual(totals['logins'], [0, 4, 0])
+        self.assertEqual(rollups.daily_totals(3, user=self.users[0], today=self.today)['decryptions'], [0, 0, 2])
+
+
+class RollupFlusherTests(TransactionTestCase):
+    @override_settings(ROLLUP_FLUSH_INTERVAL=0.05)
+    def test_idle_buffer_is_flushed(self):
+        user = User.objects.create_user('kim', 'kim@example.com', 'pw')
+        buffer = rollups.RollupBuffer()
+        self.addCleanup(buffer.stop)
+        buffer.add(user.pk, encryptions=1)
+        buffer.add(user.pk, encryptions=1)
+        # No further events: the background thread writes the counts
+        deadline = time.monotonic() + 5
+        while not DailyActivity.objects.filter(user=user).exists() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(DailyActivity.objects.get(user=user).encryptions, 2)
+
+    @override_settings(ROLLUP_FLUSH_INTERVAL=3600)
+    def test_stop_flushes(self):
+        user = User.objects.create_user('lou', 'lou@example.com', 'pw')
+        buffer = rollups.RollupBuffer()
+        buffer.add(user.pk, logins=1)
+        self.assertFalse(DailyActivity.objects.exists())
+        buffer.stop()
+        self.assertEqual(DailyActivity.objects.get(user=user).logins, 1)
+
+
+class VaultTests(TransactionTestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        user = User.objects.create_user('vera', 'vera@example.com', 'pw')
+        key = EncryptionKey.objects.create(user=user, key_name='k', key_value=generate_key())
+        EncryptedData.create(key.get_cipher().encrypt_text('secret'), user=user, key=key, data_name='note')
+        batch.encrypt_batch(key, user, [(f'f{i}.txt', b'%d' % i * 100) for i in range(3)])
+        segments.create(key, user, 'log.bin', [b'a' * 3000], size=1024)
+
+    def _blobs(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media)
+            for root, _, names in os.walk(self.media) for name in names
+        )
+
+    def _referenced(self):
+        names = [f.encrypted_file.name for f in EncryptedFile.objects.filter(segmented=False)]
+        return sorted(names + list(FileSegment.objects.values_list('blob', flat=True)))
+
+    def _export(self):
+        archive = io.BytesIO()
+        vault.export_vault(archive, chunk_size=2)
+        archive.seek(0)
+        # Start over from an empty database and storage
+        User.objects.all().delete()
+        shutil.rmtree(self.media)
+        os.makedirs(self.media)
+        return archive
+
+    def test_round_trip(self):
+        plaintext = {f.file_name: b''.join(segments.iter_plaintext(f)) for f in EncryptedFile.objects.all()}
+        archive = self._export()
+
+        counts = vault.import_vault(archive, create_users=True)
+        self.assertEqual((counts['keys'], counts['data'], counts['files']), (1, 1, 4))
+        record = EncryptedData.objects.select_related('key', 'payload').get(data_name='note')
+        self.assertEqual(record.key.get_cipher().decrypt_text(record.encrypted_value), 'secret')
+        files = EncryptedFile.objects.select_related('key')
+        self.assertEqual({f.file_name: b''.join(segments.iter_plaintext(f)) for f in files}, plaintext)
+        self.assertEqual(self._blobs(), self._referenced())
+
+    def test_tampered_manifest(self):
+        from .keycache import key_cache
+
+        source = self._export()
+        # Drop the last chunk of file rows; the blobs before it are still in the archive
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=source, mode='r') as src, \
+                tarfile.open(fileobj=archive, mode='w', format=tarfile.PAX_FORMAT) as dst:
+            for member in src.getmembers():
+                if member.name != 'files/000002.jsonl':
+                    dst.addfile(member, src.extractfile(member))
+        archive.seek(0)
+        version = key_cache._version(0)
+
+        with self.assertRaisesMessage(vault.VaultError, 'do not match the manifest'):
+            vault.import_vault(archive, create_users=True)
+        # The first chunk stays imported; blobs stored for the dropped rows are removed
+        self.assertEqual(EncryptedFile.objects.count(), 2)
+        self.assertEqual(self._blobs(), self._referenced())
+        self.assertNotEqual(key_cache._version(0), version)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('wes', 'wes@example.com', 'pw')
+        self.key = EncryptionKey.objects.create(user=self.user, key_name='k', key_value=generate_key())
+        for i in range(3):
+            EncryptedData.create(f'token{i}', user=self.user, key=self.key, data_name=f'note{i}')
+        self.client.force_login(self.user)
+
+    def test_conditional_requests(self):
+        response = self.client.get('/encryption/api/data/')
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        self.assertEqual(self.client.get('/encryption/api/data/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client.get('/encryption/api/data/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # Another selection of fields is another representation
+        response = self.client.get('/encryption/api/data/?fields=id', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_follows_rows_without_signals(self):
+        EncryptedFile.objects.create(user=self.user, key=self.key, file_name='a.bin', encrypted_file='a.bin')
+        etag = self.client.get('/encryption/api/files/')['ETag']
+        # A queryset update sends no signal and leaves the cache counters alone
+        EncryptedFile.objects.filter(user=self.user).update(version=2)
+        response = self.client.get('/encryption/api/files/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['version'], 2)
+
+    def test_pagination(self):
+        page = self.client.get('/encryption/api/data/?limit=2').json()
+        self.assertEqual([row['data_name'] for row in page['results']], ['note0', 'note1'])
+        page = self.client.get(page['next']).json()
+        self.assertEqual([row['data_name'] for row in page['results']], ['note2'])
+        self.assertIsNone(page['next'])
+        self.assertEqual(self.client.get('/encryption/api/data/?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/encryption/api/data/?after=x').status_code, 400)
+
+    def test_field_selection(self):
+        page = self.client.get('/encryption/api/data/?fields=id,data_name').json()
+        self.assertEqual([sorted(row) for row in page['results']], [['data_name', 'id']] * 3)
+        self.assertNotIn('encrypted_value', self.client.get('/encryption/api/data/').json()['results'][0])
+        row = self.client.get('/encryption/api/data/?fields=encrypted_value').json()['results'][0]
+        self.assertEqual(row, {'encrypted_value': 'token0'})
+        self.assertEqual(self.client.get('/encryption/api/data/?fields=id,bogus').status_code, 400)
+
+    def test_detail_is_scoped_to_the_user(self):
+        record = EncryptedData.objects.get(data_name='note1')
+        response = self.client.get(f'/encryption/api/data/{record.pk}/?fields=data_name')
+        self.assertEqual(response.json(), {'data_name': 'note1'})
+        other = User.objects.create_user('xena', 'xena@example.com', 'pw')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(f'/encryption/api/data/{record.pk}/').status_code, 404)
+
+
+class EncryptingUploadTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('yuri', 'yuri@example.com', 'pw')
+        self.key = EncryptionKey.objects.create(user=self.user, key_name='k', key_value=generate_key())
+        self.client.force_login(self.user)
+        # Key saves invalidate on commit, which never comes in a TestCase, and user ids are reused
+        from .keycache import key_cache
+        key_cache.clear()
+
+    def _blobs(self):
+        return [name for _, _, names in os.walk(self.media) for name in names]
+
+    def _post(self, url, client=None, **extra):
+        upload = SimpleUploadedFile('plain.txt', b'attack at dawn')
+        return (client or self.client).post(url, {'file': upload, 'key_name': 'k'}, **extra)
+
+    def _plaintext(self):
+        encrypted_file = EncryptedFile.objects.select_related('key').get()
+        return encrypted_file.segmented, b''.join(segments.iter_plaintext(encrypted_file))
+
+    def test_key_from_query(self):
+        self.assertEqual(self._post('/encryption/encrypt-file/?key_name=k').status_code, 200)
+        self.assertEqual(self._plaintext(), (True, b'attack at dawn'))
+
+    def test_key_from_header(self):
+        self.assertEqual(self._post('/encryption/encrypt-file/', HTTP_X_KEY_NAME='k').status_code, 200)
+        self.assertEqual(self._plaintext(), (True, b'attack at dawn'))
+
+    def test_unknown_key_uses_default_handlers(self):
+        # The form's key_name still applies once the body is parsed normally
+        self.assertEqual(self._post('/encryption/encrypt-file/?key_name=nope').status_code, 200)
+        self.assertEqual(self._plaintext(), (False, b'attack at dawn'))
+
+    def test_csrf_failure_leaves_no_blobs(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        self.assertEqual(self._post('/encryption/encrypt-file/?key_name=k', client=client).status_code, 403)
+        self.assertFalse(EncryptedFile.objects.exists())
+        self.assertEqual(self._blobs(), [])
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FILES=1)
+    def test_parse_error_after_file_leaves_no_blobs(self):
+        # The second file is refused after the first was stored, and request.FILES ends up empty
+        files = [SimpleUploadedFile('plain.txt', b'attack at dawn'), SimpleUploadedFile('more.txt', b'x')]
+        response = self.client.post('/encryption/encrypt-file/?key_name=k', {'file': files})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(EncryptedFile.objects.exists())
+        self.assertEqual(self._blobs(), [])
+
+
+class ShardedFileSystemStorageTests(SimpleTestCase):
+    def setUp(self):
+        from .storage import ShardedFileSystemStorage
+
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        self.storage = ShardedFileSystemStorage(location=self.media)
+
+    def _files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media)
+            for root, _, names in os.walk(self.media) for name in names
+        )
+
+    def test_save_is_sharded(self):
+        from django.core.files.base import ContentFile
+
+        name = self.storage.save(self.storage.generate_filename('encrypted_files/a.bin'), ContentFile(b'x' * 100))
+        self.assertRegex(name, r'^encrypted_files/[0-9a-f]{2}/[0-9a-f]{2}/a\.bin$')
+        self.assertEqual(self._files(), [name])
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'x' * 100)
+
+    def test_failed_write_publishes_nothing(self):
+        from django.core.files.base import File
+
+        class Broken(File):
+            def chunks(self, chunk_size=None):
+                yield b'partial'
+                raise OSError('disk full')
+
+        with self.assertRaises(OSError):
+            self.storage.save('encrypted_files/b.bin', Broken(io.BytesIO(), name='b.bin'))
+        # Neither the final name nor the temp file is left behind
+        self.assertEqual(self._files(), [])
+
+    def test_name_taken_by_another_writer(self):
+        from django.core.files.base import ContentFile
+
+        # Another writer publishes the name between get_available_name() and the rename
+        os.makedirs(os.path.join(self.media, 'encrypted_files'))
+        with open(os.path.join(self.media, 'encrypted_files', 'c.bin'), 'wb') as f:
+            f.write(b'theirs')
+        name = self.storage._atomic_save('encrypted_files/c.bin', ContentFile(b'ours'))
+
+        self.assertNotEqual(name, 'encrypted_files/c.bin')
+        with self.storage.open('encrypted_files/c.bin') as f:
+            self.assertEqual(f.read(), b'theirs')
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'ours')
+        self.assertEqual(self._files(), sorted(['encrypted_files/c.bin', name]))
+
+
+@unittest.skipUnless(
+    all(importlib.util.find_spec(module) for module in ('boto3', 'moto')), 'S3 tests need boto3 and moto'
+)
+class S3StorageTests(SimpleTestCase):
+    def setUp(self):
+        import boto3
+        import moto
+
+        mock_aws = moto.mock_aws()
+        mock_aws.start()
+        self.addCleanup(mock_aws.stop)
+        client = boto3.client(
+            's3', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test',
+        )
+        client.create_bucket(Bucket='vault')
+
+        from .storage import S3Storage
+
+        self.storage = S3Storage(bucket_name='vault', location='blobs', client=client)
+        self.client = client
+
+    def test_round_trip(self):
+        from django.core.files.base import ContentFile
+
+        name = self.storage.save(self.storage.generate_filename('encrypted_files/a.bin'), ContentFile(b'x' * 100))
+        self.assertRegex(name, r'^encrypted_files/[0-9a-f]{2}/[0-9a-f]{2}/a\.bin$')
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), 100)
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'x' * 100)
+        # Keys live under the configured location
+        self.client.head_object(Bucket='vault', Key=f'blobs/{name}')
+        self.assertIn('blobs/encrypted_files/', self.storage.url(name))
+
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_listdir(self):
+        from django.core.files.base import ContentFile
+
+        self.storage.save('encrypted_files/aa/one.bin', ContentFile(b'1'))
+        self.storage.save('encrypted_files/two.bin', ContentFile(b'2'))
+        self.assertEqual(self.storage.listdir('encrypted_files'), (['aa'], ['two.bin']))
+
+
+class CipherTests(SimpleTestCase):
+    SUITES = (ciphers.FERNET, ciphers.AES_256_GCM, ciphers.CHACHA20_POLY1305)
+
+    def _tampered(self, token, at=-1):
+        return token[:at] + bytes([token[at] ^ 1]) + (token[at + 1:] if at != -1 else b'')
+
+    def test_round_trips(self):
+        for suite in self.SUITES:
+            with self.subTest(suite=suite):
+                cipher = ciphers.Cipher(generate_key(suite), suite)
+                token = cipher.encrypt(b'attack at dawn')
+                self.assertEqual(cipher.decrypt(token), b'attack at dawn')
+                self.assertTrue(cipher.verify(token))
+                self.assertEqual(cipher.decrypt_text(cipher.encrypt_text('attack at dawn')), 'attack at dawn')
+                self.assertEqual(token.startswith(ciphers.MAGIC), suite != ciphers.FERNET)
+
+    def test_legacy_fernet_token(self):
+        from cryptography.fernet import Fernet
+
+        key = generate_key()
+        token = Fernet(key.encode()).encrypt(b'old row')
+        # Whatever suite the key uses now, header-less tokens decrypt as Fernet
+        cipher = ciphers.Cipher(key, ciphers.AES_256_GCM)
+        self.assertEqual(cipher.decrypt(token), b'old row')
+        self.assertEqual(cipher.decrypt_text(token.decode()), 'old row')
+        self.assertTrue(cipher.verify(token))
+
+    def test_derived_round_trips(self):
+        for suite in self.SUITES:
+            with self.subTest(suite=suite):
+                master = ciphers.Cipher(generate_key(suite), suite)
+                record = master.for_record(ciphers.new_record_id())
+                token = record.encrypt(b'attack at dawn')
+                self.assertTrue(token.startswith(ciphers.DERIVED_MAGIC + record.record_id))
+                # The master key decrypts any record's token
+                self.assertEqual(master.decrypt(token), b'attack at dawn')
+                self.assertTrue(master.verify(token))
+                self.assertEqual(master.decrypt_text(record.encrypt_text('dawn')), 'dawn')
+                # The subkey differs from the master key
+                with self.assertRaises(ciphers.InvalidToken):
+                    master.decrypt(token[len(ciphers.DERIVED_MAGIC) + ciphers.RECORD_ID_SIZE:])
+
+    def test_only_decryption_fills_the_subkey_cache(self):
+        master = ciphers.Cipher(generate_key(ciphers.AES_256_GCM), ciphers.AES_256_GCM)
+        ciphers.subkeys.clear()
+        self.addCleanup(ciphers.subkeys.clear)
+        record = master.for_record(ciphers.new_record_id())
+        with mock.patch.object(ciphers, 'derive_key', wraps=ciphers.derive_key) as derive:
+            tokens = [record.encrypt(b'segment %d' % i) for i in range(3)]
+            self.assertEqual((derive.call_count, len(ciphers.subkeys)), (1, 0))
+            for token in tokens:
+                master.decrypt(token)
+            self.assertEqual((derive.call_count, len(ciphers.subkeys)), (2, 1))
+
+    def test_verify_rejects_tampering(self):
+        for suite in self.SUITES:
+            for derived in (False, True):
+                with self.subTest(suite=suite, derived=derived):
+                    master = ciphers.Cipher(generate_key(suite), suite)
+                    cipher = master.for_record(ciphers.new_record_id()) if derived else master
+                    token = cipher.encrypt(b'attack at dawn')
+                    if suite == ciphers.FERNET and not derived:
+                        # Fernet tokens are base64 text; flip a bit inside the decoded bytes
+                        raw = base64.urlsafe_b64decode(token)
+                        tampered = base64.urlsafe_b64encode(self._tampered(raw, at=30))
+                    else:
+                        tampered = self._tampered(token)
+                    self.assertFalse(master.verify(tampered))
+                    with self.assertRaises(ciphers.InvalidToken):
+                        master.decrypt(tampered)
+                    self.assertFalse(master.verify(token[:20]))
+
+    def test_wrong_key(self):
+        for suite in self.SUITES:
+            with self.subTest(suite=suite):
+                token = ciphers.Cipher(generate_key(suite), suite).encrypt(b'attack at dawn')
+                other = ciphers.Cipher(generate_key(suite), suite)
+                self.assertFalse(other.verify(token))
+                with self.assertRaises(ciphers.InvalidToken):
+                    other.decrypt(token)
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate('5/m'), (5, 60))
+        self.assertEqual(ratelimit.parse_rate('10/30s'), (10, 30))
+        self.assertEqual(ratelimit.parse_rate(' 2 / 5m '), (2, 300))
+        with self.assertRaises(ValueError):
+            ratelimit.parse_rate('5 per minute')
+
+    def _window_edges(self, store):
+        limiter = ratelimit.RateLimiter(5, 60, store=store)
+        start = 600.0  # the first instant of window 10
+        for _ in range(5):
+            self.assertEqual(limiter.hit('k', now=start), (True, 0))
+        self.assertEqual(limiter.hit('k', now=start), (False, 60))
+        # The last instant of the window still counts as this window
+        self.assertEqual(limiter.hit('k', now=start + 59.999), (False, 1))
+
+        # Next window, at its start: all 7 earlier hits still weigh in fully
+        self.assertEqual(limiter.hit('k', now=start + 60), (False, 60))
+        # Three quarters through, they weigh a quarter: 7 * 0.25 + 2, 3, then 4 current hits
+        self.assertEqual(limiter.hit('k', now=start + 105), (True, 0))
+        self.assertEqual(limiter.hit('k', now=start + 105), (True, 0))
+        self.assertEqual(limiter.hit('k', now=start + 105), (False, 15))
+
+        # A window with no hits in between forgets everything
+        self.assertEqual(limiter.hit('k', now=start + 180), (True, 0))
+        self.assertEqual(limiter.hit('other', now=start), (True, 0))
+
+    def test_window_edges_in_memory(self):
+        self._window_edges(ratelimit.MemoryCounterStore())
+
+    def test_window_edges_in_cache(self):
+        from django.core.cache import cache
+
+        store = ratelimit.CacheCounterStore()
+        store.prefix = f'rl-test-{os.getpid()}-{time.monotonic_ns()}'
+        self._window_edges(store)
+        cache.delete_many([f'{store.prefix}:{key}:{n}' for key in ('k', 'other') for n in range(10, 14)])
+
+    def test_decorator(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+
+        view = ratelimit.ratelimit('test')(lambda request: HttpResponse('ok'))
+        factory = RequestFactory()
+        with override_settings(RATELIMITS={'test': {'ip': '2/m'}}), \
+                mock.patch.object(ratelimit, '_store', ratelimit.MemoryCounterStore()):
+            self.assertEqual(view(factory.post('/')).status_code, 200)
+            self.assertEqual(view(factory.post('/')).status_code, 200)
+            # Only the listed methods are counted
+            self.assertEqual(view(factory.get('/')).status_code, 200)
+            response = view(factory.post('/'))
+            self.assertEqual(response.status_code, 429)
+            self.assertTrue(1 <= int(response['Retry-After']) <= 60)
+            self.assertIn(f'Try again in {response["Retry-After"]} seconds', response.content.decode())
+            # Another client has its own budget
+            self.assertEqual(view(factory.post('/', REMOTE_ADDR='10.0.0.2')).status_code, 200)
+            with override_settings(RATELIMIT_ENABLED=False):
+                self.assertEqual(view(factory.post('/')).status_code, 200)
+
+
+@override_settings(FILE_SEGMENT_SIZE=100)
+class SegmentHeaderTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('zoe', 'zoe@example.com', 'pw')
+        self.key = EncryptionKey.objects.create(user=self.user, key_name='k', key_value=generate_key())
+
+    def _read(self, encrypted_file, start=0, end=None):
+        encrypted_file = EncryptedFile.objects.select_related('key').get(pk=encrypted_file.pk)
+        return b''.join(segments.read_range(encrypted_file, start, end))
+
+    def test_append_across_passes(self):
+        encrypted_file = segments.create(self.key, self.user, 'a.bin', [b'a' * 250])
+        self.assertEqual(len(encrypted_file.segment_tag), 32)
+        segments.append(EncryptedFile.objects.select_related('key').get(pk=encrypted_file.pk), [b'b' * 120])
+        self.assertEqual(self._read(encrypted_file), b'a' * 250 + b'b' * 120)
+        self.assertEqual(FileSegment.objects.filter(file=encrypted_file).count(), 5)
+
+    def test_segment_from_another_file(self):
+        first = segments.create(self.key, self.user, 'a.bin', [b'a' * 150])
+        second = segments.create(self.key, self.user, 'b.bin', [b'b' * 150])
+        # Same key, index and offset: only the file tag tells the blobs apart
+        blob = first.segments.get(index=0).blob.name
+        FileSegment.objects.filter(file=second, index=0).update(blob=blob)
+        with self.assertRaises(ciphers.InvalidToken):
+            self._read(second)
+
+    def test_truncation_mid_pass(self):
+        encrypted_file = segments.create(self.key, self.user, 'a.bin', [b'a' * 250])
+        encrypted_file.segments.filter(index=2).delete()
+        EncryptedFile.objects.filter(pk=encrypted_file.pk).update(size=200)
+        self.assertEqual(self._read(encrypted_file, 0, 100), b'a' * 100)
+        with self.assertRaises(ciphers.InvalidToken):
+            self._read(encrypted_file)
+
+    def test_untagged_files_stay_readable(self):
+        # Written the way files were before segment tags existed
+        writer = segments.SegmentWriter(self.key.get_cipher().for_new_record(), 'old.bin')
+        writer.write(b'o' * 150)
+        encrypted_file = segments.create_from_writer(self.key, self.user, 'old.bin', writer)
+        self.assertEqual(encrypted_file.segment_tag, '')
+        segments.append(EncryptedFile.objects.select_related('key').get(pk=encrypted_file.pk), [b'n' * 10])
+        self.assertEqual(self._read(encrypted_file), b'o' * 150 + b'n' * 10)
@@ -0,0 +1,144 @@
+"""
+Upload handler that encrypts file uploads while they are being received.
+
+Django's default handlers spool an upload to memory or a temporary file, then
+the view reads it back to encrypt it, so large plaintexts hit disk and
+are copied several times. ``EncryptingUploadHandler`` passes each chunk coming
+off the socket to a :class:`~encryption.segments.SegmentWriter`. The writer
+stores ciphertext segments directly in the encrypted-files storage, so
+plaintext is never written anywhere and at most one segment of it is held in
+memory.
+
+The key must be known before the file part arrives, but handlers cannot see
+other form fields. So it is read from the ``key_name`` query parameter or the
+``X-Key-Name`` header. Without one (or with an unknown key), the upload passes
+through to the default handlers untouched.
+
+Handlers must be installed before the body is parsed, and CSRF checking parses
+it. The ``encrypt_uploads`` view decorator therefore installs the handler
+under ``csrf_exempt``, runs the view under ``csrf_protect``, and removes any
+stored segments the view did not keep.
+"""
+from __future__ import annotations
+
+import functools
+from typing import Optional
+
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from . import segments
+from .keycache import resolve_key
+from .models import EncryptionKey
+
+
+class EncryptedUpload:
+    """What ``request.FILES[field]`` holds for a file encrypted on arrival."""
+
+    def __init__(self, name: str, size: int, key, writer: segments.SegmentWriter):
+        self.name = name
+        self.size = size
+        self.key = key
+        self.writer = writer
+        self.saved = False
+
+    def save(self, user):
+        """Record the already-stored segments as ``user``'s file; returns the EncryptedFile."""
+        encrypted_file = segments.create_from_writer(self.key, user, self.name, self.writer)
+        self.saved = True
+        return encrypted_file
+
+    def discard(self) -> None:
+        self.writer.abort()
+
+    def close(self) -> None:
+        # Called by the request and the multipart parser like on any upload; the segments are already stored
+        pass
+
+
+class EncryptingUploadHandler(FileUploadHandler):
+    def __init__(self, request=None, field_name: str = "file"):
+        super().__init__(request)
+        self.field_name = field_name
+        self.key = None
+        self.writer: Optional[segments.SegmentWriter] = None
+        self.upload: Optional[EncryptedUpload] = None
+        self.active = False
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        key_name = self.request.GET.get("key_name") or META.get("HTTP_X_KEY_NAME")
+        if key_name and self.request.user.is_authenticated:
+            try:
+                self.key = resolve_key(self.request.user, key_name)
+            except EncryptionKey.DoesNotExist:
+                self.key = None
+        return None
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        # Only the first file of the expected field is encrypted here
+        self.active = self.key is not None and field_name == self.field_name and self.writer is None
+        if self.active:
+            self.writer = segments.SegmentWriter(
+                self.key.get_cipher().for_new_record(), self.file_name, tag=segments.new_tag()
+            )
+            # The remaining handlers would only buffer a copy of the plaintext
+            raise StopFutureHandlers
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.writer.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        self.writer.close()
+        self.upload = EncryptedUpload(self.file_name, file_size, self.key, self.writer)
+        return self.upload
+
+    def upload_interrupted(self):
+        if self.active:
+            self.writer.abort()
+
+    def discard_unsaved(self) -> None:
+        """Remove the stored segments unless a view recorded them.
+
+        Tracked here rather than found through ``request.FILES``: a parse error
+        after ``file_complete`` leaves the request without its files.
+        """
+        if self.upload is not None:
+            if not self.upload.saved:
+                self.upload.discard()
+        elif self.writer is not None:
+            self.writer.abort()
+
+
+def encrypt_uploads(field_name: str = "file"):
+    """View decorator: encrypt ``field_name`` uploads on arrival (see the module docstring).
+
+    Apply it below ``login_required`` and rate limiting, so rejected requests are
+    turned away before their body is read.
+    """
+
+    def decorator(view):
+        protected = csrf_protect(view)
+
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            handler = None
+            if request.method == "POST":
+                handler = EncryptingUploadHandler(request, field_name)
+                request.upload_handlers.insert(0, handler)
+            try:
+                return protected(request, *args, **kwargs)
+            finally:
+                # Stored but never recorded (CSRF failure, parse error, view error...): drop the blobs
+                if handler is not None:
+                    handler.discard_unsaved()
+
+        return csrf_exempt(wrapped)
+
+    return decorator
@@ -1,6 +1,7 @@
 from django.urls import path
 from . import views
 from . import views_register
+from . import api
 from .views import delete_encrypted_file
 
 urlpatterns = [
@@ -12,11 +13,15 @@ urlpatterns = [
 
 urlpatterns += [
     path('encrypt-file/', views.encrypt_file, name='encrypt_file'),
+    path('encrypt-files/', views.encrypt_files_batch, name='encrypt_files_batch'),
     path('decrypt-file/', views.decrypt_file, name='decrypt_file'),
+    path('append-file/', views.append_file, name='append_file'),
+    path('files/<int:file_id>/download/', views.download_file_range, name='download_file_range'),
 ]
 
 urlpatterns += [
     path('records/', views.record_system, name='record_system'),
+    path('search/', views.search_records, name='search_records'),
 ]
 
 urlpatterns += [
@@ -30,4 +35,17 @@ urlpatterns += [
 urlpatterns += [
     path('delete-file/<int:file_id>/', delete_encrypted_file, name='delete_encrypted_file'),
     path('verify-2fa/', views_register.verify_2fa, name='verify_2fa'),
-]
\ No newline at end of file
+]
+
+urlpatterns += [
+    path('api/keys/', api.list_view, {'resource': 'keys'}, name='api_keys'),
+    path('api/keys/<int:pk>/', api.detail_view, {'resource': 'keys'}, name='api_key_detail'),
+    path('api/data/', api.list_view, {'resource': 'data'}, name='api_data'),
+    path('api/data/<int:pk>/', api.detail_view, {'resource': 'data'}, name='api_data_detail'),
+    path('api/files/', api.list_view, {'resource': 'files'}, name='api_files'),
+    path('api/files/<int:pk>/', api.detail_view, {'resource': 'files'}, name='api_file_detail'),
+]
+
+urlpatterns += [
+    path('metrics/', views.metrics_endpoint, name='metrics'),
+]
@@ -0,0 +1,545 @@
+"""
+Streaming export/import of keys, encrypted data and encrypted file blobs.
+
+A vault archive is a PAX tar stream::
+
+    vault.json            format header
+    keys/000001.jsonl     EncryptionKey rows, ``chunk_size`` per member
+    data/000001.jsonl     EncryptedData rows
+    blobs/<file id>       raw ciphertext of one EncryptedFile
+    blobs/<file id>/<n>   ciphertext of segment ``n`` of a segmented file
+    files/000001.jsonl    EncryptedFile rows (each chunk follows its blobs)
+    manifest.json         row counts and a digest over every member's checksum
+
+Every member carries its SHA-256 in the ``DSVAULT.sha256`` PAX header and is
+verified before it is used. Rows are read with ``iterator()`` and inserted with
+``bulk_create`` one chunk at a time, and members are staged in spooled temp
+files, so memory stays bounded whatever the archive size. Blobs are read from
+(export) or written to (import) storage on a thread pool.
+
+Imports commit chunk by chunk, so a damaged archive can leave the rows read
+before the damage in place; ``dry_run`` verifies a whole archive first.
+
+Users are matched by username. The archive contains key material next to the
+ciphertext it protects; treat it like a database backup.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import fragments, keycache, search
+from .models import EncryptedData, EncryptedFile, EncryptedPayload, EncryptionKey, FileSegment
+from .storage import get_encrypted_storage
+
+FORMAT = "data-security-vault"
+VERSION = 3
+# Version 1 archives predate segmented files and plaintext sizes, version 2 segment tags
+READABLE_VERSIONS = (1, 2, 3)
+CHECKSUM_HEADER = "DSVAULT.sha256"
+
+COPY_CHUNK = 1024 * 1024
+ROWS_SPOOL_SIZE = 8 * 1024 * 1024
+BLOB_SPOOL_SIZE = 1024 * 1024
+
+
+class VaultError(Exception):
+    pass
+
+
+def _spool(max_size: int):
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+
+def _copy(src, dst) -> Tuple[str, int]:
+    """Copy ``src`` to ``dst`` in chunks; return its SHA-256 and size."""
+    sha, size = hashlib.sha256(), 0
+    while True:
+        chunk = src.read(COPY_CHUNK)
+        if not chunk:
+            break
+        sha.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+    return sha.hexdigest(), size
+
+
+def _chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# -- export -----------------------------------------------------------------
+
+
+class _Writer:
+    def __init__(self, fileobj, compress: bool):
+        self.tar = tarfile.open(fileobj=fileobj, mode="w|gz" if compress else "w|", format=tarfile.PAX_FORMAT)
+        self.members = 0
+        self.digest = hashlib.sha256()
+
+    def add(self, name: str, fileobj, size: int, sha: str) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o600
+        info.pax_headers = {CHECKSUM_HEADER: sha}
+        fileobj.seek(0)
+        self.tar.addfile(info, fileobj)
+        self.members += 1
+        self.digest.update(f"{name}\0{sha}\n".encode())
+
+    def add_json(self, name: str, payload: Dict) -> None:
+        data = json.dumps(payload, cls=DjangoJSONEncoder, indent=2).encode()
+        self.add(name, io.BytesIO(data), len(data), hashlib.sha256(data).hexdigest())
+
+    def add_rows(self, name: str, rows: Iterable[Dict]) -> None:
+        with _spool(ROWS_SPOOL_SIZE) as spool:
+            sha, size = hashlib.sha256(), 0
+            for row in rows:
+                line = json.dumps(row, cls=DjangoJSONEncoder, separators=(",", ":")).encode() + b"\n"
+                sha.update(line)
+                spool.write(line)
+                size += len(line)
+            self.add(name, spool, size, sha.hexdigest())
+
+    def close(self) -> None:
+        self.tar.close()
+
+
+def _fetch_blob(storage, name: str):
+    spool = _spool(BLOB_SPOOL_SIZE)
+    try:
+        with storage.open(name, "rb") as src:
+            sha, size = _copy(src, spool)
+    except Exception:
+        spool.close()
+        raise
+    return spool, sha, size
+
+
+def _file_blobs(files) -> Iterator[Tuple[EncryptedFile, Optional[FileSegment]]]:
+    """``(file, segment)`` for every blob of ``files`` in archive order; ``segment`` is None for single-blob files."""
+    for f in files:
+        if f.segmented:
+            for segment in f.segments.order_by("index"):
+                yield f, segment
+        else:
+            yield f, None
+
+
+def export_vault(
+    fileobj,
+    users: Optional[Iterable[str]] = None,
+    chunk_size: int = 1000,
+    workers: int = 4,
+    compress: bool = False,
+    log: Callable[[str], None] = lambda message: None,
+) -> Dict:
+    """Write a vault archive to ``fileobj``; return the manifest."""
+    keys = EncryptionKey.objects.select_related("user").order_by("id")
+    data = EncryptedData.objects.select_related("user", "payload").order_by("id")
+    files = EncryptedFile.objects.select_related("user").order_by("id")
+    if users:
+        users = sorted(set(users))
+        keys, data, files = (qs.filter(user__username__in=users) for qs in (keys, data, files))
+
+    storage = get_encrypted_storage()
+    writer = _Writer(fileobj, compress)
+    counts = {"keys": 0, "data": 0, "files": 0, "blob_bytes": 0}
+    missing = 0
+    writer.add_json("vault.json", {"format": FORMAT, "version": VERSION, "created_at": timezone.now(), "users": users})
+
+    for n, chunk in enumerate(_chunks(keys.iterator(chunk_size=chunk_size), chunk_size), 1):
+        writer.add_rows(f"keys/{n:06d}.jsonl", (
+            {"id": k.id, "user": k.user.username, "key_name": k.key_name, "key_value": k.key_value,
+             "cipher": k.cipher, "created_at": k.created_at.isoformat()}
+            for k in chunk
+        ))
+        counts["keys"] += len(chunk)
+    log(f"keys: {counts['keys']}")
+
+    for n, chunk in enumerate(_chunks(data.iterator(chunk_size=chunk_size), chunk_size), 1):
+        writer.add_rows(f"data/{n:06d}.jsonl", (
+            {"id": d.id, "user": d.user.username, "key": d.key_id, "data_name": d.data_name,
+             "encrypted_value": d.encrypted_value, "created_at": d.created_at.isoformat()}
+            for d in chunk
+        ))
+        counts["data"] += len(chunk)
+    log(f"data: {counts['data']}")
+
+    orphaned = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for n, chunk in enumerate(_chunks(files.iterator(chunk_size=chunk_size), chunk_size), 1):
+            skipped = set()
+            # Segmented files with no data yet have no blobs to wait for
+            rows_by_id = {
+                f.id: _file_row(f) for f in chunk if f.segmented and not f.segments.exists()
+            }
+            # Read ahead a bounded window of blobs in parallel, write them in order
+            window = deque()
+            todo = _file_blobs(chunk)
+
+            def submit(item):
+                f, segment = item
+                name = segment.blob.name if segment is not None else f.encrypted_file.name
+                window.append((f, segment, name, pool.submit(_fetch_blob, storage, name)))
+
+            for item in todo:
+                submit(item)
+                if len(window) >= workers * 2:
+                    break
+            while window:
+                f, segment, name, future = window.popleft()
+                nxt = next(todo, None)
+                if nxt is not None:
+                    submit(nxt)
+                try:
+                    spool, sha, size = future.result()
+                except Exception as exc:
+                    if f.id not in skipped:
+                        missing += 1
+                        skipped.add(f.id)
+                        log(f"skipping file {f.id} ({name}): {exc}")
+                        row = rows_by_id.pop(f.id, None)
+                        if row is not None:
+                            # Segments already written are left out of the import
+                            orphaned.extend(segment["blob"] for segment in row["segments"])
+                    continue
+                if f.id in skipped:
+                    spool.close()
+                    continue
+                member = f"blobs/{f.id}" if segment is None else f"blobs/{f.id}/{segment.index:06d}"
+                with spool:
+                    writer.add(member, spool, size, sha)
+                counts["blob_bytes"] += size
+                if segment is None:
+                    rows_by_id[f.id] = dict(_file_row(f), name=name, blob=member, sha256=sha, size=size)
+                else:
+                    rows_by_id.setdefault(f.id, _file_row(f))["segments"].append(
+                        {"index": segment.index, "offset": segment.offset, "length": segment.length,
+                         "name": name, "blob": member, "sha256": sha, "size": size}
+                    )
+            rows = [rows_by_id[f.id] for f in chunk if f.id in rows_by_id]
+            if rows:
+                writer.add_rows(f"files/{n:06d}.jsonl", rows)
+            counts["files"] += len(rows)
+    log(f"files: {counts['files']} ({counts['blob_bytes']} bytes)")
+
+    manifest = {
+        "format": FORMAT,
+        "version": VERSION,
+        "counts": counts,
+        "missing_blobs": missing,
+        "orphaned_members": orphaned,
+        "members": writer.members,
+        "digest": writer.digest.hexdigest(),
+    }
+    writer.add_json("manifest.json", manifest)
+    writer.close()
+    return manifest
+
+
+def _file_row(f: EncryptedFile) -> Dict:
+    row = {"id": f.id, "user": f.user.username, "key": f.key_id, "file_name": f.file_name,
+           "plaintext_size": f.size, "created_at": f.created_at.isoformat()}
+    if f.segmented:
+        row.update(segmented=True, segment_tag=f.segment_tag, segments=[])
+    return row
+
+
+# -- import -----------------------------------------------------------------
+
+
+class _Importer:
+    def __init__(self, pool, workers: int, create_users: bool, dry_run: bool):
+        self.pool = pool
+        self.workers = workers
+        self.create_users = create_users
+        self.dry_run = dry_run
+        self.storage = get_encrypted_storage()
+        self.user_ids: Dict[str, int] = {}
+        self.key_ids: Dict[int, int] = {}  # exported key id -> local key id
+        self.blobs: Dict[str, object] = {}  # blob member -> future (stored name, sha256)
+        self.touched_users = set()
+        self.counts = {"keys": 0, "data": 0, "files": 0, "blob_bytes": 0}
+
+    def user_id(self, username: str) -> int:
+        if username not in self.user_ids:
+            user = User.objects.filter(username=username).only("id").first()
+            if user is None:
+                if not self.create_users:
+                    raise VaultError(f"User {username!r} does not exist (use --create-users)")
+                user = User(username=username)
+                user.set_unusable_password()
+                if not self.dry_run:
+                    user.save()
+            self.user_ids[username] = user.id
+        self.touched_users.add(self.user_ids[username])
+        return self.user_ids[username]
+
+    def key_id(self, exported_id: int) -> int:
+        try:
+            return self.key_ids[exported_id]
+        except KeyError:
+            raise VaultError(f"Row references key {exported_id}, which is not in the archive")
+
+    @staticmethod
+    def _restore_created_at(model, objs, rows) -> None:
+        # auto_now_add overrides created_at on insert; put the exported values back
+        for obj, row in zip(objs, rows):
+            obj.created_at = parse_datetime(row["created_at"]) if row.get("created_at") else obj.created_at
+        model.objects.bulk_update(objs, ["created_at"], batch_size=500)
+
+    def import_keys(self, rows: List[Dict]) -> None:
+        new_rows, new_keys = [], []
+        for row in rows:
+            user_id = self.user_id(row["user"])
+            existing = EncryptionKey.objects.filter(user_id=user_id, key_name=row["key_name"]).first()
+            if existing is not None:
+                if existing.key_value != row["key_value"] or existing.cipher != row["cipher"]:
+                    raise VaultError(f"Key {row['key_name']!r} of {row['user']!r} already exists with different material")
+                self.key_ids[row["id"]] = existing.id
+                continue
+            new_rows.append(row)
+            new_keys.append(EncryptionKey(user_id=user_id, key_name=row["key_name"], key_value=row["key_value"],
+                                          cipher=row["cipher"]))
+        if self.dry_run:
+            for row in new_rows:
+                self.key_ids[row["id"]] = -row["id"]
+        elif new_keys:
+            with transaction.atomic():
+                created = EncryptionKey.objects.bulk_create(new_keys)
+                self._restore_created_at(EncryptionKey, created, new_rows)
+            for row, key in zip(new_rows, created):
+                self.key_ids[row["id"]] = key.id
+        self.counts["keys"] += len(rows)
+
+    def import_data(self, rows: List[Dict]) -> None:
+        objs = [
+            EncryptedData(user_id=self.user_id(row["user"]), key_id=self.key_id(row["key"]),
+                          data_name=row["data_name"], encrypted_size=len(row["encrypted_value"]))
+            for row in rows
+        ]
+        if not self.dry_run:
+            with transaction.atomic():
+                created = EncryptedData.objects.bulk_create(objs)
+                EncryptedPayload.objects.bulk_create(
+                    [EncryptedPayload(record=obj, value=row["encrypted_value"]) for obj, row in zip(created, rows)],
+                    batch_size=500,
+                )
+                self._restore_created_at(EncryptedData, created, rows)
+                search.index_records(created)
+        self.counts["data"] += len(rows)
+
+    def _store_blob(self, spool, name: str) -> str:
+        with spool:
+            spool.seek(0)
+            return self.storage.save(self.storage.generate_filename(f"encrypted_files/{os.path.basename(name)}"),
+                                     File(spool, name=name))
+
+    def add_blob(self, member: str, spool, sha: str, size: int) -> None:
+        if self.dry_run:
+            spool.close()
+            self.blobs[member] = (None, sha)
+        else:
+            in_flight = [f for f, _ in self.blobs.values() if not f.done()]
+            if len(in_flight) >= self.workers * 2:
+                wait(in_flight, return_when=FIRST_COMPLETED)
+            # The stored name is only known once saved; the row chunk that follows picks it up
+            self.blobs[member] = (self.pool.submit(self._store_blob, spool, member), sha)
+        self.counts["blob_bytes"] += size
+
+    def _take_blob(self, file_id: int, blob: Dict, stored: List[str]) -> str:
+        entry = self.blobs.pop(blob["blob"], None)
+        if entry is None:
+            raise VaultError(f"File {file_id} references missing blob {blob['blob']}")
+        future, sha = entry
+        if sha != blob["sha256"]:
+            raise VaultError(f"Checksum of {blob['blob']} does not match file {file_id}")
+        if future is None:
+            return blob["name"]
+        name = future.result()
+        stored.append(name)
+        return name
+
+    def import_files(self, rows: List[Dict]) -> None:
+        objs, segments, stored = [], [], []
+        try:
+            for row in rows:
+                obj = EncryptedFile(user_id=self.user_id(row["user"]), key_id=self.key_id(row["key"]),
+                                    file_name=row["file_name"], size=row.get("plaintext_size"))
+                if row.get("segmented"):
+                    obj.segmented = True
+                    obj.segment_tag = row.get("segment_tag", "")
+                    segments.append([
+                        FileSegment(index=seg["index"], offset=seg["offset"], length=seg["length"],
+                                    blob=self._take_blob(row["id"], seg, stored))
+                        for seg in row["segments"]
+                    ])
+                else:
+                    obj.encrypted_file = self._take_blob(row["id"], row, stored)
+                    segments.append([])
+                objs.append(obj)
+            if not self.dry_run:
+                with transaction.atomic():
+                    created = EncryptedFile.objects.bulk_create(objs)
+                    self._restore_created_at(EncryptedFile, created, rows)
+                    for obj, file_segments in zip(created, segments):
+                        for segment in file_segments:
+                            segment.file = obj
+                    FileSegment.objects.bulk_create([seg for file_segments in segments for seg in file_segments],
+                                                    batch_size=500)
+                    search.index_records(created)
+        except Exception:
+            # Don't leave orphaned blobs behind for rows that were never inserted
+            for name in stored:
+                self.storage.delete(name)
+            raise
+        self.counts["files"] += len(rows)
+
+    def discard_pending(self) -> None:
+        """Wait for in-flight blob writes and remove blobs no row will reference."""
+        for future, _ in self.blobs.values():
+            if future is None:
+                continue
+            try:
+                self.storage.delete(future.result())
+            except Exception:
+                pass
+        self.blobs.clear()
+
+    def invalidate(self) -> None:
+        """Drop cached key resolutions and fragments that the imported rows make stale."""
+        if not self.dry_run:
+            keycache.invalidate_all()
+            fragments.invalidate(fragments.GLOBAL_SCOPE, *self.touched_users)
+
+    def abort(self) -> None:
+        """Clean up after a failed import; the chunks already committed stay."""
+        self.discard_pending()
+        self.invalidate()
+
+    def finish(self, orphaned: Iterable[str] = ()) -> None:
+        # Segments of files the export had to skip part-way through
+        for member in orphaned:
+            future, _ = self.blobs.pop(member, (None, None))
+            if future is not None:
+                self.storage.delete(future.result())
+        if self.blobs:
+            raise VaultError(f"{len(self.blobs)} blobs are not referenced by any file row")
+        self.invalidate()
+
+
+def _read_member(tar, member) -> Tuple[object, str, int]:
+    """Spool a member and check it against its recorded checksum."""
+    expected = member.pax_headers.get(CHECKSUM_HEADER)
+    if not expected:
+        raise VaultError(f"{member.name} has no checksum")
+    spool = _spool(BLOB_SPOOL_SIZE if member.name.startswith("blobs/") else ROWS_SPOOL_SIZE)
+    sha, size = _copy(tar.extractfile(member), spool)
+    if sha != expected:
+        spool.close()
+        raise VaultError(f"Checksum mismatch for {member.name}")
+    spool.seek(0)
+    return spool, sha, size
+
+
+def _read_json(spool) -> Dict:
+    with spool:
+        return json.loads(spool.read())
+
+
+def _read_rows(spool) -> List[Dict]:
+    with spool:
+        return [json.loads(line) for line in spool if line.strip()]
+
+
+def import_vault(
+    fileobj,
+    create_users: bool = False,
+    workers: int = 4,
+    dry_run: bool = False,
+    log: Callable[[str], None] = lambda message: None,
+) -> Dict:
+    """Load a vault archive from ``fileobj``; return the counts imported.
+
+    With ``dry_run`` every checksum and reference is verified but nothing is written.
+    """
+    digest = hashlib.sha256()
+    members = 0
+    header = manifest = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        importer = _Importer(pool, workers, create_users, dry_run)
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    if manifest is not None:
+                        raise VaultError(f"Unexpected member {member.name} after manifest")
+                    spool, sha, size = _read_member(tar, member)
+                    name = member.name
+                    if name == "manifest.json":
+                        manifest = _read_json(spool)
+                        continue
+                    members += 1
+                    digest.update(f"{name}\0{sha}\n".encode())
+                    if name == "vault.json":
+                        header = _read_json(spool)
+                        if header.get("format") != FORMAT or header.get("version") not in READABLE_VERSIONS:
+                            raise VaultError("Not a supported vault archive")
+                    elif header is None:
+                        raise VaultError("Archive does not start with vault.json")
+                    elif name.startswith("keys/"):
+                        importer.import_keys(_read_rows(spool))
+                    elif name.startswith("data/"):
+                        importer.import_data(_read_rows(spool))
+                    elif name.startswith("blobs/"):
+                        importer.add_blob(name, spool, sha, size)
+                    elif name.startswith("files/"):
+                        importer.import_files(_read_rows(spool))
+                        log(f"files: {importer.counts['files']} ({importer.counts['blob_bytes']} bytes)")
+                    else:
+                        spool.close()
+                        raise VaultError(f"Unknown member {name}")
+
+            if manifest is None:
+                raise VaultError("Archive is truncated: manifest.json is missing")
+            if manifest.get("members") != members or manifest.get("digest") != digest.hexdigest():
+                raise VaultError("Archive members do not match the manifest")
+            for kind in ("keys", "data", "files"):
+                if manifest["counts"].get(kind) != importer.counts[kind]:
+                    raise VaultError(
+                        f"Manifest lists {manifest['counts'].get(kind)} {kind}, archive holds {importer.counts[kind]}"
+                    )
+            importer.finish(manifest.get("orphaned_members", ()))
+        except tarfile.TarError as exc:
+            importer.abort()
+            raise VaultError(f"Corrupt archive: {exc}") from exc
+        except Exception:
+            importer.abort()
+            raise
+    return importer.counts
+
@@ -1,13 +1,28 @@
 from django.shortcuts import render
-from django.http import JsonResponse
-from django.core.files.base import ContentFile
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.files.base import ContentFile, File
 from django.conf import settings
-from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import FileSystemStorage, default_storage
 from .models import EncryptionKey, EncryptedData, EncryptedFile
-from cryptography.fernet import Fernet
+from .batch import BatchError, encrypt_batch, iter_entries
+from . import fragments, locks, metrics, rollups, search, segments
+from .keycache import resolve_key
+from .locks import LockTimeout, VersionConflict
+from .ratelimit import client_ip, ratelimit
+from .uploads import EncryptedUpload, encrypt_uploads
+from .ciphers import (
+    CIPHER_CHOICES,
+    DEFAULT_CIPHER,
+    InvalidToken,
+    generate_key as generate_key_value,
+)
+import hmac
 import os
+import re
+import tempfile
 from django.db import IntegrityError
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
 from django.shortcuts import redirect
 from django.contrib.auth.models import User
 from django.contrib.admin.views.decorators import staff_member_required
@@ -15,29 +30,40 @@ from django.contrib import messages
 
 
 @login_required
+@ratelimit("crypto")
 def generate_key(request):
     if request.method == "POST":
         key_name = request.POST.get("key_name")
-        if key_name:
-            key_value = Fernet.generate_key().decode()
+        cipher = request.POST.get("cipher") or DEFAULT_CIPHER
+        if cipher not in dict(CIPHER_CHOICES):
+            messages.error(request, f"Unknown cipher suite '{cipher}'.")
+        elif key_name:
+            key_value = generate_key_value(cipher)
             try:
                 EncryptionKey.objects.create(
-                    key_name=key_name, key_value=key_value, user=request.user
+                    key_name=key_name, key_value=key_value, cipher=cipher, user=request.user
                 )
                 return render(
                     request,
                     "encryption/generate_key.html",
-                    {"key_value": key_value, "success": True},
+                    {
+                        "key_value": key_value,
+                        "success": True,
+                        "cipher_choices": CIPHER_CHOICES,
+                    },
                 )
             except IntegrityError:
                 messages.error(
                     request,
                     f"Key name '{key_name}' already exists. Please choose a different name.",
                 )
-    return render(request, "encryption/generate_key.html")
+    return render(
+        request, "encryption/generate_key.html", {"cipher_choices": CIPHER_CHOICES}
+    )
 
 
 @login_required
+@ratelimit("crypto")
 def encrypt_data(request):
     if request.method == "POST":
         data_name = request.POST.get("data_name")
@@ -46,15 +72,17 @@ def encrypt_data(request):
         user = request.user
         if data_name and data_value and key_name:
             try:
-                key = EncryptionKey.objects.get(key_name=key_name)
-                fernet = Fernet(key.key_value.encode())
-                encrypted_value = fernet.encrypt(data_value.encode()).decode()
-                EncryptedData.objects.create(
+                key = resolve_key(request.user, key_name)
+                encrypted_value = key.get_cipher().for_new_record().encrypt_text(data_value)
+                record = EncryptedData.create(
+                    encrypted_value,
                     data_name=data_name,
-                    encrypted_value=encrypted_value,
                     key=key,
                     user=user,
                 )
+                if request.POST.get("searchable"):
+                    search.index_tokens(record, data_value)
+                rollups.record(user, encryptions=1, bytes_processed=len(data_value.encode()))
                 return render(
                     request,
                     "encryption/encrypt_data.html",
@@ -68,6 +96,7 @@ def encrypt_data(request):
 
 
 @login_required
+@ratelimit("crypto")
 def decrypt_data(request):
     if request.method == "POST":
         data_name = request.POST.get("data_name")
@@ -75,10 +104,10 @@ def decrypt_data(request):
 
         if data_name and key_name:
             try:
-                key = EncryptionKey.objects.get(key_name=key_name)
-                data = EncryptedData.objects.get(data_name=data_name, key=key)
-                fernet = Fernet(key.key_value.encode())
-                decrypted_value = fernet.decrypt(data.encrypted_value.encode()).decode()
+                key = resolve_key(request.user, key_name)
+                data = EncryptedData.objects.select_related("payload").get(data_name=data_name, key=key)
+                decrypted_value = key.get_cipher().decrypt_text(data.encrypted_value)
+                rollups.record(request.user, decryptions=1, bytes_processed=len(decrypted_value.encode()))
                 return render(
                     request,
                     "encryption/decrypt_data.html",
@@ -90,40 +119,66 @@ def decrypt_data(request):
                     "encryption/decrypt_data.html",
                     {"error": "Key or data not found"},
                 )
+            except InvalidToken:
+                return render(
+                    request,
+                    "encryption/decrypt_data.html",
+                    {"error": "Decryption failed: data is corrupt or the key does not match"},
+                )
     return render(request, "encryption/decrypt_data.html")
 
 
 # File Encryption View
 @login_required
+@ratelimit("crypto")
+@encrypt_uploads("file")
 def encrypt_file(request):
-    if request.method == "POST" and request.FILES["file"]:
+    if request.method == "POST" and request.FILES.get("file"):
         file = request.FILES["file"]
         key_name = request.POST.get("key_name")
         user = request.user
 
+        if isinstance(file, EncryptedUpload):
+            # Encrypted and stored while it was received (key from ?key_name=)
+            file.save(user)
+            rollups.record(user, encryptions=1, bytes_processed=file.size)
+            return render(
+                request,
+                "encryption/encrypt_file.html",
+                {"message": "File encrypted successfully"},
+            )
+
         if key_name:
             try:
-                key = EncryptionKey.objects.get(key_name=key_name)
-                fernet = Fernet(key.key_value.encode())
+                key = resolve_key(request.user, key_name)
+
+                if request.POST.get("segmented"):
+                    # Stream the upload into independently encrypted segments
+                    # so the file can be appended to and read by range
+                    segments.create(key, user, file.name, file.chunks(segments.segment_size()))
+                    rollups.record(user, encryptions=1, bytes_processed=file.size)
+                    return render(
+                        request,
+                        "encryption/encrypt_file.html",
+                        {"message": "File encrypted successfully"},
+                    )
+
+                cipher = key.get_cipher().for_new_record()
 
                 # Encrypt file content
-                encrypted_content = fernet.encrypt(file.read())
+                content = file.read()
+                encrypted_content = cipher.encrypt(content)
 
-                # Save encrypted file to media directory
-                encrypted_file_path = os.path.join(
-                    settings.MEDIA_ROOT, "encrypted_files", file.name
+                # Save encrypted blob through the configured storage backend
+                # and record it in the database
+                encrypted_file_instance = EncryptedFile(
+                    file_name=file.name, key=key, user=user, size=len(content)
                 )
-                os.makedirs(os.path.dirname(encrypted_file_path), exist_ok=True)
-                with open(encrypted_file_path, "wb") as f:
-                    f.write(encrypted_content)
-
-                # Save file record in the database
-                encrypted_file_instance = EncryptedFile.objects.create(
-                    file_name=file.name,
-                    encrypted_file=f"encrypted_files/{file.name}",
-                    key=key,
-                    user=user,
+                encrypted_file_instance.encrypted_file.save(
+                    file.name, ContentFile(encrypted_content), save=False
                 )
+                encrypted_file_instance.save()
+                rollups.record(user, encryptions=1, bytes_processed=len(content))
 
                 return render(
                     request,
@@ -137,8 +192,51 @@ def encrypt_file(request):
     return render(request, "encryption/encrypt_file.html")
 
 
+# Batch File Encryption View
+@login_required
+@ratelimit("crypto")
+def encrypt_files_batch(request):
+    """Encrypt many uploaded files (or zip/tar archive entries) in one request.
+
+    Returns a JSON manifest with one entry per encrypted file.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    key_name = request.POST.get("key_name")
+    uploads = request.FILES.getlist("files")
+    expand_archives = request.POST.get("expand_archives", "true").lower() in ("1", "true", "yes")
+    if not key_name or not uploads:
+        return JsonResponse({"error": "key_name and files are required"}, status=400)
+
+    try:
+        key = resolve_key(request.user, key_name)
+    except EncryptionKey.DoesNotExist:
+        return JsonResponse({"error": "Key not found"}, status=404)
+
+    try:
+        manifest = encrypt_batch(
+            key, request.user, iter_entries(uploads, expand_archives=expand_archives)
+        )
+    except BatchError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    encrypted = [item for item in manifest if item["status"] == "encrypted"]
+    rollups.record(request.user, encryptions=len(encrypted), bytes_processed=sum(item["size"] for item in encrypted))
+
+    return JsonResponse(
+        {
+            "key_name": key.key_name,
+            "encrypted": len(encrypted),
+            "failed": sum(1 for item in manifest if item["status"] == "error"),
+            "files": manifest,
+        }
+    )
+
+
 # File Decryption View
 @login_required
+@ratelimit("crypto")
 def decrypt_file(request):
     if request.method == "POST":
         file_name = request.POST.get("file_name")
@@ -146,38 +244,48 @@ def decrypt_file(request):
 
         if file_name and key_name:
             try:
-                key = EncryptionKey.objects.get(key_name=key_name)
-                encrypted_file_instance = EncryptedFile.objects.get(
+                key = resolve_key(request.user, key_name)
+                # Uploads may reuse a name; the newest file wins
+                encrypted_file_instance = EncryptedFile.objects.filter(
                     file_name=file_name, key=key
-                )
-                fernet = Fernet(key.key_value.encode())
+                ).latest("id")
+                cipher = key.get_cipher()
 
-                # Read encrypted file content
-                encrypted_file_path = os.path.join(
-                    settings.MEDIA_ROOT, encrypted_file_instance.encrypted_file.name
-                )
-                with open(encrypted_file_path, "rb") as f:
-                    encrypted_content = f.read()
+                if encrypted_file_instance.segmented:
+                    # Decrypt segment by segment, spooling to disk past 8 MiB
+                    decrypted_file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+                    for chunk in segments.iter_plaintext(encrypted_file_instance):
+                        decrypted_file.write(chunk)
+                    decrypted_file.seek(0)
+                    decrypted = File(decrypted_file)
+                else:
+                    # Read encrypted file content
+                    with encrypted_file_instance.encrypted_file.open("rb") as f:
+                        encrypted_content = f.read()
 
-                # Decrypt file content
-                decrypted_content = fernet.decrypt(encrypted_content)
+                    # Decrypt file content
+                    decrypted = ContentFile(cipher.decrypt(encrypted_content))
 
-                # Save decrypted file to media directory
-                decrypted_file_path = os.path.join(
-                    settings.MEDIA_ROOT, "decrypted_files", file_name
+                # Save decrypted file to media directory, under a path of its own
+                # per user and file. Replacing the previous copy is serialised so
+                # concurrent decrypts (on any node) don't delete each other's output.
+                decrypted_name = (
+                    f"decrypted_files/{request.user.pk}/{encrypted_file_instance.pk}/"
+                    f"{os.path.basename(file_name)}"
                 )
-                os.makedirs(os.path.dirname(decrypted_file_path), exist_ok=True)
-                with open(decrypted_file_path, "wb") as f:
-                    f.write(decrypted_content)
+                with locks.named_lock(f"decrypted:{decrypted_name}"):
+                    if default_storage.exists(decrypted_name):
+                        default_storage.delete(decrypted_name)
+                    decrypted_name = default_storage.save(decrypted_name, decrypted)
+                rollups.record(request.user, decryptions=1, bytes_processed=decrypted.size)
 
                 return render(
                     request,
                     "encryption/decrypt_file.html",
                     {
                         "message": "File decrypted successfully",
-                        "file_path": f"decrypted_files/{file_name}",
-                        "decrypted_file_url": settings.MEDIA_URL
-                        + f"decrypted_files/{file_name}",
+                        "file_path": decrypted_name,
+                        "decrypted_file_url": default_storage.url(decrypted_name),
                     },
                 )
             except (EncryptionKey.DoesNotExist, EncryptedFile.DoesNotExist):
@@ -186,45 +294,247 @@ def decrypt_file(request):
                     "encryption/decrypt_file.html",
                     {"error": "Key or file not found"},
                 )
+            except InvalidToken:
+                return render(
+                    request,
+                    "encryption/decrypt_file.html",
+                    {"error": "Decryption failed: file is corrupt or the key does not match"},
+                )
+            except LockTimeout:
+                return render(
+                    request,
+                    "encryption/decrypt_file.html",
+                    {"error": "The file is busy; try again"},
+                )
     return render(request, "encryption/decrypt_file.html")
 
 
+@login_required
+@ratelimit("crypto")
+def append_file(request):
+    """Append the uploaded ``file`` to the user's segmented file ``file_name``.
+
+    Only the new data is encrypted; existing segments are left untouched. With
+    ``version``, the append is refused (409) unless the file is still at it.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    key_name = request.POST.get("key_name")
+    file_name = request.POST.get("file_name")
+    upload = request.FILES.get("file")
+    if not key_name or not file_name or upload is None:
+        return JsonResponse({"error": "key_name, file_name and file are required"}, status=400)
+
+    try:
+        key = resolve_key(request.user, key_name)
+        encrypted_file = EncryptedFile.objects.get(file_name=file_name, key=key, user=request.user)
+    except (EncryptionKey.DoesNotExist, EncryptedFile.DoesNotExist):
+        return JsonResponse({"error": "Key or file not found"}, status=404)
+    if not encrypted_file.segmented:
+        return JsonResponse({"error": "File was not stored in segments and cannot be appended to"}, status=409)
+
+    try:
+        appended = segments.append(
+            encrypted_file, upload.chunks(segments.segment_size()), expected_version=_posted_version(request)
+        )
+    except ValueError:
+        return JsonResponse({"error": "version must be an integer"}, status=400)
+    except EncryptedFile.DoesNotExist:
+        return JsonResponse({"error": "Key or file not found"}, status=404)
+    except VersionConflict as exc:
+        return JsonResponse({"error": "File changed since that version", "version": exc.current}, status=409)
+    except LockTimeout:
+        return JsonResponse({"error": "File is busy, try again"}, status=503)
+    rollups.record(request.user, encryptions=1, bytes_processed=appended)
+    return JsonResponse(
+        {"id": encrypted_file.pk, "appended": appended, "size": encrypted_file.size, "version": encrypted_file.version}
+    )
+
+
+def _posted_version(request):
+    """The optional ``version`` a write is based on (raises ValueError if malformed)."""
+    version = request.POST.get("version")
+    return int(version) if version else None
+
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _requested_range(request, size):
+    """``(start, end)`` (end exclusive) from a single-range Range header or ?start=&end=.
+
+    Returns None when the range cannot be satisfied.
+    """
+    header = request.META.get("HTTP_RANGE", "")
+    if header:
+        match = _RANGE.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            # Suffix range: the last N bytes
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+    else:
+        try:
+            start = int(request.GET.get("start", 0))
+            end = min(int(request.GET.get("end", size)), size)
+        except ValueError:
+            return None
+    if start < 0 or start >= end:
+        return None
+    return start, end
+
+
+@login_required
+@ratelimit("crypto", methods=("GET",))
+def download_file_range(request, file_id):
+    """Stream decrypted bytes of one of the user's files.
+
+    Honours a single ``Range: bytes=a-b`` header (or ``?start=&end=``, end
+    exclusive) with a 206 response. Segmented files decrypt only the segments
+    covering the range; single-blob files are decrypted whole and sliced.
+    """
+    try:
+        encrypted_file = EncryptedFile.objects.select_related("key").get(id=file_id, user=request.user)
+    except EncryptedFile.DoesNotExist:
+        return JsonResponse({"error": "File not found"}, status=404)
+
+    size = encrypted_file.size
+    if size is None:
+        # Older single-blob files do not record their size
+        size = sum(len(chunk) for chunk in segments.read_range(encrypted_file))
+        EncryptedFile.objects.filter(pk=encrypted_file.pk).update(size=size)
+
+    partial = "HTTP_RANGE" in request.META or "start" in request.GET or "end" in request.GET
+    requested = _requested_range(request, size) if partial else (0, size)
+    if requested is None:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    start, end = requested
+
+    try:
+        # Decrypt the first piece up front so a bad key or blob is a clean error
+        body = segments.read_range(encrypted_file, start, end)
+        first = next(body, b"")
+    except InvalidToken:
+        return JsonResponse({"error": "Decryption failed: file is corrupt or the key does not match"}, status=500)
+
+    def stream():
+        yield first
+        yield from body
+
+    rollups.record(request.user, decryptions=1, bytes_processed=end - start)
+
+    response = StreamingHttpResponse(stream(), status=206 if partial else 200, content_type="application/octet-stream")
+    response["Content-Length"] = str(end - start)
+    response["Accept-Ranges"] = "bytes"
+    response["Content-Disposition"] = f'attachment; filename="{os.path.basename(encrypted_file.file_name)}"'
+    if partial:
+        response["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return response
+
+
+@login_required
+def search_records(request):
+    """Blind-index search over the user's records: ?q=...&mode=prefix|exact|token&kind=data|file|all"""
+    query = request.GET.get("q", "")
+    mode = request.GET.get("mode", search.MODE_PREFIX)
+    kind = request.GET.get("kind", "all")
+    if mode not in search.MODES or kind not in ("data", "file", "all"):
+        return JsonResponse({"error": "Invalid mode or kind"}, status=400)
+
+    kinds = ["data", "file"] if kind == "all" else [kind]
+    results = []
+    for k in kinds:
+        for obj in search.search(query, k, mode, user=request.user):
+            results.append(
+                {
+                    "kind": k,
+                    "id": obj.pk,
+                    "name": obj.file_name if k == "file" else obj.data_name,
+                    "created_at": obj.created_at.isoformat(),
+                }
+            )
+    return JsonResponse({"query": query, "mode": mode, "results": results})
+
+
 @login_required
 def record_system(request):
-    keys = EncryptionKey.objects.all()
-    encrypted_files = EncryptedFile.objects.all()
-    return render(
+    version = fragments.records_version()
+    keys = EncryptionKey.objects.order_by("id")
+    encrypted_files = (
+        EncryptedFile.objects.select_related("key")
+        .only("file_name", "encrypted_file", "segmented", "version", "created_at", "key__key_name")
+        .order_by("id")
+    )
+    return fragments.stream_template(
         request,
         "encryption/record_system.html",
-        {"keys": keys, "encrypted_files": encrypted_files},
+        {},
+        {
+            "keys": fragments.RowStream(
+                "encryption/partials/record_key_rows.html",
+                keys,
+                # No cache_key: the rows contain key material
+            ),
+            "encrypted_files": fragments.RowStream(
+                "encryption/partials/record_file_rows.html",
+                encrypted_files,
+                cache_key=f"frag:record_files:{version}",
+            ),
+        },
     )
 
 
 @login_required
 def dashboard(request):
     # Only show data related to the current logged-in user
-    key_count = EncryptionKey.objects.filter(user=request.user).count()
-    file_count = EncryptedFile.objects.filter(user=request.user).count()
-    data_count = EncryptedData.objects.filter(user=request.user).count()
-    latest_key = EncryptionKey.objects.filter(user=request.user).order_by("-id").first()
-    latest_file = EncryptedFile.objects.filter(user=request.user).order_by("-id").first()
-    latest_data = EncryptedData.objects.filter(user=request.user).order_by("-id").first()
+    version = fragments.records_version(request.user.pk)
     user_keys = EncryptionKey.objects.filter(user=request.user)
     user_files = EncryptedFile.objects.filter(user=request.user)
     user_data = EncryptedData.objects.filter(user=request.user)
-    return render(
+    # Row partials only show names, sizes and key names; don't fetch key material
+    file_rows = user_files.select_related("key").only("file_name", "key__key_name")
+    data_rows = user_data.select_related("key").only("data_name", "encrypted_size", "key__key_name")
+    # Stats are passed as callables so they only hit the database when the
+    # cached stats fragment is stale
+    return fragments.stream_template(
         request,
         "encryption/dashboard.html",
         {
-            "key_count": key_count,
-            "file_count": file_count,
-            "data_count": data_count,
-            "latest_key": latest_key,
-            "latest_file": latest_file,
-            "latest_data": latest_data,
-            "user_keys": user_keys,
-            "user_files": user_files,
-            "user_data": user_data,
+            "records_version": version,
+            "fragment_timeout": fragments.fragment_timeout(),
+            "key_count": user_keys.count,
+            "file_count": user_files.count,
+            "data_count": user_data.count,
+            "latest_key": user_keys.only("key_name").order_by("-id").first,
+            "latest_file": user_files.only("file_name").order_by("-id").first,
+            "latest_data": user_data.only("data_name").order_by("-id").first,
+        },
+        {
+            "user_keys": fragments.RowStream(
+                "encryption/partials/key_rows.html",
+                user_keys.only("key_name", "key_value").order_by("id"),
+                empty_html='<tr><td colspan="2">No keys found.</td></tr>',
+                # No cache_key: the rows contain key material
+            ),
+            "user_files": fragments.RowStream(
+                "encryption/partials/file_rows.html",
+                file_rows.order_by("id"),
+                empty_html='<tr><td colspan="2">No files found.</td></tr>',
+                cache_key=f"frag:dashboard_files:{request.user.pk}:{version}",
+            ),
+            "user_data": fragments.RowStream(
+                "encryption/partials/data_rows.html",
+                data_rows.order_by("id"),
+                empty_html='<tr><td colspan="3">No data found.</td></tr>',
+                cache_key=f"frag:dashboard_data:{request.user.pk}:{version}",
+            ),
         },
     )
 
@@ -240,45 +550,93 @@ def root_redirect(request):
 
 @staff_member_required
 def custom_admin_panel(request):
-    user_count = User.objects.count()
-    file_count = EncryptedFile.objects.count()
-    key_count = EncryptionKey.objects.count()
-    users = User.objects.all()
-    keys = EncryptionKey.objects.all()
-    encrypted_files = EncryptedFile.objects.all()
-    encrypted_data = EncryptedData.objects.all()
-    # More details for dashboard
-    staff_count = User.objects.filter(is_staff=True).count()
-    superuser_count = User.objects.filter(is_superuser=True).count()
-    latest_user = User.objects.order_by("-date_joined").first()
-    latest_file = EncryptedFile.objects.order_by("-id").first()
-    latest_key = EncryptionKey.objects.order_by("-id").first()
-    return render(
+    version = fragments.records_version()
+    try:
+        days = min(max(int(request.GET.get("days", 30)), 7), 365)
+    except ValueError:
+        days = 30
+    # Include this worker's buffered counts; other workers' arrive within ROLLUP_FLUSH_INTERVAL
+    rollups.flush()
+    return fragments.stream_template(
         request,
         "encryption/admin_panel.html",
         {
-            "user_count": user_count,
-            "file_count": file_count,
-            "key_count": key_count,
-            "users": users,
-            "keys": keys,
-            "encrypted_files": encrypted_files,
-            "encrypted_data": encrypted_data,
-            "staff_count": staff_count,
-            "superuser_count": superuser_count,
-            "latest_user": latest_user,
-            "latest_file": latest_file,
-            "latest_key": latest_key,
+            "activity_days": days,
+            "activity": rollups.daily_totals(days),
+            "records_version": version,
+            "fragment_timeout": fragments.fragment_timeout(),
+            "user_count": User.objects.count,
+            "file_count": EncryptedFile.objects.count,
+            "key_count": EncryptionKey.objects.count,
+            "staff_count": User.objects.filter(is_staff=True).count,
+            "superuser_count": User.objects.filter(is_superuser=True).count,
+            "latest_user": User.objects.order_by("-date_joined").first,
+            "latest_file": EncryptedFile.objects.order_by("-id").first,
+            "latest_key": EncryptionKey.objects.order_by("-id").first,
+        },
+        {
+            "keys": fragments.RowStream(
+                "encryption/partials/key_rows.html",
+                EncryptionKey.objects.only("key_name", "key_value").order_by("id"),
+                empty_html='<tr><td colspan="2">No keys found.</td></tr>',
+                # No cache_key: the rows contain key material
+            ),
+            "encrypted_data": fragments.RowStream(
+                "encryption/partials/data_rows.html",
+                EncryptedData.objects.select_related("key")
+                .only("data_name", "encrypted_size", "key__key_name")
+                .order_by("id"),
+                empty_html='<tr><td colspan="3">No encrypted data found.</td></tr>',
+                cache_key=f"frag:admin_data:{version}",
+            ),
+            "encrypted_files": fragments.RowStream(
+                "encryption/partials/file_rows.html",
+                EncryptedFile.objects.select_related("key").only("file_name", "key__key_name").order_by("id"),
+                empty_html='<tr><td colspan="2">No encrypted files found.</td></tr>',
+                cache_key=f"frag:admin_files:{version}",
+            ),
+            "users": fragments.RowStream(
+                "encryption/partials/user_rows.html",
+                User.objects.order_by("id"),
+                empty_html='<tr><td colspan="3">No users found.</td></tr>',
+                cache_key=f"frag:admin_users:{version}",
+            ),
         },
     )
 
 
 @login_required
+@require_POST
 def delete_encrypted_file(request, file_id):
+    """Delete one of the user's files (staff may delete any).
+
+    Runs under the file's row lock, so it waits for an append in progress
+    instead of racing it. A posted ``version`` that is no longer current
+    refuses the delete. Blobs are removed once the deletion commits.
+    """
+    files = EncryptedFile.objects.all() if request.user.is_staff else EncryptedFile.objects.filter(user=request.user)
     try:
-        file_instance = EncryptedFile.objects.get(id=file_id)
-        file_instance.delete()
-        messages.success(request, "File deleted successfully.")
-    except EncryptedFile.DoesNotExist:
-        messages.error(request, "File not found.")
+        with locks.locked_row(files.only("id", "user_id", "version", "encrypted_file"), file_id) as file_instance:
+            if file_instance is None:
+                messages.error(request, "File not found.")
+            else:
+                locks.check_version(file_instance, _posted_version(request))
+                file_instance.delete()
+                messages.success(request, "File deleted successfully.")
+    except VersionConflict:
+        messages.error(request, "The file changed since this page was loaded; reload and try again.")
+    except LockTimeout:
+        messages.error(request, "The file is busy; try again.")
+    except ValueError:
+        messages.error(request, "Invalid file version.")
     return redirect('record_system')
+
+
+def metrics_endpoint(request):
+    """Prometheus scrape target; restricted to METRICS_ALLOWED_IPS or METRICS_TOKEN."""
+    token = getattr(settings, "METRICS_TOKEN", "")
+    supplied = request.META.get("HTTP_AUTHORIZATION", "").removeprefix("Bearer ").strip()
+    allowed = client_ip(request) in getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])
+    if not allowed and not (token and supplied and hmac.compare_digest(supplied, token)):
+        return HttpResponse("Forbidden", status=403, content_type="text/plain")
+    return HttpResponse(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
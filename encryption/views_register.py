@@ -6,35 +6,36 @@ Fix: Make Resend email sending reliable, with rich diagnostics and SMTP fallback
 """
 from typing import Optional, Dict, Any
 import os
-import random
-import datetime
 import logging
 import json
-import smtplib
-
-# Optional requests import for HTTP fallback to Resend
-try:
-    import requests  # type: ignore
-except Exception:  # pragma: no cover
-    requests = None  # type: ignore
+import functools
+import importlib
 
 from django.shortcuts import render, redirect
-from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth import login as auth_login, logout as auth_logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 
-# Optional Resend SDK import
-try:
-    import resend  # type: ignore
-except Exception:  # pragma: no cover
-    resend = None  # type: ignore
+from . import metrics, otp, ratelimit, rollups
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _optional_import(name: str):
+    """Import an optional email SDK on first use instead of at worker start.
+
+    `requests` and `resend` cost tens of milliseconds to import and are only
+    needed when a verification email is actually sent.
+    """
+    try:
+        return importlib.import_module(name)
+    except Exception:  # pragma: no cover
+        return None
+
+
 # -------- Email helpers ----------------------------------------------------
 
 def _format_email_content(username: str, code: str) -> Dict[str, str]:
@@ -82,11 +83,15 @@ def _send_via_resend(to_email: str, subject: str, text: str, html: str) -> bool:
     test_recipient = getattr(settings, "RESEND_TEST_RECIPIENT", None) or os.environ.get("RESEND_TEST_RECIPIENT")
     test_from = getattr(settings, "RESEND_TEST_FROM", None) or os.environ.get("RESEND_TEST_FROM")
 
-    if resend is None or not api_key:
+    if not api_key:
+        return False
+    resend = _optional_import("resend")
+    if resend is None:
         return False
 
     try:
         resend.api_key = api_key
+        resend.api_url = getattr(settings, "RESEND_API_URL", "https://api.resend.com")
         # SDK expects dict payload; returns id dict on success
         payload: Dict[str, Any] = {
             "from": from_addr,
@@ -102,12 +107,13 @@ def _send_via_resend(to_email: str, subject: str, text: str, html: str) -> bool:
         _log_exception("Resend SDK send failed", exc)
 
         # Try HTTP API fallback if requests is available
+        requests = _optional_import("requests")
         if not requests:
             logger.warning("requests library not available; cannot use HTTP fallback for Resend")
             return False
 
         try:
-            url = "https://api.resend.com/emails"
+            url = f'{getattr(settings, "RESEND_API_URL", "https://api.resend.com").rstrip("/")}/emails'
             headers = {
                 "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json",
@@ -168,11 +174,12 @@ def _send_via_brevo_api(to_email: str, subject: str, text: str, html: str) -> bo
     api_key = getattr(settings, 'BREVO_API_KEY', None) or os.environ.get('BREVO_API_KEY')
     if not api_key:
         return False
+    requests = _optional_import("requests")
     if not requests:
         logger.warning("requests not available; cannot use Brevo REST API")
         return False
 
-    url = "https://api.brevo.com/v3/smtp/email"
+    url = f"{getattr(settings, 'BREVO_API_URL', 'https://api.brevo.com').rstrip('/')}/v3/smtp/email"
     headers = {
         'api-key': api_key,
         'Content-Type': 'application/json',
@@ -213,18 +220,28 @@ def _send_via_smtp(to_email: str, subject: str, text: str) -> bool:
         return False
 
 
+def _attempt(provider: str, send, *args) -> bool:
+    """Call one provider and record its outcome and latency."""
+    with metrics.EMAIL_LATENCY.labels(provider).time():
+        sent = send(*args)
+    metrics.EMAIL_SENDS.labels(provider, "sent" if sent else "failed").inc()
+    return sent
+
+
 def _send_verification_email(*, to_email: str, username: str, code: str) -> None:
     content = _format_email_content(username, code)
 
     # Prefer Resend SDK; fall back to SMTP if needed
-    if _send_via_resend(to_email, content["subject"], content["text"], content["html"]):
+    if _attempt("resend", _send_via_resend, to_email, content["subject"], content["text"], content["html"]):
         return
     # Try Brevo REST API (HTTPS) next - works when SMTP is blocked
-    if _send_via_brevo_api(to_email, content["subject"], content["text"], content["html"]):
+    if _attempt("brevo", _send_via_brevo_api, to_email, content["subject"], content["text"], content["html"]):
         return
-    if _send_via_smtp(to_email, content["subject"], content["text"]):
+    if _attempt("smtp", _send_via_smtp, to_email, content["subject"], content["text"]):
         return
 
+    metrics.EMAIL_SENDS.labels("console", "sent").inc()
+
     # Final fallback for development: log the OTP so testing can continue.
     logger.warning("All email delivery methods failed; falling back to console. OTP for %s is: %s", to_email, code)
     # Also print to stdout so developers running runserver see it immediately
@@ -257,6 +274,19 @@ def register(request):
 
 def login_view(request):
     if request.method == "POST":
+        # Throttle before the password check so bots can't burn CPU or email quota
+        allowed, retry_after = ratelimit.check(request, "login")
+        if not allowed:
+            form = AuthenticationForm(request, initial={"username": request.POST.get("username", "")})
+            response = render(
+                request,
+                "encryption/registration/login.html",
+                {"form": form, "error": f"Too many login attempts. Try again in {retry_after} seconds."},
+                status=429,
+            )
+            response["Retry-After"] = str(retry_after)
+            return response
+
         form = AuthenticationForm(request, data=request.POST)
         if form.is_valid():
             user = form.get_user()
@@ -267,10 +297,9 @@ def login_view(request):
                     {"form": form, "error": "No email on your account; contact admin."},
                 )
 
-            code = f"{random.randint(0, 999_999):06d}"
+            # The code itself never touches the session; only its hash is stored
+            code = otp.issue(user)
             request.session["pre_2fa_user_id"] = user.id
-            request.session["pre_2fa_code"] = code
-            request.session["pre_2fa_expires"] = (timezone.now() + datetime.timedelta(minutes=10)).timestamp()
 
             _send_verification_email(to_email=user.email, username=user.username, code=code)
             return redirect("verify_2fa")
@@ -284,23 +313,16 @@ def logout_view(request):
     return redirect("custom_login")
 
 
+@ratelimit.ratelimit("verify_2fa", template="encryption/registration/verify_2fa.html")
 def verify_2fa(request):
     if request.method == "POST":
-        code = request.POST.get("code")
-        stored_code = request.session.get("pre_2fa_code")
+        code = request.POST.get("code", "").strip()
         user_id = request.session.get("pre_2fa_user_id")
-        expires_ts = request.session.get("pre_2fa_expires")
-
-        if not (stored_code and user_id and expires_ts):
+        if not user_id:
             return redirect("custom_login")
 
-        if timezone.now().timestamp() > float(expires_ts):
-            request.session.pop("pre_2fa_code", None)
-            request.session.pop("pre_2fa_user_id", None)
-            request.session.pop("pre_2fa_expires", None)
-            return render(request, "encryption/registration/verify_2fa.html", {"error": "Code expired. Please login again."})
-
-        if code == stored_code:
+        outcome = otp.verify(user_id, code)
+        if outcome == otp.SUCCESS:
             User = get_user_model()
             try:
                 user = User.objects.get(id=user_id)
@@ -308,11 +330,21 @@ def verify_2fa(request):
                 return redirect("custom_login")
 
             auth_login(request, user)
-            request.session.pop("pre_2fa_code", None)
+            metrics.TWO_FACTOR.labels("success").inc()
             request.session.pop("pre_2fa_user_id", None)
-            request.session.pop("pre_2fa_expires", None)
             return redirect("dashboard")
-        else:
+        rollups.record(user_id, two_factor_failures=1)
+        if outcome == otp.INVALID:
+            metrics.TWO_FACTOR.labels("invalid").inc()
             return render(request, "encryption/registration/verify_2fa.html", {"error": "Invalid code."})
 
+        # Expired, locked after too many guesses, or already used: start over
+        metrics.TWO_FACTOR.labels(outcome).inc()
+        request.session.pop("pre_2fa_user_id", None)
+        message = {
+            otp.EXPIRED: "Code expired. Please login again.",
+            otp.LOCKED: "Too many invalid codes. Please login again.",
+        }.get(outcome, "Code is no longer valid. Please login again.")
+        return render(request, "encryption/registration/verify_2fa.html", {"error": message})
+
     return render(request, "encryption/registration/verify_2fa.html")